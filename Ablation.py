@@ -0,0 +1,18 @@
+from pathlib import Path
+
+from AblationFunctions import run_ablation
+from constants import *
+
+# -------------------------------------- FEATURES ABLATION --------------------------------------
+# Number of processes (None: as many as the variants, within the cores budget), each variant is scored with
+# fit_predict on every fold
+ABLATION_WORKERS = None
+# Toggle only the cells whose title contains one of these strings (None: every feature cell)
+ABLATION_CELLS = None
+ABLATION_TABLE = Path(predictions_dir, 'ablation.csv')
+
+print("Performing features ablation")
+ablation = run_ablation(ABLATION_TABLE, cells_filter=ABLATION_CELLS, n_workers=ABLATION_WORKERS)
+print("Baseline error: {}".format(ablation.attrs['baseline_error']))
+print(ablation.to_string(float_format='{:.5f}'.format))
+print("DONE")
@@ -0,0 +1,251 @@
+import ast
+import copy
+import io
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t
+from sklearn.metrics import mean_squared_log_error
+from sklearn.model_selection import KFold
+
+from RegressionFunctions import RANDOM_STATE, fit_predict
+from ResourceFunctions import available_cores, init_worker, split_cores
+
+# %% ~~~~~ FEATURES ABLATION ~~~~~
+# Every '# %%' cell of FeaturesEngineering.py that handles a feature is a toggleable block:
+# - 'remove' runs the block, then drops every column it created or registered in the lists of the features;
+# - 'add' runs the code commented out in a block without active code (e.g. TotalSF, Add logs).
+# The script runs once, keeping a copy of its variables before each block; a variant restarts from the copy of its
+# block, so only the cells downstream of the toggle are executed again. All the variants are scored on the same folds.
+FEATURES_SCRIPT = Path(os.path.dirname(os.path.abspath(__file__)), 'FeaturesEngineering.py')
+ABLATION_FOLDS = 5
+ABLATION_CONFIDENCE = 0.95
+
+# Cells that are part of the pipeline, not features
+FIXED_CELLS = ('Dropping outliers', 'Infos', 'Check for missing values')
+FEATURES_LISTS = ('columns_to_ohe', 'numeric_columns', 'boolean_columns')
+
+# Start of a statement in a commented line: an assignment or a call
+_CODE_LINE = re.compile(r"[A-Za-z_][\w.]*(\[[^\]]*\])*\s*(=|\+=|\(|\.\w+\()")
+
+
+def read_cells(path=FEATURES_SCRIPT):
+    """
+    :return: the code before the first cell (the imports) and the list of (title, source) of the cells
+    """
+    with open(path) as f:
+        lines = f.read().split('\n')
+
+    prelude, cells, headers, body = [], [], [], None
+    for line in lines:
+        if line.startswith('# %%'):
+            # A header with an empty body is merged with the next one (e.g. ExterQual and ExterCond)
+            if any(x.strip() for x in body or []):
+                cells.append(_cell(headers, body))
+                headers = []
+            headers.append(line)
+            body = []
+        elif body is None:
+            prelude.append(line)
+        else:
+            body.append(line)
+    cells.append(_cell(headers, body))
+    return '\n'.join(prelude), cells
+
+
+def _cell(headers, body):
+    return ' / '.join(x[4:].strip() for x in headers), '\n'.join(headers + body)
+
+
+def is_toggleable(title):
+    return '~~~~~' not in title and not title.isupper() and title not in FIXED_CELLS
+
+
+def has_active_code(source):
+    return len(ast.parse(source).body) > 0
+
+
+def commented_code(source):
+    """
+    :return: the statements commented out in the cell (prose comments are skipped), None if they are not valid code
+    """
+    statements, statement = [], None
+    for line in source.split('\n'):
+        code = line[2:] if line.startswith('# ') else None
+        if statement is not None:
+            if code is not None and not _is_complete(statement):
+                statement += '\n' + code
+                continue
+            if _is_complete(statement):
+                statements.append(statement)
+            statement = None
+        if code is not None and _CODE_LINE.match(code):
+            statement = code
+    if statement is not None and _is_complete(statement):
+        statements.append(statement)
+
+    code = '\n'.join(statements)
+    return code if statements and _is_complete(code) else None
+
+
+def _is_complete(code):
+    try:
+        ast.parse(code)
+        return True
+    except SyntaxError:
+        return False
+
+
+def _data(namespace):
+    # The variables of the script, the functions and the modules come from the prelude
+    return {name: value for name, value in namespace.items()
+            if not name.startswith('__') and isinstance(value, (pd.DataFrame, pd.Series, np.ndarray, list, dict,
+                                                                  tuple, set, str, int, float))}
+
+
+def _remove_block(namespace, source):
+    before = {name: list(namespace[name]) for name in FEATURES_LISTS}
+    columns = set(namespace['complete_df'].columns)
+    exec(source, namespace)
+
+    added = [x for name in FEATURES_LISTS for x in namespace[name] if x not in before[name]]
+    created = [x for x in namespace['complete_df'].columns if x not in columns]
+    removed = list(dict.fromkeys(added + created))
+    for name in FEATURES_LISTS:
+        namespace[name] = [x for x in namespace[name] if x not in removed or x in before[name]]
+
+    present = [x for x in removed if x in namespace['complete_df']]
+    if 'backup_df' in namespace:
+        # The block comes after the removal of the bad features
+        namespace['complete_df'] = namespace['complete_df'].drop(columns=present)
+    else:
+        namespace['columns_to_drop'].extend(x for x in present if x not in namespace['columns_to_drop'])
+    return removed
+
+
+# %% ~~~~~ VARIANTS ~~~~~
+def list_variants(cells):
+    """
+    :return: list of (position of the cell, variant) to evaluate
+    """
+    variants = []
+    for position, (title, source) in enumerate(cells):
+        if not is_toggleable(title):
+            continue
+        if has_active_code(source):
+            variants.append((position, 'remove'))
+        elif commented_code(source) is not None:
+            variants.append((position, 'add'))
+    return variants
+
+
+def run_script(prelude, cells, positions=()):
+    """
+    Runs the whole features script.
+    :return: the final variables and a copy of the variables before each of the given cells
+    """
+    namespace, snapshots = {}, {}
+    with redirect_stdout(io.StringIO()):
+        exec(prelude, namespace)
+        for position, (title, source) in enumerate(cells):
+            if position in positions:
+                snapshots[position] = copy.deepcopy(_data(namespace))
+            exec(compile(source, title, 'exec'), namespace)
+    return namespace, snapshots
+
+
+def evaluate_variant(prelude, cells, position, variant, snapshot, folds, fit_predict_function=fit_predict):
+    """
+    Runs the cells from position (the toggled one) with the variables of the snapshot and scores the final x_train.
+    :return: dict with the changed columns and the error of each fold (or the exception)
+    """
+    result = {'cell': cells[position][0], 'variant': variant, 'columns': [], 'errors': None, 'exception': None}
+    try:
+        with redirect_stdout(io.StringIO()):
+            namespace = {}
+            exec(prelude, namespace)
+            namespace.update(copy.deepcopy(snapshot))
+            for i, (title, source) in enumerate(cells[position:], position):
+                if i == position and variant == 'remove':
+                    result['columns'] = _remove_block(namespace, source)
+                elif i == position and variant == 'add':
+                    columns = set(namespace['complete_df'].columns)
+                    exec(compile(commented_code(source), title, 'exec'), namespace)
+                    result['columns'] = [x for x in namespace['complete_df'].columns if x not in columns]
+                else:
+                    exec(compile(source, title, 'exec'), namespace)
+
+            x, y = namespace['x_train'], namespace['y_train']
+            result['errors'] = [
+                np.sqrt(mean_squared_log_error(y.iloc[val_index],
+                                               fit_predict_function(x.iloc[train_index], y.iloc[train_index],
+                                                                    x.iloc[val_index])))
+                for train_index, val_index in folds]
+    except Exception as e:
+        result['exception'] = repr(e)
+    return result
+
+
+def ablation_table(baseline, results, confidence=ABLATION_CONFIDENCE):
+    """
+    Paired comparison with the baseline on the same folds: mean delta of the error and its t confidence interval.
+    A negative delta means the variant improves the score. The variants that do not change any column are skipped.
+    """
+    baseline_errors = np.array(baseline['errors'])
+    rows = []
+    for result in results:
+        if not result['columns'] and result['exception'] is None:
+            continue
+        row = {'cell': result['cell'], 'variant': result['variant'], 'n_columns': len(result['columns']),
+               'error': np.nan, 'delta': np.nan, 'ci_low': np.nan, 'ci_high': np.nan,
+               'exception': result['exception']}
+        if result['errors'] is not None:
+            deltas = np.array(result['errors']) - baseline_errors
+            half_width = t.ppf((1 + confidence) / 2, len(deltas) - 1) * deltas.std(ddof=1) / np.sqrt(len(deltas))
+            row.update(error=np.mean(result['errors']), delta=deltas.mean(),
+                       ci_low=deltas.mean() - half_width, ci_high=deltas.mean() + half_width)
+        rows.append(row)
+    table = pd.DataFrame(rows, columns=['cell', 'variant', 'n_columns', 'error', 'delta', 'ci_low', 'ci_high',
+                                        'exception'])
+    table.attrs['baseline_error'] = baseline_errors.mean()
+    return table.sort_values('delta', na_position='last').reset_index(drop=True)
+
+
+def run_ablation(output_path=None, cells_filter=None, n_folds=ABLATION_FOLDS, n_workers=None,
+                 fit_predict_function=fit_predict, script_path=FEATURES_SCRIPT):
+    """
+    :param cells_filter: if given, only the cells whose title contains one of these strings are toggled
+    :param n_workers: processes evaluating the variants (one per variant by default), the cores are split among them
+    :param fit_predict_function: same signature of fit_predict, a cheaper model can be used for a first sweep
+    :return: the ranked table of the variants (also written as csv to output_path)
+    """
+    prelude, cells = read_cells(script_path)
+    variants = [(position, variant) for position, variant in list_variants(cells)
+                if cells_filter is None or any(x in cells[position][0] for x in cells_filter)]
+    first_block = min([position for position, _ in variants], default=len(cells) - 1)
+
+    namespace, snapshots = run_script(prelude, cells, {first_block} | {position for position, _ in variants})
+    folds = list(KFold(n_splits=n_folds, shuffle=True, random_state=RANDOM_STATE).split(namespace['x_train']))
+
+    n_workers, worker_cores = split_cores(n_workers or len(variants) + 1, available_cores())
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(worker_cores,)) as executor:
+        baseline = executor.submit(evaluate_variant, prelude, cells, first_block, 'baseline',
+                                   snapshots[first_block], folds, fit_predict_function)
+        futures = [executor.submit(evaluate_variant, prelude, cells, position, variant, snapshots[position], folds,
+                                   fit_predict_function)
+                   for position, variant in variants]
+        baseline = baseline.result()
+        results = [future.result() for future in futures]
+
+    if baseline['errors'] is None:
+        raise RuntimeError('The baseline failed: {}'.format(baseline['exception']))
+    table = ablation_table(baseline, results)
+    if output_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        table.to_csv(output_path, index=False)
+    return table
@@ -0,0 +1,128 @@
+import json
+import os
+from itertools import permutations
+
+import joblib
+import numpy as np
+from sklearn.model_selection import KFold
+
+from CheckpointFunctions import fingerprint
+from FeatureStoreFunctions import function_fingerprint
+from RegressionFunctions import RANDOM_STATE, BLEND_WEIGHTS, fit_models, load_tuned_config, predict_members
+
+# Folds of the out-of-fold predictions of the members
+OOF_SPLITS = 5
+# First amount of weight moved from a member to another by the coordinate search, halved when nothing improves
+BLEND_STEP = 0.05
+BLEND_MIN_STEP = 1e-4
+# Name of the key of the cached out-of-fold predictions in their file
+OOF_KEY = 'key'
+
+
+# %% ~~~~~ OUT-OF-FOLD PREDICTIONS ~~~~~
+def compute_oof_predictions(x_train, y_train, n_splits=OOF_SPLITS):
+    """
+    Fits every member on each training split and predicts the held out rows.
+    :return: dict member -> out-of-fold predicted prices, plus 'y' with the true prices
+    """
+    x_train = x_train.reset_index(drop=True)
+    y_train = np.asarray(y_train, dtype=np.float64)
+    oof = {'y': y_train}
+    for train_index, val_index in KFold(n_splits=n_splits, shuffle=True, random_state=RANDOM_STATE).split(x_train):
+        models = fit_models(x_train.iloc[train_index], y_train[train_index])
+        for name, predictions in predict_members(models, x_train.iloc[val_index]).items():
+            oof.setdefault(name, np.zeros(y_train.shape[0]))[val_index] = predictions
+    return oof
+
+
+def oof_key(x_train, y_train, n_splits=OOF_SPLITS):
+    """
+    :return: hash of what the out-of-fold predictions depend on: the data (so the features config), the tuned config
+             and the code of the members with the constants it reads (e.g. RIDGE_ALPHAS)
+    """
+    return joblib.hash([fingerprint(x_train), fingerprint(np.asarray(y_train, dtype=np.float64)), load_tuned_config(),
+                        function_fingerprint(fit_models), function_fingerprint(predict_members), n_splits])
+
+
+def save_oof_predictions(oof, path, key=None):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.savez(path, **oof, **({OOF_KEY: np.array(key)} if key is not None else {}))
+
+
+def load_oof_predictions(path):
+    """
+    :return: the out-of-fold predictions and their key (None if not stored)
+    """
+    with np.load(path) as oof:
+        key = str(oof[OOF_KEY]) if OOF_KEY in oof.files else None
+        return {name: oof[name] for name in oof.files if name != OOF_KEY}, key
+
+
+def get_oof_predictions(path, x_train, y_train):
+    """
+    The out-of-fold predictions cached in path, computed (once) if missing or computed with other data, config or
+    members.
+    """
+    key = oof_key(x_train, y_train)
+    if os.path.exists(path):
+        oof, cached_key = load_oof_predictions(path)
+        if cached_key == key:
+            return oof
+        print("The out-of-fold predictions in {} are stale, recomputing them".format(path))
+    oof = compute_oof_predictions(x_train, y_train)
+    save_oof_predictions(oof, path, key)
+    return oof
+
+
+# %% ~~~~~ WEIGHTS SEARCH ~~~~~
+def blend_errors(oof, candidates, members=None):
+    """
+    RMSLE of many blends at once.
+    :param candidates: (n_candidates, n_members) weights, columns in the order of members
+    """
+    members = list(BLEND_WEIGHTS) if members is None else members
+    predictions = np.column_stack([oof[name] for name in members]) @ np.atleast_2d(candidates).T
+    log_error = np.log1p(np.maximum(predictions, 0)) - np.log1p(oof['y'])[:, None]
+    return np.sqrt(np.mean(log_error ** 2, axis=0))
+
+
+def optimize_blend_weights(oof, start=None, step=BLEND_STEP, min_step=BLEND_MIN_STEP):
+    """
+    Coordinate search on the simplex: at each iteration every transfer of step weight from a member to another is
+    evaluated (all together), the best one is applied if it lowers the RMSLE, otherwise the step is halved.
+    The weights stay non-negative and sum to 1.
+    :param start: dict of the initial weights, BLEND_WEIGHTS by default
+    :return: dict of the optimized weights (same order of the start) and their RMSLE on the out-of-fold predictions
+    """
+    start = BLEND_WEIGHTS if start is None else start
+    members = list(start)
+    weights = np.array([start[name] for name in members], dtype=np.float64)
+    weights /= weights.sum()
+    error = blend_errors(oof, weights, members)[0]
+
+    pairs = np.array(list(permutations(range(len(members)), 2)))
+    while step >= min_step:
+        candidates = np.repeat(weights[None, :], pairs.shape[0], axis=0)
+        moved = np.minimum(step, candidates[np.arange(pairs.shape[0]), pairs[:, 1]])
+        candidates[np.arange(pairs.shape[0]), pairs[:, 0]] += moved
+        candidates[np.arange(pairs.shape[0]), pairs[:, 1]] -= moved
+
+        errors = blend_errors(oof, candidates, members)
+        best = int(np.argmin(errors))
+        if errors[best] < error - 1e-12:
+            weights, error = candidates[best], errors[best]
+        else:
+            step /= 2
+
+    return dict(zip(members, weights.tolist())), error
+
+
+def save_blend_weights(weights, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(weights, f, indent=4)
+
+
+def load_blend_weights(path):
+    with open(path) as f:
+        return json.load(f)
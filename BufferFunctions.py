@@ -0,0 +1,137 @@
+import sys
+
+import numpy as np
+import pandas as pd
+
+from constants import *
+
+# %% ~~~~~ FEATURE BUFFER ~~~~~
+# The engineered features are converted once into a single read-only float64 buffer, column-major (the order the
+# coordinate descent of Lasso and ElasticNet works on, sklearn converts every other input to it) and aligned to
+# BUFFER_ALIGNMENT bytes. Every member, the stack and the predictions get the buffer itself: the validation of sklearn
+# accepts it as it is, without the conversions of a DataFrame (dtype and order) of every estimator.
+# CopyCounter counts the full-matrix copies made by the validation of the estimators (check_array and check_X_y) while
+# it is active, with the estimator that made them: the scaled copies of the RobustScalers are needed, the others are the
+# ones to remove. The rows of the CV folds (x[train_index]) are copies made by the fancy indexing of numpy, they cannot
+# be views and they are not counted, as the copies of the estimators fitted in other processes.
+BUFFER_ALIGNMENT = 64
+BUFFER_DTYPE = np.float64
+# Copies of at least this share of the elements of the matrix are counted (the folds are most of it)
+BUFFER_COPY_SHARE = 0.5
+
+_VALIDATORS = ('check_array', 'check_X_y')
+
+
+def aligned_empty(shape, dtype=BUFFER_DTYPE, alignment=BUFFER_ALIGNMENT):
+    """
+    :return: empty column-major array whose data starts at a multiple of alignment bytes
+    """
+    dtype = np.dtype(dtype)
+    n_bytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.empty(n_bytes + alignment, dtype=np.uint8)
+    offset = -raw.ctypes.data % alignment
+    return raw[offset:offset + n_bytes].view(dtype).reshape(shape, order='F')
+
+
+def is_feature_buffer(x):
+    return (isinstance(x, np.ndarray) and x.dtype == BUFFER_DTYPE and x.ndim == 2 and x.flags.f_contiguous
+            and not x.flags.writeable and x.ctypes.data % BUFFER_ALIGNMENT == 0)
+
+
+def feature_buffer(x, name='x', budget=None):
+    """
+    :param x: the engineered features, DataFrame or matrix
+    :param budget: MemoryBudget, the buffer is memory-mapped when it does not fit in it
+    :return: the read-only buffer of x, x itself when it is already one
+    """
+    if is_feature_buffer(x):
+        return x
+    n_bytes = int(np.prod(x.shape)) * np.dtype(BUFFER_DTYPE).itemsize
+    if budget is not None and not budget.fits(n_bytes):
+        return budget.asarray(name, x, BUFFER_DTYPE, order='F')
+    buffer = aligned_empty(x.shape)
+    if isinstance(x, pd.DataFrame):
+        # Column by column, without the intermediate row-major copy of a DataFrame of mixed dtypes
+        for i in range(x.shape[1]):
+            buffer[:, i] = x.iloc[:, i].to_numpy(dtype=BUFFER_DTYPE)
+    else:
+        buffer[...] = x
+    buffer.flags.writeable = False
+    return buffer
+
+
+def _shares_memory(checked, x):
+    # The array of a DataFrame of a single dtype is a view of its block (its first column shares it), the one of a
+    # DataFrame of many dtypes is a copy
+    if isinstance(x, pd.DataFrame):
+        x = x.iloc[:, 0].to_numpy() if x.shape[1] else None
+    return isinstance(x, np.ndarray) and np.may_share_memory(checked, x)
+
+
+def _calling_estimator():
+    # The innermost estimator on the stack, the module of the caller for the functions
+    frame = sys._getframe(2)
+    caller = frame.f_globals.get('__name__')
+    while frame is not None:
+        estimator = frame.f_locals.get('self')
+        if hasattr(estimator, 'get_params'):
+            return type(estimator).__name__
+        frame = frame.f_back
+    return caller
+
+
+class CopyCounter:
+    """
+    Counts the copies of at least share * n_elements elements made by the validation of sklearn, e.g.
+    with CopyCounter(x.size) as copies: ...
+    then copies.count and copies.summary().
+    """
+
+    def __init__(self, n_elements, share=BUFFER_COPY_SHARE):
+        self.min_elements = share * n_elements
+        self.copies = []
+        self._patched = []
+
+    @property
+    def count(self):
+        return len(self.copies)
+
+    def _wrap(self, name, validate):
+        def wrapper(*args, **kwargs):
+            result = validate(*args, **kwargs)
+            x = args[0] if args else kwargs.get('X', kwargs.get('array'))
+            checked = result[0] if name == 'check_X_y' else result
+            if (isinstance(checked, np.ndarray) and checked.size >= self.min_elements
+                    and not _shares_memory(checked, x)):
+                self.copies.append({'estimator': _calling_estimator(), 'input': type(x).__name__,
+                                    'shape': checked.shape, 'dtype': str(checked.dtype)})
+            return result
+
+        return wrapper
+
+    def __enter__(self):
+        import sklearn.utils.validation
+
+        originals = {name: getattr(sklearn.utils.validation, name) for name in _VALIDATORS}
+        # The validators are imported by name in every module that uses them
+        for module in list(sys.modules.values()):
+            if module is None or not getattr(module, '__name__', '').startswith('sklearn'):
+                continue
+            for name, validate in originals.items():
+                if getattr(module, name, None) is validate:
+                    setattr(module, name, self._wrap(name, validate))
+                    self._patched.append((module, name, validate))
+        return self
+
+    def __exit__(self, *exc):
+        for module, name, validate in self._patched:
+            setattr(module, name, validate)
+        self._patched = []
+        return False
+
+    def summary(self):
+        """
+        :return: number of copies by estimator, type of the input and dtype of the copy
+        """
+        copies = pd.DataFrame(self.copies, columns=['estimator', 'input', 'shape', 'dtype'])
+        return copies.groupby(['estimator', 'input', 'dtype']).size().rename('copies').reset_index()
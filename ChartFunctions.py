@@ -0,0 +1,159 @@
+import atexit
+import shutil
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+
+import joblib
+import numpy as np
+from scipy.cluster.hierarchy import leaves_list, linkage
+from scipy.spatial.distance import squareform
+
+from ResourceFunctions import available_cores
+from constants import *
+
+# %% ~~~~~ CHARTS ~~~~~
+# The heatmaps are drawn with the non-interactive Agg backend in a pool of background processes (they also run on
+# headless servers, and the caller goes on while they are drawn): the render functions return a Future of the path.
+# Every image is cached under the hash of what it draws (the matrix, the labels and the style), a chart of an unchanged
+# matrix is copied from the cache without drawing.
+# The correlation matrices wider than CHART_MAX_COLUMNS are reordered by hierarchical clustering (the correlated
+# columns end up next to each other) and reduced to the CHART_MAX_COLUMNS columns most correlated with any other, the
+# correlations are estimated on CHART_MAX_ROWS rows at most.
+CHART_DIR = Path(predictions_dir, 'charts')
+CHART_CACHE_DIR = Path(CHART_DIR, 'cache')
+CHART_DPI = 150
+CHART_MAX_COLUMNS = 60
+CHART_MAX_ROWS = 100000
+# Matrices up to this size get the value written in every cell
+CHART_MAX_ANNOTATED = 40
+# Processes drawing at the same time (None for one per core)
+CHART_WORKERS = None
+# Bump to invalidate the cached images when the style of the charts changes
+CHART_VERSION = 1
+
+_CMAP = [(0, 1, 0, 1), (1, 1, 1, 1), (1, 1, 1, 1), (1, 1, 1, 1), (1, 1, 1, 1), (1, 1, 1, 1), (1, 1, 1, 1),
+         (0, 0, 0, 1)]
+
+_executor = None
+
+
+def _init_worker():
+    import matplotlib
+
+    matplotlib.use('Agg', force=True)
+
+
+def _renderer():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=CHART_WORKERS or available_cores(), initializer=_init_worker)
+        atexit.register(wait_charts)
+    return _executor
+
+
+def wait_charts():
+    """
+    Waits for the charts being drawn.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def _heatmap(path, data, labels, annot, title, figsize, xlabel=None, ylabel=None):
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+
+    sns.set(style="white")
+    f, ax = plt.subplots(figsize=figsize)
+    heatmap = sns.heatmap(data, xticklabels=labels, cbar=False, yticklabels=labels, cmap=_CMAP, square=True,
+                          annot=annot, fmt="g", linewidths=1, annot_kws={"size": 11}, ax=ax)
+    heatmap.yaxis.set_ticklabels(heatmap.yaxis.get_ticklabels(), rotation=0, ha='right', fontsize=12)
+    heatmap.xaxis.set_ticklabels(heatmap.xaxis.get_ticklabels(), rotation=45, ha='right', fontsize=12)
+    plt.title(title)
+    if xlabel:
+        plt.xlabel(xlabel)
+        plt.ylabel(ylabel)
+    plt.tight_layout()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Written under a temporary name, a cached image is never half drawn
+    plt.savefig(str(path) + '.tmp.png', dpi=CHART_DPI)
+    plt.close(f)
+    os.replace(str(path) + '.tmp.png', path)
+    return path
+
+
+def _draw_confusion_matrix(path, data, labels):
+    annot = data if len(data) <= CHART_MAX_ANNOTATED else False
+    data = np.where(data != 0, np.log(np.where(data != 0, data, 1)), 0)
+    return _heatmap(path, data, labels, annot, "Confusion Matrix", (20, 20), 'Predicted label', 'True label')
+
+
+def _draw_correlation(path, corr, labels):
+    # Square cells, a quarter of inch each (plus the labels)
+    size = max(9, 0.25 * len(labels) + 4)
+    return _heatmap(path, corr, labels, False, "Correlation", (size, size))
+
+
+def _copy_when_done(future, path):
+    result = Future()
+
+    def copy(done):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            shutil.copyfile(done.result(), path)
+            result.set_result(path)
+        except Exception as e:
+            result.set_exception(e)
+
+    future.add_done_callback(copy)
+    return result
+
+
+def _render(draw, path, *args):
+    """
+    :return: Future of the path, the image is drawn in the pool or copied from the cache
+    """
+    key = joblib.hash([CHART_VERSION, CHART_DPI, CHART_MAX_ANNOTATED, draw.__name__, args])
+    cached = Path(CHART_CACHE_DIR, '{}.png'.format(key))
+    if cached.exists():
+        future = Future()
+        future.set_result(str(cached))
+    else:
+        future = _renderer().submit(draw, str(cached), *args)
+    return _copy_when_done(future, path)
+
+
+def render_confusion_matrix(path, data, labels):
+    """
+    :param data: the confusion matrix, square
+    """
+    return _render(_draw_confusion_matrix, path, np.asarray(data), list(labels))
+
+
+def reduce_correlation(corr, max_columns=CHART_MAX_COLUMNS):
+    """
+    :return: the correlation matrix with the columns in the order of a hierarchical clustering (on 1 - |corr|), reduced
+             to the max_columns most correlated with any other
+    """
+    corr = corr.fillna(0)
+    if len(corr) > max_columns:
+        strongest = corr.abs().where(~np.eye(len(corr), dtype=bool)).max().nlargest(max_columns).index
+        corr = corr.loc[strongest, strongest]
+    if len(corr) > 2:
+        distance = np.clip(1 - np.abs(corr.values), 0, None)
+        np.fill_diagonal(distance, 0)
+        order = leaves_list(linkage(squareform(distance, checks=False), method='average'))
+        corr = corr.iloc[order, order]
+    return corr
+
+
+def render_correlation(path, df, max_columns=CHART_MAX_COLUMNS, max_rows=CHART_MAX_ROWS):
+    """
+    Heatmap of the correlations of the columns of df (see reduce_correlation).
+    """
+    if len(df) > max_rows:
+        df = df.sample(max_rows, random_state=0)
+    corr = reduce_correlation(df.corr(), max_columns)
+    return _render(_draw_correlation, path, corr.values, list(corr.columns))
@@ -0,0 +1,18 @@
+import time
+from pathlib import Path
+
+from ChartFunctions import CHART_DIR, render_correlation, wait_charts
+from FeaturesEngineering import get_engineered_train_test
+from constants import *
+
+# -------------------------------------- CHARTS --------------------------------------
+# Correlation heatmap of the engineered training matrix (with the target), drawn in the background (see ChartFunctions)
+CORRELATION_CHART = Path(CHART_DIR, 'correlation_train.png')
+
+((_, x_train, y_train), _) = get_engineered_train_test()
+
+start = time.time()
+chart = render_correlation(CORRELATION_CHART, x_train.assign(SalePrice=y_train.values))
+print("Submitted in {:.2f} s".format(time.time() - start))
+print("Drawn {} in {:.2f} s".format(chart.result(), time.time() - start))
+wait_charts()
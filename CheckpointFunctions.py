@@ -0,0 +1,233 @@
+import os
+import socket
+import time
+from functools import partial
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.model_selection import check_cv
+
+from ResourceFunctions import limit_threads, split_cores
+from constants import *
+
+# %% ~~~~~ CHECKPOINTS ~~~~~
+# Every unit of work of fit_models (a member, a fold of the stack, the meta regressor, a refit of a base regressor)
+# is saved as soon as it completes, under a key that hashes the estimator parameters and the training data.
+# A rerun loads the completed units and fits only the missing ones: the directory is also the cache of the fitted
+# models, a run that changes only the post-processing (blend weights, quantile_reductions) fits nothing. Several machines sharing the directory can run
+# the same fit together: a unit is claimed with a lock file, the units claimed by others are awaited.
+CHECKPOINT_DIR = Path(predictions_dir, 'checkpoints')
+# Seconds after which the lock of a unit (e.g. of a machine that crashed while fitting it) is taken over
+CHECKPOINT_LOCK_TIMEOUT = 6 * 3600
+# Seconds between two checks of the units fitted by other machines
+CHECKPOINT_POLL = 10
+# Size limit of the directory, the least recently used units are evicted beyond it (None for no limit)
+CHECKPOINT_MAX_BYTES = 4 * 1024 ** 3
+
+# Parameters that do not change the fitted model (and depend on the machine)
+_IGNORED_PARAMS = ('n_jobs', 'verbose', 'pre_dispatch')
+
+
+def fingerprint(data):
+    if isinstance(data, pd.DataFrame):
+        return joblib.hash([list(data.columns), data.values])
+    return joblib.hash(np.asarray(data))
+
+
+def _param_value(value):
+    # The nested estimators are described by their type, their parameters are already among the deep ones
+    if hasattr(value, 'get_params'):
+        return type(value).__name__
+    if isinstance(value, (list, tuple)):
+        return [_param_value(x) for x in value]
+    return value
+
+
+def unit_key(kind, estimator, x_fingerprint, y_fingerprint, extra=None):
+    params = {name: _param_value(value) for name, value in estimator.get_params(deep=True).items()
+              if not name.endswith(_IGNORED_PARAMS)}
+    return joblib.hash([kind, type(estimator).__name__, params, x_fingerprint, y_fingerprint, extra])
+
+
+class CheckpointStore:
+
+    def __init__(self, directory=CHECKPOINT_DIR, lock_timeout=CHECKPOINT_LOCK_TIMEOUT, poll=CHECKPOINT_POLL,
+                 max_bytes=CHECKPOINT_MAX_BYTES):
+        self.directory = Path(directory)
+        self.lock_timeout = lock_timeout
+        self.poll = poll
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return Path(self.directory, '{}.joblib'.format(key))
+
+    def _lock(self, key):
+        return Path(self.directory, '{}.lock'.format(key))
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            value = joblib.load(path)
+            # The modification time is the last use, for the eviction
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, value):
+        # Written aside and renamed, a unit is either complete or missing
+        tmp = Path(self.directory, '{}.{}.{}.tmp'.format(key, socket.gethostname(), os.getpid()))
+        joblib.dump(value, tmp)
+        os.replace(tmp, self._path(key))
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used units until the directory fits in max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+        units = []
+        for path in self.directory.glob('*.joblib'):
+            try:
+                stat = path.stat()
+                units.append((stat.st_mtime, stat.st_size, path))
+            except FileNotFoundError:
+                pass
+        total = sum(size for _, size, _ in units)
+        for _, size, path in sorted(units):
+            if total <= self.max_bytes:
+                break
+            if path.stem == keep:
+                continue
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def claim(self, key):
+        lock = self._lock(key)
+        for _ in range(2):
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, '{} {}'.format(socket.gethostname(), os.getpid()).encode())
+                os.close(fd)
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock) < self.lock_timeout:
+                        return False
+                    os.remove(lock)
+                except FileNotFoundError:
+                    pass
+        return False
+
+    def release(self, key):
+        try:
+            os.remove(self._lock(key))
+        except FileNotFoundError:
+            pass
+
+    def _compute(self, key, function):
+        # Run by the workers of run: the unit is saved as soon as it completes, then its lock is released
+        try:
+            value = function()
+            self.save(key, value)
+            return value
+        finally:
+            self.release(key)
+
+    def run(self, units, n_jobs=1):
+        """
+        :param units: list of (key, function without arguments)
+        :param n_jobs: processes computing the units claimed by this run
+        :return: dict key -> result, loaded if already computed (here or by another machine), computed otherwise
+        """
+        results, pending = {}, list(units)
+        while pending:
+            claimed, waiting = [], []
+            for key, function in pending:
+                value = self.load(key)
+                if value is not None:
+                    results[key] = value
+                    self.hits += 1
+                elif self.claim(key):
+                    claimed.append((key, function))
+                else:
+                    waiting.append((key, function))
+            try:
+                computed = Parallel(n_jobs=n_jobs)(delayed(self._compute)(key, function) for key, function in claimed)
+            except BaseException:
+                # The locks of the units of the workers that did not complete
+                for key, _ in claimed:
+                    self.release(key)
+                raise
+            self.misses += len(claimed)
+            results.update(zip([key for key, _ in claimed], computed))
+            if waiting:
+                time.sleep(self.poll)
+            pending = waiting
+        return results
+
+
+# %% ~~~~~ CHECKPOINTED FITS ~~~~~
+def _fit(estimator, x, y):
+    return clone(estimator).fit(x, y)
+
+
+def _fit_fold(estimator, x, y, train_index, val_index):
+    model = clone(estimator).fit(x[train_index], y[train_index])
+    return {'model': model, 'predictions': model.predict(x[val_index])}
+
+
+def fit_estimators(estimators, x, y, store, n_jobs=1):
+    """
+    :param n_jobs: processes fitting the estimators
+    :return: the fitted copies of the estimators
+    """
+    x_fingerprint, y_fingerprint = fingerprint(x), fingerprint(y)
+    keys = [unit_key('fit', estimator, x_fingerprint, y_fingerprint) for estimator in estimators]
+    results = store.run([(key, partial(_fit, estimator, x, y)) for key, estimator in zip(keys, estimators)], n_jobs)
+    return [results[key] for key in keys]
+
+
+def fit_stack(stack, x, y, store):
+    """
+    Same fit of StackingCVRegressor, one unit for each (base regressor, fold) with its out-of-fold predictions,
+    one for the meta regressor and one for each base regressor refitted on all the data.
+    The units are fitted by stack.n_jobs processes, the cores are split among them as in StackingCVRegressor.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    folds = list(check_cv(stack.cv, y).split(x, y))
+    x_fingerprint, y_fingerprint = fingerprint(x), fingerprint(y)
+
+    units, keys = [], []
+    for regressor in stack.regressors:
+        regressor_keys = []
+        for train_index, val_index in folds:
+            key = unit_key('fold', regressor, x_fingerprint, y_fingerprint, joblib.hash(val_index))
+            units.append((key, partial(_fit_fold, regressor, x, y, train_index, val_index)))
+            regressor_keys.append(key)
+        keys.append(regressor_keys)
+    n_jobs = stack.n_jobs or 1
+    with limit_threads(split_cores(n_jobs)[1]):
+        results = store.run(units, n_jobs)
+
+        meta_features = np.zeros((x.shape[0], len(stack.regressors)))
+        for i, regressor_keys in enumerate(keys):
+            for (_, val_index), key in zip(folds, regressor_keys):
+                meta_features[val_index, i] = results[key]['predictions']
+        if stack.use_features_in_secondary:
+            meta_features = np.hstack((x, meta_features))
+
+        stack.meta_regr_ = fit_estimators([stack.meta_regressor], meta_features, y, store)[0]
+        stack.regr_ = fit_estimators(stack.regressors, x, y, store, n_jobs)
+    return stack
@@ -0,0 +1,100 @@
+import operator
+
+import numpy as np
+import pandas as pd
+
+from constants import *
+
+# %% ~~~~~ DATA CORRECTIONS ~~~~~
+# Typos and inconsistencies of the raw rows, fixed before any feature step. Two kinds of rules:
+# - ID_CORRECTIONS: the value of a column of a single listing, joined on the Id column, a constant or a statistic of
+#   the column fitted once on the training rows (fit_corrections, so that every chunk gets the same value)
+# - PREDICATE_CORRECTIONS: every row where the comparison of a column with another one (plus an offset) holds gets the
+#   value of a column
+# Both are a vectorized join or mask on the rows of a batch, they do not depend on the order nor on the other rows of
+# the batch (chunks, streams and parallel workers get the same corrections) and applying them twice changes nothing.
+# Statistics the values of ID_CORRECTIONS can be, fitted by fit_corrections
+CORRECTION_STATISTICS = ('median', 'mode')
+
+# (Id, column, value)
+ID_CORRECTIONS = [
+    # Basements with a missing rating
+    (333, 'BsmtFinType2', 'ALQ'),
+    (949, 'BsmtExposure', 'No'),
+    (1488, 'BsmtExposure', 'No'),
+    (2041, 'BsmtCond', 'TA'),
+    (2186, 'BsmtCond', 'TA'),
+    (2218, 'BsmtQual', 'Po'),
+    (2219, 'BsmtQual', 'Fa'),
+    (2349, 'BsmtExposure', 'No'),
+    (2525, 'BsmtCond', 'Gd'),
+    # Detached garage without its size
+    (2577, 'GarageCars', 'median'),
+    (2577, 'GarageArea', 'median'),
+]
+
+# (column, comparison, other column, offset, column of the value): the column gets the value where
+# "column comparison other column + offset" holds
+PREDICATE_CORRECTIONS = [
+    # Garages built years after the sale (e.g. 2207 for 2007), the new builds sold before completion are a year ahead
+    ('GarageYrBlt', '>', 'YrSold', 1, 'YrSold'),
+]
+
+# The same functions compare pandas Series and polars expressions (see LazyFeaturesFunctions)
+COMPARISONS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le, '==': operator.eq,
+               '!=': operator.ne}
+
+
+def fit_corrections(dfs, id_rules=ID_CORRECTIONS):
+    """
+    :param dfs: the raw training rows, a list of DataFrames (e.g. train and test, or the chunks of a store)
+    :return: dict (column, statistic) -> value of the statistics of the ID_CORRECTIONS
+    """
+    needed = sorted({(column, value) for _, column, value in id_rules if value in CORRECTION_STATISTICS})
+    statistics = {}
+    for column in sorted({column for column, _ in needed}):
+        values = pd.concat([df[column] for df in dfs if column in df], ignore_index=True)
+        for statistic in [statistic for x, statistic in needed if x == column]:
+            statistics[column, statistic] = values.median() if statistic == 'median' else values.mode()[0]
+    return statistics
+
+
+def id_correction_values(statistics, id_rules=ID_CORRECTIONS):
+    """
+    :return: dict column -> {Id: value}, without the rules whose statistic is not fitted
+    """
+    values = {}
+    for row_id, column, value in id_rules:
+        if value in CORRECTION_STATISTICS:
+            if (column, value) not in statistics:
+                continue
+            value = statistics[column, value]
+        values.setdefault(column, {})[row_id] = value.item() if isinstance(value, np.generic) else value
+    return values
+
+
+def apply_corrections(df, statistics, id_rules=ID_CORRECTIONS, predicate_rules=PREDICATE_CORRECTIONS):
+    """
+    :param df: raw rows with the Id column, it is not modified
+    :param statistics: see fit_corrections
+    :return: the corrected rows (df itself if nothing changed) and the number of rows corrected by every rule
+    """
+    corrected, counts = df, {}
+
+    def _set(column, mask, values, rule):
+        nonlocal corrected
+        counts[rule] = int(mask.sum())
+        if counts[rule]:
+            corrected = corrected.copy() if corrected is df else corrected
+            corrected[column] = corrected[column].mask(mask, values)
+
+    if 'Id' in df:
+        for column, values in id_correction_values(statistics, id_rules).items():
+            if column in df:
+                joined = df['Id'].map(values)
+                _set(column, joined.notna(), joined, 'Id -> {}'.format(column))
+    for column, comparison, other, offset, value in predicate_rules:
+        if column in df and other in df and value in df:
+            mask = COMPARISONS[comparison](corrected[column], corrected[other] + offset)
+            _set(column, mask, corrected[value], '{} {} {} + {}'.format(column, comparison, other, offset))
+    return corrected, pd.Series(counts, name='corrected', dtype=np.int64)
@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.model_selection import KFold
+from sklearn.pipeline import Pipeline
+
+# %% ~~~~~ WIDTH REDUCTION ~~~~~
+# Fitted on the training rows only, then applied to any rows:
+# - the categories with less than MIN_CATEGORY_COUNT training rows are pooled into RARE_CATEGORY before the one hot
+#   encoding, so they do not become a column each (the unseen categories of new rows are pooled as well);
+# - the columns whose most frequent value covers at least NEAR_CONSTANT_FREQUENCY of the training rows are dropped.
+MIN_CATEGORY_COUNT = 10
+RARE_CATEGORY = 'Other'
+NEAR_CONSTANT_FREQUENCY = 0.995
+
+
+def fit_rare_categories(df, columns, min_count=MIN_CATEGORY_COUNT):
+    """
+    :return: dict column -> list of the categories kept
+    """
+    kept = {}
+    for x in columns:
+        counts = df[x].value_counts()
+        kept[x] = list(counts.index[counts >= min_count])
+    return kept
+
+
+def pool_rare_categories(df, kept_categories, other=RARE_CATEGORY):
+    df = df.copy()
+    for x, categories in kept_categories.items():
+        df[x] = df[x].where(df[x].isin(categories) | df[x].isna(), other)
+    return df
+
+
+def fit_near_constant_columns(df, max_frequency=NEAR_CONSTANT_FREQUENCY):
+    """
+    :return: the columns to drop (the missing values count as a value)
+    """
+    return [x for x in df.columns if df[x].value_counts(normalize=True, dropna=False).iloc[0] >= max_frequency]
+
+
+def width_report(n_categories, n_pooled, n_encoded, n_dropped, n_columns):
+    """
+    :return: the summary of the reduction, e.g. for the logs
+    """
+    return ("One hot encoding of {} categories ({} pooled into '{}'): {} columns\n"
+            "Near constant columns dropped: {}, width: {}".format(n_categories, n_pooled, RARE_CATEGORY, n_encoded,
+                                                                  n_dropped, n_columns))
+
+
+# %% ~~~~~ CATEGORY ENCODINGS ~~~~~
+# Alternatives to the one hot encoding for the columns with many categories (its width grows with them), chosen per
+# column in columns_encoding of FeaturesEngineering.py, the columns not listed there are one hot encoded:
+# - 'frequency': the share of the training rows with the category (0 for the unseen ones);
+# - 'target': the category becomes an integer code column (with TARGET_CODE_SUFFIX). The TargetEncoder step of every
+#   member replaces the codes with the smoothed mean of the target of each category, fitted on the rows the member is
+#   fitted on (inside every CV fold) and out of fold on those rows, so it never sees the target of the rows it encodes.
+ENCODINGS = ('ohe', 'frequency', 'target')
+FREQUENCY_SUFFIX = '_Frequency'
+TARGET_CODE_SUFFIX = '_TargetCode'
+TARGET_ENCODING_FOLDS = 5
+# Weight (in rows) of the global mean in the mean of each category
+TARGET_ENCODING_SMOOTHING = 20
+
+
+def fit_category_encodings(df, columns_encoding):
+    """
+    :param columns_encoding: dict column -> one of ENCODINGS
+    :return: dict column -> (encoding, mapping of the categories), for the columns not one hot encoded
+    """
+    encodings = {}
+    for x, encoding in columns_encoding.items():
+        assert encoding in ENCODINGS, "Unknown encoding {} of {}".format(encoding, x)
+        if encoding == 'frequency':
+            encodings[x] = (encoding, df[x].value_counts(normalize=True).to_dict())
+        elif encoding == 'target':
+            encodings[x] = (encoding, {category: i for i, category in enumerate(sorted(df[x].dropna().unique()))})
+    return encodings
+
+
+def encode_categories(df, category_encodings):
+    """
+    Replaces each encoded column with its frequency or its code (-1 for the unseen categories).
+    """
+    df = df.copy()
+    for x, (encoding, mapping) in category_encodings.items():
+        if encoding == 'frequency':
+            df[x + FREQUENCY_SUFFIX] = df[x].map(mapping).fillna(0.0).astype(np.float64)
+        else:
+            df[x + TARGET_CODE_SUFFIX] = df[x].map(mapping).fillna(-1).astype(np.int64)
+    return df.drop(columns=list(category_encodings))
+
+
+def target_code_columns(x):
+    """
+    :return: the positions of the target code columns of a DataFrame (none for an array)
+    """
+    return [i for i, column in enumerate(getattr(x, 'columns', [])) if str(column).endswith(TARGET_CODE_SUFFIX)]
+
+
+def _smoothed_means(codes, y, smoothing):
+    stats = pd.DataFrame({'code': codes, 'y': y}).groupby('code')['y'].agg(['sum', 'count'])
+    prior = float(np.mean(y))
+    return ((stats['sum'] + smoothing * prior) / (stats['count'] + smoothing)).to_dict(), prior
+
+
+class TargetEncoder(BaseEstimator, TransformerMixin):
+    """
+    Replaces the code columns (by position) with the smoothed means of the target. fit_transform returns the out of
+    fold encoding of the fitted rows, transform the encoding fitted on all of them (the prior for unseen codes).
+    """
+
+    def __init__(self, columns=(), n_splits=TARGET_ENCODING_FOLDS, smoothing=TARGET_ENCODING_SMOOTHING,
+                 random_state=None):
+        self.columns = columns
+        self.n_splits = n_splits
+        self.smoothing = smoothing
+        self.random_state = random_state
+
+    def fit(self, x, y):
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        self.means_ = [_smoothed_means(x[:, i], y, self.smoothing) for i in self.columns]
+        return self
+
+    def _encode(self, x, means):
+        x = np.array(x, dtype=np.float64)
+        for i, (mapping, prior) in zip(self.columns, means):
+            x[:, i] = pd.Series(x[:, i]).map(mapping).fillna(prior).values
+        return x
+
+    def transform(self, x):
+        return self._encode(x, self.means_)
+
+    def fit_transform(self, x, y=None, **fit_params):
+        self.fit(x, y)
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        encoded = np.array(x)
+        folds = KFold(n_splits=self.n_splits, shuffle=True, random_state=self.random_state)
+        for train_index, val_index in folds.split(x):
+            means = [_smoothed_means(x[train_index, i], y[train_index], self.smoothing) for i in self.columns]
+            encoded[val_index] = self._encode(x[val_index], means)
+        return encoded
+
+
+def add_target_encoder(pipelines, columns, random_state=None):
+    """
+    :return: the pipelines with a TargetEncoder of the given columns as first step (unchanged without columns)
+    """
+    if not columns:
+        return pipelines
+    return [Pipeline([('targetencoder', TargetEncoder(list(columns), random_state=random_state))] + pipeline.steps)
+            for pipeline in pipelines]
@@ -0,0 +1,120 @@
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t
+from sklearn.metrics import mean_squared_log_error
+from sklearn.model_selection import RepeatedKFold
+
+from RegressionFunctions import RANDOM_STATE
+
+# %% ~~~~~ PAIRED EVALUATION ~~~~~
+# Every configuration is scored on the same seeded repeated K-fold plan, so the comparison uses the paired differences
+# of the errors on each fold: most of the noise of a split (which rows end up in validation) cancels out.
+# The folds are evaluated one after the other and the evaluation stops as soon as every configuration is clearly
+# better or worse than the baseline (the confidence interval of the mean difference excludes 0). The intervals are only
+# looked at after a whole repeat, and every look uses the confidence corrected for the number of looks of the plan
+# (Bonferroni), so that stopping at any of them is wrong at most 1 - EVAL_CONFIDENCE of the times.
+EVAL_FOLDS = 5
+# Maximum number of repeats, each one with a different shuffle
+EVAL_REPEATS = 4
+EVAL_MIN_FOLDS = 5
+EVAL_CONFIDENCE = 0.95
+
+
+def evaluation_plan(x, n_splits=EVAL_FOLDS, n_repeats=EVAL_REPEATS, random_state=RANDOM_STATE):
+    """
+    :return: list of (train_index, val_index), the folds of each repeat one after the other
+    """
+    return list(RepeatedKFold(n_splits=n_splits, n_repeats=n_repeats, random_state=random_state).split(x))
+
+
+def paired_interval(deltas, confidence=EVAL_CONFIDENCE):
+    """
+    :return: mean of the paired differences and its t confidence interval
+    """
+    deltas = np.asarray(deltas, dtype=np.float64)
+    if len(deltas) < 2:
+        return deltas.mean(), -np.inf, np.inf
+    half_width = t.ppf((1 + confidence) / 2, len(deltas) - 1) * deltas.std(ddof=1) / np.sqrt(len(deltas))
+    return deltas.mean(), deltas.mean() - half_width, deltas.mean() + half_width
+
+
+def sequential_looks(n_folds, repeat_folds=EVAL_FOLDS, min_folds=EVAL_MIN_FOLDS):
+    """
+    :return: the numbers of evaluated folds after which the intervals are looked at, the end of every repeat
+    """
+    return [i for i in range(repeat_folds, n_folds + 1, repeat_folds) if i >= min_folds]
+
+
+def corrected_confidence(n_looks, confidence=EVAL_CONFIDENCE):
+    """
+    :return: the confidence of every look (Bonferroni), the whole sequence is wrong at most 1 - confidence of the times
+    """
+    return 1 - (1 - confidence) / max(1, n_looks)
+
+
+def is_decided(errors, baseline, confidence=EVAL_CONFIDENCE):
+    return all(not (low <= 0 <= high)
+               for name, (_, low, high) in ((name, paired_interval(np.subtract(errors[name], errors[baseline]),
+                                                                   confidence))
+                                            for name in errors if name != baseline))
+
+
+def evaluate_configs(x_train, y_train, configs, baseline=None, plan=None, min_folds=EVAL_MIN_FOLDS,
+                     confidence=EVAL_CONFIDENCE, store=None, features=None, repeat_folds=EVAL_FOLDS):
+    """
+    :param configs: dict name -> function with the signature of fit_predict (e.g. a partial of it)
+    :param baseline: name of the configuration the others are compared with, the first one by default
+    :param plan: the folds, evaluation_plan by default
+    :param store: ExperimentStore, the folds already evaluated for a configuration are read from it instead of fitted
+    :param features: the features config recorded in the store
+    :param repeat_folds: folds of every repeat of the plan, the evaluation can only stop at the end of a repeat
+    :return: table with the mean error of each configuration on the evaluated folds and its paired difference with
+             the baseline (negative when better) with its interval at the corrected confidence (attrs['confidence']),
+             the number of fits in attrs['fits'] and the experiment keys in attrs['keys']
+    """
+    baseline = list(configs)[0] if baseline is None else baseline
+    plan = evaluation_plan(x_train) if plan is None else plan
+    looks = sequential_looks(len(plan), repeat_folds, min_folds)
+    confidence = corrected_confidence(len(looks), confidence)
+    x_train, y_train = x_train.reset_index(drop=True), np.asarray(y_train, dtype=np.float64)
+
+    keys = {name: store.register(name, fit_predict_function, x_train, y_train, features, plan)
+            for name, fit_predict_function in configs.items()} if store is not None else {}
+    stored = {name: store.folds(key) for name, key in keys.items()}
+    errors = {name: [] for name in configs}
+    fits = {name: 0 for name in configs}
+    start = time.time()
+    for i, (train_index, val_index) in enumerate(plan):
+        for name, fit_predict_function in configs.items():
+            if i in stored.get(name, {}):
+                errors[name].append(stored[name][i])
+                continue
+            timings = {}
+            predictions = fit_predict_function(x_train.iloc[train_index], y_train[train_index],
+                                               x_train.iloc[val_index], timings=timings)
+            errors[name].append(np.sqrt(mean_squared_log_error(y_train[val_index], predictions)))
+            fits[name] += 1
+            if store is not None:
+                store.add_fold(keys[name], i, errors[name][-1], timings)
+        print("Fold {}/{}: {}".format(i + 1, len(plan), {name: round(x[-1], 5) for name, x in errors.items()}))
+        if i + 1 in looks and len(configs) > 1 and is_decided(errors, baseline, confidence):
+            break
+    for name, key in keys.items():
+        store.add_run(key, 'validation', fits[name], {'seconds': time.time() - start})
+
+    rows = []
+    for name in configs:
+        delta, low, high = paired_interval(np.subtract(errors[name], errors[baseline]), confidence)
+        rows.append({'config': name, 'folds': len(errors[name]), 'error': np.mean(errors[name]),
+                     'std': np.std(errors[name], ddof=1) if len(errors[name]) > 1 else np.nan,
+                     'delta': np.nan if name == baseline else delta,
+                     'ci_low': np.nan if name == baseline else low,
+                     'ci_high': np.nan if name == baseline else high})
+    table = pd.DataFrame(rows, columns=['config', 'folds', 'error', 'std', 'delta', 'ci_low', 'ci_high'])
+    table.attrs['fits'] = sum(fits.values())
+    table.attrs['keys'] = keys
+    table.attrs['baseline'] = baseline
+    table.attrs['confidence'] = confidence
+    return table
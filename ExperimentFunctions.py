@@ -0,0 +1,128 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+from functools import partial
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from CheckpointFunctions import fingerprint
+from FeatureStoreFunctions import function_fingerprint
+from RegressionFunctions import load_tuned_config
+from constants import *
+
+# %% ~~~~~ EXPERIMENT STORE ~~~~~
+# Every evaluated configuration is recorded in a SQLite file: the features config, the description of the model (the
+# arguments of the fit_predict partial, the tuned hyperparameters and the fingerprint of its code, which covers the
+# constants it reads, e.g. BLEND_WEIGHTS), the fingerprint of the data, the error and the stage timings of every fold.
+# The key of an experiment hashes all of them with the fold plan: the evaluation of a configuration already tried reads
+# its folds instead of fitting them, and an evaluation that stopped early is resumed from the last stored fold.
+EXPERIMENTS_DB = Path(predictions_dir, 'experiments.sqlite')
+# Seconds a writer waits for the lock of the file (e.g. held by another evaluation)
+EXPERIMENTS_TIMEOUT = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS experiments (
+    key TEXT PRIMARY KEY, name TEXT, features TEXT, model TEXT, data TEXT, plan TEXT, created_at REAL);
+CREATE TABLE IF NOT EXISTS folds (
+    key TEXT, fold INTEGER, error REAL, timings TEXT, created_at REAL, PRIMARY KEY (key, fold));
+CREATE TABLE IF NOT EXISTS runs (
+    key TEXT, kind TEXT, fits INTEGER, timings TEXT, created_at REAL);
+CREATE INDEX IF NOT EXISTS runs_key ON runs (key);
+"""
+
+
+def _json(value):
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def describe_model(fit_predict_function):
+    """
+    :param fit_predict_function: fit_predict or a partial of it
+    :return: JSON-able description of what the function fits
+    """
+    args, keywords = (), {}
+    if isinstance(fit_predict_function, partial):
+        args, keywords = fit_predict_function.args, fit_predict_function.keywords
+        fit_predict_function = fit_predict_function.func
+    return {'function': fit_predict_function.__name__, 'args': list(args), 'keywords': keywords,
+            'tuned': load_tuned_config(), 'code': function_fingerprint(fit_predict_function)}
+
+
+def plan_fingerprint(plan):
+    return joblib.hash([val_index for _, val_index in plan]) if plan is not None else None
+
+
+class ExperimentStore:
+
+    def __init__(self, path=EXPERIMENTS_DB, timeout=EXPERIMENTS_TIMEOUT):
+        self.path = Path(path)
+        self.timeout = timeout
+        os.makedirs(self.path.parent, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(str(self.path), timeout=self.timeout)
+
+    def register(self, name, fit_predict_function, x, y, features=None, plan=None):
+        """
+        :param features: the features config (see get_features_config), recorded for the queries
+        :return: the key of the experiment, the same for an identical configuration, data and plan
+        """
+        model, data = describe_model(fit_predict_function), [fingerprint(x), fingerprint(y)]
+        key = joblib.hash([_json(features), _json(model), data, plan_fingerprint(plan)])
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR IGNORE INTO experiments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (key, name, _json(features), _json(model), _json(data), plan_fingerprint(plan), time.time()))
+        return key
+
+    def folds(self, key):
+        """
+        :return: dict fold -> error of the stored folds of an experiment
+        """
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT fold, error FROM folds WHERE key = ?", (key,)).fetchall())
+
+    def add_fold(self, key, fold, error, timings=None):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO folds VALUES (?, ?, ?, ?, ?)",
+                         (key, fold, float(error), _json(timings or {}), time.time()))
+
+    def add_run(self, key, kind, fits, timings=None):
+        """
+        :param kind: e.g. 'validation' or 'predictions'
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?)", (key, kind, fits, _json(timings or {}),
+                                                                    time.time()))
+
+    def best_configs(self, n=10, min_folds=1):
+        """
+        :return: table of the n experiments with the lowest mean error on at least min_folds folds (the errors on
+                 different plans or data are not comparable, see the plan and data columns)
+        """
+        query = """
+            SELECT e.name, e.key, e.plan, e.data, COUNT(f.fold) AS folds, AVG(f.error) AS error,
+                   AVG(f.error * f.error) - AVG(f.error) * AVG(f.error) AS variance, e.model, e.features
+            FROM experiments e JOIN folds f ON f.key = e.key
+            GROUP BY e.key HAVING COUNT(f.fold) >= ? ORDER BY error LIMIT ?"""
+        with closing(self._connect()) as conn:
+            table = pd.read_sql_query(query, conn, params=(min_folds, n))
+        # Standard deviation with ddof=1, as in evaluate_configs
+        variance = table.pop('variance').clip(lower=0) * table['folds'] / (table['folds'] - 1)
+        table.insert(table.columns.get_loc('error') + 1, 'std', np.sqrt(variance.where(table['folds'] > 1)))
+        return table
+
+    def fold_timings(self, key):
+        """
+        :return: table of the error and the stage timings (seconds) of every stored fold of an experiment
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT fold, error, timings FROM folds WHERE key = ? ORDER BY fold",
+                                (key,)).fetchall()
+        return pd.DataFrame([dict(fold=fold, error=error, **json.loads(timings)) for fold, error, timings in rows])
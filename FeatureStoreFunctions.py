@@ -0,0 +1,105 @@
+import os
+import types
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import joblib
+import pandas as pd
+
+
+# %% ~~~~~ FEATURE STORE ~~~~~
+def function_fingerprint(function):
+    """
+    Hash of what a feature function computes: its code, the values captured in its closure (e.g. the mapping of an
+    encoding) and the data constants it reads from its module (e.g. good_neighborhoods), recursively for the nested
+    functions. Editing a mapping in constants.py changes the fingerprint of the features that use it.
+    """
+    code = function.__code__
+    closure = [cell.cell_contents for cell in function.__closure__ or []]
+    constants = {name: function.__globals__[name] for name in code.co_names
+                 if isinstance(function.__globals__.get(name), (dict, list, tuple, set, str, int, float, range))}
+    parts = [code.co_code, [x for x in code.co_consts if not isinstance(x, types.CodeType)],
+             [function_fingerprint(x) if isinstance(x, types.FunctionType) else x for x in closure],
+             constants,
+             [function_fingerprint(x) for x in function.__globals__.values()
+              if isinstance(x, types.FunctionType) and x.__name__ in code.co_names and x is not function]]
+    return joblib.hash(parts)
+
+
+class FeatureStore:
+    """
+    Derived columns cached one by one on disk.
+    Each feature declares its input columns, so every feature is a node that depends on the last previous feature
+    with the same name of each input (e.g. ExterQualCond on the encoded ExterQual), or on the raw column.
+    The key of a node is the hash of its function and of the keys of its inputs (the raw columns are hashed by value):
+    only the nodes downstream of a change are recomputed, the independent ones in parallel, the others are loaded.
+    """
+
+    def __init__(self, features, directory, n_jobs=None):
+        """
+        :param features: list of (column, input columns, function of a frame with the input columns)
+        """
+        self.features = features
+        self.directory = directory
+        self.n_jobs = n_jobs
+        self.computed = []
+        self.cached = []
+
+    def plan(self, df):
+        """
+        :return: for each feature, its key, the (producer, column) of its inputs (producer is None for the raw
+                 columns) and its level (the features of the same level are independent)
+        """
+        producers, raw_keys, nodes = {}, {}, []
+        for i, (column, inputs, function) in enumerate(self.features):
+            sources, input_keys, level = [], [], 0
+            for x in inputs:
+                if x in producers:
+                    sources.append((producers[x], x))
+                    input_keys.append(nodes[producers[x]]['key'])
+                    level = max(level, nodes[producers[x]]['level'] + 1)
+                else:
+                    if x not in raw_keys:
+                        raw_keys[x] = joblib.hash(df[x])
+                    sources.append((None, x))
+                    input_keys.append(raw_keys[x])
+            key = joblib.hash([column, function_fingerprint(function), input_keys])
+            nodes.append({'column': column, 'key': key, 'sources': sources, 'level': level})
+            producers[column] = i
+        return nodes
+
+    def _path(self, node):
+        return Path(self.directory, '{}-{}.pkl'.format(node['column'], node['key']))
+
+    def _build_node(self, df, outputs, i, node):
+        path = self._path(node)
+        if path.exists():
+            return i, pd.read_pickle(path), False
+
+        frame = pd.DataFrame({x: df[x] if producer is None else outputs[producer] for producer, x in node['sources']},
+                             index=df.index)
+        values = self.features[i][2](frame)
+        values.to_pickle(path)
+        return i, values, True
+
+    def build(self, df):
+        """
+        Adds the derived columns to the frame, same result of assigning them one after the other.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        nodes = self.plan(df)
+        outputs = {}
+        self.computed, self.cached = [], []
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            for level in sorted(set(node['level'] for node in nodes)):
+                tasks = [executor.submit(self._build_node, df, outputs, i, node)
+                         for i, node in enumerate(nodes) if node['level'] == level]
+                for task in tasks:
+                    i, values, computed = task.result()
+                    outputs[i] = values
+                    (self.computed if computed else self.cached).append(nodes[i]['column'])
+
+        for i, node in enumerate(nodes):
+            df[node['column']] = outputs[i]
+        return df
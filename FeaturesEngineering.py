@@ -2,7 +2,12 @@ from pathlib import Path
 
 from sklearn.impute import SimpleImputer
 
+from CorrectionFunctions import apply_corrections, fit_corrections
+from EncodingFunctions import encode_categories, fit_category_encodings, fit_near_constant_columns, \
+    fit_rare_categories, pool_rare_categories, width_report
 from FeaturesFunctions import *
+from MemoryFunctions import memory_budget
+from OutlierFunctions import OutlierFilter
 from constants import *
 
 # %% ~~~~~ GLOBAL SETTINGS ~~~~~
@@ -13,33 +18,36 @@ pd.set_option('display.max_rows', 100)
 pd.set_option('display.float_format', lambda x: '{:.3f}'.format(x))
 
 # %% ~~~~~ CONSTANTS ~~~~~
-NONE_VALUE = 'None'
-
 columns_to_drop = []
 columns_to_drop_to_avoid_overfit = []
 
 columns_to_ohe = []
+# Encoding of the columns_to_ohe with many categories: 'frequency' or 'target' (see EncodingFunctions), the columns
+# not listed here are one hot encoded. E.g. {'Neighborhood': 'target', 'Exterior1st': 'frequency'}
+columns_encoding = {}
 numeric_columns = []
 boolean_columns = []
 drop_by_correlation = []
 drop_test = []
 
-# %% ~~~~~ COMMON MAPPINGS ~~~~~
-qualities_dict = {NONE_VALUE: 0, 'Po': 1, 'Fa': 2, 'TA': 3, 'Gd': 4, 'Ex': 5}
-fin_qualities_dict = {NONE_VALUE: 0, "Unf": 1, "LwQ": 2, "Rec": 3, "BLQ": 4, "ALQ": 5, "GLQ": 6}
-
 # %% ~~~~~ Train & test loading ~~~~~
 train_df = pd.read_csv(Path(dataset_dir, 'train.csv'))
 test_df = pd.read_csv(Path(dataset_dir, 'test.csv'))
 
 # %% ~~~~~ Removing outliers ~~~~~
-# As suggested by many participants, we remove several outliers
-# %% Dropping outliers
-out = [30, 88, 462, 631, 1322]
-train_df = train_df.drop(train_df.index[out])
-train_df.drop(train_df[(train_df['OverallQual'] < 5) & (train_df['SalePrice'] > 200000)].index, inplace=True)
-train_df.drop(train_df[(train_df['GrLivArea'] > 4000) & (train_df['SalePrice'] < 300000)].index, inplace=True)
+# The sales far from the price of the similar houses, with the fences fitted on the training sales (see OutlierFunctions)
+outliers = OutlierFilter().fit(train_df)
+train_df, dropped_outliers = outliers.filter(train_df)
 train_df.reset_index(drop=True, inplace=True)
+print("Outliers dropped: {}\n{}".format(dropped_outliers.shape[0],
+                                        dropped_outliers[['Id', 'reason']].to_string(index=False)))
+
+# %% ~~~~~ Data corrections ~~~~~
+# Typos and inconsistencies, by Id and by rule (see CorrectionFunctions), the statistics fitted on train and test
+corrections = fit_corrections([train_df, test_df])
+train_df, train_corrected = apply_corrections(train_df, corrections)
+test_df, test_corrected = apply_corrections(test_df, corrections)
+print("Corrected rows:\n{}".format(train_corrected.add(test_corrected, fill_value=0).astype(int).to_string()))
 
 # %% ~~~~~ Log Sale Price ~~~~~
 y_train = train_df['SalePrice']
@@ -55,6 +63,11 @@ test_df = test_df.drop(columns=['Id'])
 train_len = train_df.shape[0]
 test_len = test_df.shape[0]
 complete_df = pd.concat([train_df, test_df]).reset_index(drop=True)
+# Only the names of the raw columns are needed from here on
+raw_columns = list(train_df.columns)
+del train_df, test_df
+# Resident memory of every stage, against the budget of HOUSE_PRICES_MEMORY (see MemoryFunctions)
+memory_budget().mark('features: load')
 assert complete_df.shape[0] == train_len + test_len
 
 # %% MSZoning: Identifies the general zoning classification of the sale.
@@ -253,8 +266,7 @@ drop_test.append('LandSlope')
 #
 # -> According to other partecipants, the good neighborhoods are: 'NridgHt','Crawfor','StoneBr','Somerst','NoRidge'.
 # -> Let's create a new boolean feature representing the belonging to one of these good neighborhoods.
-complete_df['IsGoodNeighborhood'] = np.array([x in ('NridgHt', 'Crawfor', 'StoneBr', 'Somerst', 'NoRidge')
-                                              for x in complete_df['Neighborhood']]) * 1
+complete_df['IsGoodNeighborhood'] = np.array([x in good_neighborhoods for x in complete_df['Neighborhood']]) * 1
 boolean_columns.append('IsGoodNeighborhood')
 # Not removing,  score increases from 0.11323 to 0.11389
 
@@ -356,9 +368,7 @@ columns_to_ohe.append('BldgType')
 # boolean_columns.append('HouseStyle_15st')
 
 complete_df['HouseStyle_int'] = complete_df['HouseStyle']
-complete_df = ints_encoding(complete_df, 'HouseStyle_int',
-                            {'1.5Unf': 0, 'SFoyer': 1, '1.5Fin': 2, '2.5Unf': 3, 'SLvl': 4, '1Story': 5, '2Story': 6,
-                             '2.5Fin': 7})
+complete_df = ints_encoding(complete_df, 'HouseStyle_int', house_style_dict)
 numeric_columns.append('HouseStyle_int')
 # Do not remove, score increases from 0.11323 to 0.11365
 
@@ -384,7 +394,7 @@ columns_to_drop_to_avoid_overfit.append('HouseStyle_2.5Fin')
 #
 # -> The distribution of these values shows that they can be grouped into 3 bins, meaning: bad - average - good
 # -> Counter({5: 825, 6: 731, 7: 600, 8: 342, 4: 225, 9: 107, 3: 40, 10: 29, 2: 13, 1: 4})
-bins_overall_qual = {range(1, 4): 1, range(4, 7): 2, range(7, 11): 3}
+bins_overall_qual = bins_overall
 
 
 def overall_qual_simplify(row):
@@ -418,7 +428,7 @@ numeric_columns.append('OverallQual')
 #
 # -> The distribution of these values shows that they can be grouped into 3 bins, meaning: bad - average - good
 # -> Counter({5: 1643, 6: 530, 7: 390, 8: 144, 4: 101, 3: 50, 9: 41, 2: 10, 1: 7})
-bins_overall_cond = {range(1, 4): 1, range(4, 7): 2, range(7, 11): 3}
+bins_overall_cond = bins_overall
 
 
 def overall_cond_simplify(row):
@@ -579,14 +589,9 @@ columns_to_ohe.append('RoofMatl')
 # -> We can merge these two features after the first OHE,
 # -> keeping in mind that we must assign 1 to the 2nd relevant column.
 # -> There is also a misspell of some value 'CmentBd', 'Wd Shng' and 'Brk Cmn'
-complete_df['Exterior1st'] = complete_df['Exterior1st'].replace(to_replace='CmentBd', value='CemntBd')
-complete_df['Exterior2nd'] = complete_df['Exterior2nd'].replace(to_replace='CmentBd', value='CemntBd')
-
-complete_df['Exterior1st'] = complete_df['Exterior1st'].replace(to_replace='Wd Shng', value='Wd Sdng')
-complete_df['Exterior2nd'] = complete_df['Exterior2nd'].replace(to_replace='Wd Shng', value='Wd Sdng')
-
-complete_df['Exterior1st'] = complete_df['Exterior1st'].replace(to_replace='Brk Cmn', value='BrkComm')
-complete_df['Exterior2nd'] = complete_df['Exterior2nd'].replace(to_replace='Brk Cmn', value='BrkComm')
+for typo, value in exterior_typos_dict.items():
+    complete_df['Exterior1st'] = complete_df['Exterior1st'].replace(to_replace=typo, value=value)
+    complete_df['Exterior2nd'] = complete_df['Exterior2nd'].replace(to_replace=typo, value=value)
 
 columns_to_ohe.append('Exterior1st')
 # Dot not removing, score increase from 0.11325 to 0.11391
@@ -638,7 +643,7 @@ numeric_columns.append('MasVnrArea')
 # Do not drop, score increase from 0.11325 to 0.11337
 
 complete_df['MasVnrType_int'] = complete_df['MasVnrType']
-complete_df = ints_encoding(complete_df, 'MasVnrType_int', {NONE_VALUE: 0, 'Stone': 1, 'BrkFace': 2, 'BrkCmn': 3})
+complete_df = ints_encoding(complete_df, 'MasVnrType_int', mas_vnr_type_dict)
 columns_to_ohe.append('MasVnrType')
 # Do not drop, score increase from 0.11325 to 0.11328
 
@@ -682,8 +687,7 @@ complete_df['ExterQualCond'] = (complete_df['ExterQual'] + complete_df['ExterCon
 # Counter({'PConc': 1306, 'CBlock': 1234, 'BrkTil': 311, 'Slab': 49, 'Stone': 11, 'Wood': 5})
 
 complete_df['Foundation_int'] = complete_df['Foundation']
-complete_df = ints_encoding(complete_df, 'Foundation_int',
-                            {'BrkTil': 5, 'CBlock': 4, 'PConc': 3, 'Slab': 2, 'Stone': 1, 'Wood': 0})
+complete_df = ints_encoding(complete_df, 'Foundation_int', foundation_dict)
 numeric_columns.append('Foundation_int')
 # Not removing, score increases from 0.11313 to 0.11348
 
@@ -696,15 +700,7 @@ drop_by_correlation.append('Foundation')
 
 
 # %% ~~~~~ Remove inconsistencies from Bsmt columns ~~~~~
-complete_df.loc[332, 'BsmtFinType2'] = 'ALQ'
-complete_df.loc[947, 'BsmtExposure'] = 'No'
-complete_df.loc[1485, 'BsmtExposure'] = 'No'
-complete_df.loc[2038, 'BsmtCond'] = 'TA'
-complete_df.loc[2183, 'BsmtCond'] = 'TA'
-complete_df.loc[2215, 'BsmtQual'] = 'Po'
-complete_df.loc[2216, 'BsmtQual'] = 'Fa'
-complete_df.loc[2346, 'BsmtExposure'] = 'No'
-complete_df.loc[2522, 'BsmtCond'] = 'Gd'
+# Corrected by Id at the load, see CorrectionFunctions.ID_CORRECTIONS
 
 # %% BsmtQual: Evaluates the height of the basement
 #
@@ -749,7 +745,7 @@ numeric_columns.append('BsmtQualCond')
 #        NA   No Basement
 #
 # -> TODO Gestisci differenza fra No e NA (?)
-complete_df = ints_encoding(complete_df, 'BsmtExposure', {NONE_VALUE: 0, 'No': 0, 'Mn': 2, 'Av': 3, 'Gd': 4})
+complete_df = ints_encoding(complete_df, 'BsmtExposure', bsmt_exposure_dict)
 numeric_columns.append('BsmtExposure')
 # Not removing, score increases from 0.11313 to 0.11428
 # ok!
@@ -1023,9 +1019,7 @@ numeric_columns.append('TotRmsAbvGrd')
 # -> Counter({'Typ': 2715, 'Min2': 70, 'Min1': 64, 'Mod': 35, 'Maj1': 19, 'Maj2': 9, 'Sev': 2, nan: 2})
 # -> Let's assume that the NaN values here are 'Typ' (that also stands for 'typical'!)
 complete_df['Functional_int'] = complete_df['Functional']
-complete_df = ints_encoding(complete_df, 'Functional_int',
-                            {NONE_VALUE: 0, 'Sal': 1, 'Sev': 2, 'Maj2': 3, 'Maj1': 4, 'Mod': 5, 'Min2': 6, 'Min1': 7,
-                             'Typ': 8})
+complete_df = ints_encoding(complete_df, 'Functional_int', functional_dict)
 
 numeric_columns.append('Functional_int')
 # Not removing, score increases from  0.11271 to  0.11343
@@ -1082,10 +1076,7 @@ numeric_columns.append('FireplaceQu')
 columns_to_ohe.append('GarageType')
 # ok!
 
-complete_df.loc[2574, 'GarageCars'] = complete_df['GarageCars'].median()
-complete_df.loc[2124, 'GarageArea'] = complete_df['GarageArea'].median()
-complete_df.loc[2574, 'GarageArea'] = complete_df['GarageArea'].median()
-complete_df.loc[2590, 'GarageYrBlt'] = 2007
+# The garages without size and the ones built after the sale are corrected at the load, see CorrectionFunctions
 
 
 # %% GarageYrBlt: Year garage was built
@@ -1113,7 +1104,7 @@ boolean_columns.append('GarageIsPresent')
 # complete_df.loc[2574, 'GarageFinish'] = complete_df['GarageFinish'].mode()[0]
 # complete_df["GarageFinish"] = complete_df["GarageFinish"]
 # print('GarageFinish', Counter(complete_df["GarageFinish"]))
-complete_df = ints_encoding(complete_df, 'GarageFinish', {NONE_VALUE: 0, "Unf": 1, "RFn": 2, "Fin": 3})
+complete_df = ints_encoding(complete_df, 'GarageFinish', garage_finish_dict)
 numeric_columns.append('GarageFinish')
 # ok!
 
@@ -1262,7 +1253,7 @@ drop_by_correlation.append('PoolQC')
 numeric_columns.append('PoolArea')
 numeric_columns.append('PoolQC')
 
-complete_df = ints_encoding(complete_df, 'PoolQC', {NONE_VALUE: 0, 'Fa': 1, 'TA': 2, 'Gd': 3, 'Ex': 4})
+complete_df = ints_encoding(complete_df, 'PoolQC', pool_qualities_dict)
 
 complete_df['PoolIsPresent'] = (complete_df['PoolArea'] > 0) * 1
 boolean_columns.append('PoolIsPresent')
@@ -1280,7 +1271,7 @@ boolean_columns.append('PoolIsPresent')
 # -> This is a categorical feature, but with order! (higher value means better fence)
 # -> Counter({nan: 2345, 'MnPrv': 329, 'GdPrv': 118, 'GdWo': 112, 'MnWw': 12})
 # -> Let's map the NaN values to NONE_VALUE which will then be mapped to a 0 quality.
-complete_df = ints_encoding(complete_df, 'Fence', {NONE_VALUE: 0, 'MnWw': 1, 'GdWo': 2, 'MnPrv': 3, 'GdPrv': 4})
+complete_df = ints_encoding(complete_df, 'Fence', fence_dict)
 numeric_columns.append('Fence')
 # ok!
 
@@ -1342,9 +1333,7 @@ numeric_columns.append('MoSold')
 # -> Counter({'WD': 2524, 'New': 237, 'COD': 87, 'ConLD': 26, 'CWD': 12, 'ConLI': 9, 'ConLw': 8, 'Oth': 7,
 # -> 'Con': 5, nan: 1})
 # -> Let's fill the single NaN value to the most common one (WD)
-complete_df = ints_encoding(complete_df, 'SaleType',
-                            {'WD': 9, 'CWD': 8, 'VWD': 7, 'New': 6, 'COD': 5, 'Con': 4, 'ConLw': 3, 'ConLI': 2,
-                             'ConLD': 1, 'Oth': 0})
+complete_df = ints_encoding(complete_df, 'SaleType', sale_type_dict)
 numeric_columns.append('SaleType')
 
 # %% SaleCondition: Condition of sale
@@ -1388,12 +1377,13 @@ numeric_columns = [x for x in numeric_columns if x not in set(columns_to_drop)]
 boolean_columns = [x for x in boolean_columns if x not in set(columns_to_drop)]
 columns_to_ohe = [x for x in columns_to_ohe if x not in set(columns_to_drop)]
 
-backup_df = complete_df.copy()
+# The raw values of the columns read by the new features (see ADD NEW FEATURES)
+backup_df = complete_df[area_columns + ['FullBath', 'HalfBath', 'BsmtFullBath', 'BsmtHalfBath']].copy()
 
 complete_df.drop(columns=columns_to_drop, inplace=True)
 
 # %% ASSERTIONS
-touched_features = set(train_df.keys())
+touched_features = set(raw_columns)
 touched_features = touched_features - set(columns_to_ohe).union(numeric_columns).union(boolean_columns).union(
     columns_to_drop)
 
@@ -1412,14 +1402,28 @@ simple_imputer = SimpleImputer(strategy='most_frequent', verbose=1)
 simple_imputed_df = simple_imputer.fit_transform(simple_imputed_df)
 for_x_in = pd.DataFrame(data=simple_imputed_df, index=complete_df.index, columns=columns_to_ohe)
 complete_df.update(for_x_in)
+del simple_imputed_df, for_x_in
+memory_budget().mark('features: cleaning')
 # Removing this changes nothing (score remains: 0.11355), let's keep it since makes sense
 
-# %% PERFORM ONE HOT ENCODING
+# %% POOL RARE CATEGORIES
 for x in columns_to_ohe:
     assert x in complete_df
     complete_df[x] = complete_df[x].astype(str)
 
-complete_df = pd.get_dummies(complete_df, columns=columns_to_ohe)
+# The categories with few training rows become a single one (see EncodingFunctions)
+rare_categories = fit_rare_categories(complete_df[:train_len], columns_to_ohe)
+n_categories = sum(complete_df[x].nunique() for x in columns_to_ohe)
+complete_df = pool_rare_categories(complete_df, rare_categories)
+n_pooled = n_categories - sum(complete_df[x].nunique() for x in columns_to_ohe)
+
+# %% PERFORM ONE HOT ENCODING
+# Or the frequency/target encoding of the columns in columns_encoding
+columns_encoding = {x: encoding for x, encoding in columns_encoding.items() if x in columns_to_ohe}
+category_encodings = fit_category_encodings(complete_df[:train_len], columns_encoding)
+complete_df = encode_categories(complete_df, category_encodings)
+complete_df = pd.get_dummies(complete_df, columns=[x for x in columns_to_ohe if x not in category_encodings])
+n_encoded = complete_df.shape[1]
 
 # ~~~~~ REMOVE FEATURES TO AVOID OVERFIT~~~
 # Dropping bad features
@@ -1432,10 +1436,19 @@ out = [
 columns_to_drop_to_avoid_overfit.extend(out)
 # Removing this increases the  score from 0.0.11355 to 0.11522
 
-for x in columns_to_drop_to_avoid_overfit:
-    assert x in complete_df, "Trying to drop {}, but it isn't in the df".format(x)
+# The rare categories (e.g. MSSubClass_150) are already pooled
+columns_to_drop_to_avoid_overfit = [x for x in columns_to_drop_to_avoid_overfit if x in complete_df]
 complete_df.drop(columns=columns_to_drop_to_avoid_overfit, inplace=True)
 
+# %% REMOVE NEAR CONSTANT COLUMNS
+# The columns (almost) constant on the training rows, whatever their values on the test rows
+near_constant_columns = fit_near_constant_columns(complete_df[:train_len])
+complete_df.drop(columns=near_constant_columns, inplace=True)
+numeric_columns = [x for x in numeric_columns if x not in set(near_constant_columns)]
+boolean_columns = [x for x in boolean_columns if x not in set(near_constant_columns)]
+print(width_report(n_categories, n_pooled, n_encoded, len(near_constant_columns), complete_df.shape[1]))
+memory_budget().mark('features: encoding')
+
 # print(complete_df.info(verbose=True))
 
 
@@ -1458,10 +1471,7 @@ complete_df = impute(complete_df)
 
 
 # %% TotalArea
-area_cols = ['LotFrontage', 'LotArea', 'MasVnrArea', 'BsmtFinSF1', 'BsmtFinSF2', 'BsmtUnfSF',
-             'TotalBsmtSF', '1stFlrSF', '2ndFlrSF', 'GrLivArea', 'GarageArea', 'WoodDeckSF',
-             'OpenPorchSF', 'EnclosedPorch', '3SsnPorch', 'ScreenPorch', 'LowQualFinSF', 'PoolArea']
-complete_df['TotalArea'] = backup_df[area_cols].sum(axis=1)
+complete_df['TotalArea'] = backup_df[area_columns].sum(axis=1)
 numeric_columns.append('TotalArea')
 # Removing this increases the score from 0.11366 to 0.11400
 
@@ -1476,6 +1486,7 @@ complete_df['Total_Bathrooms'] = (backup_df['FullBath'] + (0.5 * backup_df['Half
                                   backup_df['BsmtFullBath'] + (0.5 * backup_df['BsmtHalfBath']))
 numeric_columns.append('Total_Bathrooms')
 # Removing this increases the score from 0.11366 to 0.11422
+del backup_df
 
 # %% Total_porch_sf
 # complete_df['Total_porch_sf'] = (backup_df['OpenPorchSF'] + backup_df['3SsnPorch'] +
@@ -1498,6 +1509,7 @@ complete_df = impute(complete_df)
 # %% ~~~~~ Resolve skewness ~~~~
 complete_df = resolve_skewness(complete_df, numeric_columns)
 # DO NOT remove: score increases from 0.11423 to 0.11528
+memory_budget().mark('features: imputation and skewness')
 #
 # %% Infos
 # print(complete_df.info(verbose=True))
@@ -1524,3 +1536,15 @@ print("x_train shape: {}\n"
 
 def get_engineered_train_test():
     return (train_ids, x_train, y_train), (test_ids, x_test)
+
+
+def get_features_config():
+    return {
+        'columns_to_ohe': list(columns_to_ohe),
+        'columns_encoding': dict(columns_encoding),
+        'numeric_columns': list(numeric_columns),
+        'boolean_columns': list(boolean_columns),
+        'columns_to_drop': list(columns_to_drop),
+        'columns_to_drop_to_avoid_overfit': list(columns_to_drop_to_avoid_overfit),
+        'columns': list(x_train.columns),
+    }
@@ -1,5 +1,6 @@
 import os
 from collections import Counter
+from pathlib import Path
 from pprint import pprint
 
 import pandas as pd
@@ -8,13 +9,17 @@ import seaborn as sns
 from matplotlib import pyplot as plt
 from fancyimpute import KNN
 
+from ChartFunctions import CHART_DIR, render_confusion_matrix, render_correlation
+
 
 def count(complete_df, feature, blocking=False):
     assert feature in complete_df, '{} not in df'.format(feature)
     print(feature)
-    print("Number of values:", len(Counter(complete_df[feature])))
+    counts = complete_df[feature].value_counts(dropna=False)
+    print("Number of values:", len(counts))
     print('Number of NaN: {}'.format(complete_df[feature].isna().sum()))
-    print(Counter(complete_df[feature]))
+    # See ProfileFunctions for all the columns at once
+    print(counts.to_dict())
     if blocking:
         assert False
 
@@ -135,56 +140,20 @@ def resolve_skewness(complete_df, numeric_features):
 
 def plot_confusion_matrix(filename, data, labels):
     """
-    Plots the confusion matrix using a seaborn heatmap
-    :param classes: labels of the confusion matrix
-    :param confusion_matrix: the confusion of matrix, in a list of list format
+    Plots the confusion matrix using a seaborn heatmap, in the background (see ChartFunctions)
+    :param labels: labels of the confusion matrix
+    :param data: the confusion of matrix, in a list of list format
+    :return: Future of the filename
     """
+    return render_confusion_matrix(filename, data, labels)
 
-    sns.set(style="white")
-
-    cmap = [(0, 1, 0, 1), (1, 1, 1, 1), (1, 1, 1, 1), (1, 1, 1, 1), (1, 1, 1, 1), (1, 1, 1, 1), (1, 1, 1, 1),
-            (0, 0, 0, 1)]
-
-    f, ax = plt.subplots(figsize=(20, 20))
-    annot = data
-    data = np.where(data != 0, np.log(data), 0)
-    heatmap = sns.heatmap(data, xticklabels=labels, cbar=False, yticklabels=labels, cmap=cmap,
-                          square=True, annot=annot, fmt="g", linewidths=1, annot_kws={"size": 11})  # font size
-    heatmap.yaxis.set_ticklabels(heatmap.yaxis.get_ticklabels(), rotation=0, ha='right', fontsize=12)
-    heatmap.xaxis.set_ticklabels(heatmap.xaxis.get_ticklabels(), rotation=45, ha='right', fontsize=12)
-    plt.title("Confusion Matrix")
-    plt.ylabel('True label')
-    plt.xlabel('Predicted label')
-    plt.tight_layout()
-
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    plt.savefig(filename, dpi=500)
-    plt.close(f)
-
-def show_correlation(df):
-    sns.set(style="white")
-
-    corr = df.corr()
-
-    # Generate a mask for the upper triangle
-    mask = np.zeros_like(corr, dtype=np.bool)
-    mask[np.triu_indices_from(mask)] = True
 
-    # Set up the matplotlib figure
-    f, ax = plt.subplots(figsize=(55, 9))
-
-    # Generate a custom diverging colormap
-    cmap = [(0, 1, 0, 1), (1, 1, 1, 1), (1, 1, 1, 1), (1, 1, 1, 1), (1, 1, 1, 1), (1, 1, 1, 1), (1, 1, 1, 1),
-            (0, 0, 0, 1)]
-
-    heatmap = sns.heatmap(corr, xticklabels=df.columns, cbar=False, yticklabels=df.columns, cmap=cmap,
-                          square=True, fmt="g", linewidths=1, annot_kws={"size": 11})  # font size
-    heatmap.yaxis.set_ticklabels(heatmap.yaxis.get_ticklabels(), rotation=0, ha='right', fontsize=12)
-    heatmap.xaxis.set_ticklabels(heatmap.xaxis.get_ticklabels(), rotation=45, ha='right', fontsize=12)
-
-    # Draw the heatmap with the mask and correct aspect ratio
-
-    plt.show()
+def show_correlation(df, filename=Path(CHART_DIR, 'correlation.png')):
+    """
+    Draws the correlation heatmap of the columns into filename, in the background (see ChartFunctions)
+    :return: Future of the filename
+    """
+    return render_correlation(filename, df)
 
 
 def compute_correlation(df):
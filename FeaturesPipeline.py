@@ -0,0 +1,305 @@
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.special import boxcox1p
+from scipy.stats import boxcox_normmax, skew
+from sklearn.impute import KNNImputer
+
+from CorrectionFunctions import apply_corrections, fit_corrections
+from EncodingFunctions import encode_categories, fit_category_encodings, fit_near_constant_columns, \
+    fit_rare_categories, pool_rare_categories
+from FeatureStoreFunctions import FeatureStore
+from SketchFunctions import QuantileSketch
+from constants import *
+
+# %% ~~~~~ FITTED FEATURES TRANSFORM ~~~~~
+# FeaturesEngineering.py fits every statistic (group fills, bins, imputation, skewness) on train + test together,
+# so it cannot be applied to new rows. Here the same feature steps are replayed with the statistics fitted on the
+# training rows only, so that any batch of raw rows (same schema of test.csv) can be transformed independently.
+# The features configuration (columns to ohe/drop, numeric columns) is the one built by FeaturesEngineering.py.
+KNN_NEIGHBORS = 10
+SKEW_THRESHOLD = 0.5
+YEAR_BUILT_BINS = 7
+# Cache the derived columns on disk, keyed by the hash of their inputs and functions (see FeatureStoreFunctions)
+USE_FEATURE_STORE = False
+FEATURE_STORE_DIR = Path(predictions_dir, 'feature_store')
+
+# column -> (grouping column, statistic used to fill the missing values)
+GROUP_FILLS = {
+    'MSZoning': ('MSSubClass', 'mode'),
+    'LotFrontage': ('Neighborhood', 'median'),
+}
+
+
+def _encoding(source, mapping):
+    return lambda df: df[source].map(mapping)
+
+
+def _simplify_overall(source):
+    def _simplify(df):
+        simplified = pd.Series(np.nan, index=df.index)
+        for values, simple_value in bins_overall.items():
+            simplified[df[source].isin(list(values))] = simple_value
+        return simplified
+
+    return _simplify
+
+
+def _merge_conditions(df):
+    # Vectorized FeaturesEngineering.conditions_merge: 'Norm' is ignored, 'Feedr' (otherwise 'Artery') is discarded
+    # from the pairs of two different conditions
+    c1, c2 = df['Condition1'], df['Condition2']
+    condition = np.where(c1 != 'Norm', c1, np.where(c2 != 'Norm', c2, 'Norm'))
+    both = (c1 != 'Norm') & (c2 != 'Norm') & (c1 != c2)
+    discarded = np.where((c1 == 'Feedr') | (c2 == 'Feedr'), 'Feedr', 'Artery')
+    condition = np.where(both, np.where(c1 == discarded, c2, c1), condition)
+    return pd.Series(condition, index=df.index)
+
+
+def _fix_exterior_typos(source):
+    return lambda df: df[source].replace(exterior_typos_dict)
+
+
+# (column, input columns, function of the frame) in the same order of FeaturesEngineering.py
+DERIVED_FEATURES = [
+    ('HasAlley', ['Alley'], lambda df: df['Alley'].notna() * 1),
+    ('IsGoodNeighborhood', ['Neighborhood'], lambda df: df['Neighborhood'].isin(good_neighborhoods) * 1),
+    ('Condition', ['Condition1', 'Condition2'], _merge_conditions),
+    ('HouseStyle_int', ['HouseStyle'], _encoding('HouseStyle', house_style_dict)),
+    ('OverallQualSimplified', ['OverallQual'], _simplify_overall('OverallQual')),
+    ('OverallCondSimplified', ['OverallCond'], _simplify_overall('OverallCond')),
+    ('IsRemodeled', ['YearRemodAdd', 'YearBuilt'], lambda df: (df['YearRemodAdd'] != df['YearBuilt']) * 1),
+    ('IsRemodelRecent', ['YearRemodAdd', 'YrSold'], lambda df: (df['YearRemodAdd'] == df['YrSold']) * 1),
+    ('YearsSinceRemodel', ['YrSold', 'YearRemodAdd'], lambda df: df['YrSold'] - df['YearRemodAdd']),
+    ('IsNewHouse', ['YearBuilt', 'YrSold'], lambda df: (df['YearBuilt'] == df['YrSold']) * 1),
+    ('Exterior1st', ['Exterior1st'], _fix_exterior_typos('Exterior1st')),
+    ('Exterior2nd', ['Exterior2nd'], _fix_exterior_typos('Exterior2nd')),
+    ('MasVnrType_int', ['MasVnrType'], _encoding('MasVnrType', mas_vnr_type_dict)),
+    ('ExterQual', ['ExterQual'], _encoding('ExterQual', qualities_dict)),
+    ('ExterCond', ['ExterCond'], _encoding('ExterCond', qualities_dict)),
+    ('ExterQualCond', ['ExterQual', 'ExterCond'], lambda df: (df['ExterQual'] + df['ExterCond']) / 2),
+    ('Foundation_int', ['Foundation'], _encoding('Foundation', foundation_dict)),
+    ('BsmtQual', ['BsmtQual'], _encoding('BsmtQual', qualities_dict)),
+    ('BsmtCond', ['BsmtCond'], _encoding('BsmtCond', qualities_dict)),
+    ('BsmtQualCond', ['BsmtQual', 'BsmtCond'], lambda df: (df['BsmtQual'] + df['BsmtCond']) / 2),
+    ('BsmtExposure', ['BsmtExposure'], _encoding('BsmtExposure', bsmt_exposure_dict)),
+    ('BsmtFinType1_int', ['BsmtFinType1'], _encoding('BsmtFinType1', fin_qualities_dict)),
+    ('IsBsmtFinType1Unf', ['BsmtFinType1'], lambda df: (df['BsmtFinType1'] == 'Unf') * 1),
+    ('BsmtFinType2_int', ['BsmtFinType2'], _encoding('BsmtFinType2', fin_qualities_dict)),
+    ('IsBsmtFinType2Unf', ['BsmtFinType2'], lambda df: (df['BsmtFinType2'] == 'Unf') * 1),
+    ('BsmtIsPresent', ['TotalBsmtSF'], lambda df: (df['TotalBsmtSF'] > 0) * 1),
+    ('HeatingQC', ['HeatingQC'], _encoding('HeatingQC', qualities_dict)),
+    ('CentralAir', ['CentralAir'], lambda df: (df['CentralAir'] == 'Y') * 1),
+    ('2ndFloorIsPresent', ['2ndFlrSF'], lambda df: (df['2ndFlrSF'] > 0) * 1),
+    ('KitchenQual', ['KitchenQual'], _encoding('KitchenQual', qualities_dict)),
+    ('Functional_int', ['Functional'], _encoding('Functional', functional_dict)),
+    ('FireplaceIsPresent', ['Fireplaces'], lambda df: (df['Fireplaces'] > 0) * 1),
+    ('FireplaceQu', ['FireplaceQu'], _encoding('FireplaceQu', qualities_dict)),
+    ('GarageIsPresent', ['GarageYrBlt'], lambda df: (df['GarageYrBlt'] > 0) * 1),
+    ('GarageFinish', ['GarageFinish'], _encoding('GarageFinish', garage_finish_dict)),
+    ('GarageQual', ['GarageQual'], _encoding('GarageQual', qualities_dict)),
+    ('GarageCond', ['GarageCond'], _encoding('GarageCond', qualities_dict)),
+    ('GarageQualCond', ['GarageCond', 'GarageQual'], lambda df: (df['GarageCond'] + df['GarageQual']) / 2),
+    ('HasWoodDeck', ['WoodDeckSF'], lambda df: (df['WoodDeckSF'] == 0) * 1),
+    ('HasOpenPorch', ['OpenPorchSF'], lambda df: (df['OpenPorchSF'] == 0) * 1),
+    ('HasEnclosedPorch', ['EnclosedPorch'], lambda df: (df['EnclosedPorch'] == 0) * 1),
+    ('Has3SsnPorch', ['3SsnPorch'], lambda df: (df['3SsnPorch'] == 0) * 1),
+    ('HasScreenPorch', ['ScreenPorch'], lambda df: (df['ScreenPorch'] == 0) * 1),
+    ('PoolQC', ['PoolQC'], _encoding('PoolQC', pool_qualities_dict)),
+    ('PoolIsPresent', ['PoolArea'], lambda df: (df['PoolArea'] > 0) * 1),
+    ('Fence', ['Fence'], _encoding('Fence', fence_dict)),
+    ('MiscVal_int', ['MiscVal'], lambda df: df['MiscVal']),
+    ('HasShed', ['MiscFeature', 'MiscVal'], lambda df: ((df['MiscFeature'] == 'Shed') & (df['MiscVal'] > 0)) * 1),
+    ('SaleType', ['SaleType'], _encoding('SaleType', sale_type_dict)),
+]
+
+# Features computed on the values before the imputation (the backup_df of FeaturesEngineering.py)
+AGGREGATED_FEATURES = [
+    ('TotalArea', area_columns, lambda df: df[area_columns].sum(axis=1)),
+    ('Total_Bathrooms', ['FullBath', 'HalfBath', 'BsmtFullBath', 'BsmtHalfBath'],
+     lambda df: df['FullBath'] + (0.5 * df['HalfBath']) + df['BsmtFullBath'] + (0.5 * df['BsmtHalfBath'])),
+]
+
+
+def fit_group_fill(df, column, by, statistic):
+    grouped = df.groupby(by)[column]
+    if statistic == 'mode':
+        values = grouped.agg(lambda x: x.mode()[0] if x.notna().any() else np.nan)
+        default = df[column].mode()[0]
+    else:
+        values = grouped.median()
+        default = df[column].median()
+    return by, values.dropna().to_dict(), default
+
+
+def _new_statistic(statistic):
+    return Counter() if statistic == 'mode' else QuantileSketch()
+
+
+def _update_statistic(current, values):
+    if isinstance(current, Counter):
+        current.update(values.tolist())
+    else:
+        current.update(values.values)
+
+
+def fit_group_statistics(df):
+    """
+    Mergeable version of the GROUP_FILLS statistics: value counts for the modes, quantile sketches for the medians,
+    so the group fills can be updated in place when new rows arrive (see update_group_statistics).
+    """
+    group_statistics = {column: {'by': by, 'statistic': statistic, 'groups': {}, 'overall': _new_statistic(statistic)}
+                        for column, (by, statistic) in GROUP_FILLS.items()}
+    return update_group_statistics(group_statistics, df)
+
+
+def update_group_statistics(group_statistics, df):
+    for column, statistics in group_statistics.items():
+        rows = df[[statistics['by'], column]].dropna(subset=[column])
+        _update_statistic(statistics['overall'], rows[column])
+        for group, values in rows.groupby(statistics['by'])[column]:
+            if group not in statistics['groups']:
+                statistics['groups'][group] = _new_statistic(statistics['statistic'])
+            _update_statistic(statistics['groups'][group], values)
+    return group_statistics
+
+
+def _group_statistic(current, statistic):
+    if statistic == 'mode':
+        # Same tie breaking of pandas mode()[0]: the smallest of the most frequent values
+        top = max(current.values())
+        return min(value for value, count in current.items() if count == top)
+    return current.quantile(0.5)
+
+
+def group_fills_from_statistics(group_statistics):
+    """
+    :return: the group fills in the format of fit_group_fill
+    """
+    return {column: (statistics['by'],
+                     {group: _group_statistic(current, statistics['statistic'])
+                      for group, current in statistics['groups'].items()},
+                     _group_statistic(statistics['overall'], statistics['statistic']))
+            for column, statistics in group_statistics.items()}
+
+
+def apply_group_fills(df, group_fills):
+    for column, (by, values, default) in group_fills.items():
+        fill = df[by].map(values).fillna(default)
+        df[column] = df[column].fillna(fill)
+    return df
+
+
+def engineer_rows(df, state):
+    """
+    Applies the row-wise steps: the group fills, the derived features and the ordinal encodings.
+    """
+    df = apply_group_fills(df, state['group_fills'])
+    if USE_FEATURE_STORE:
+        df = FeatureStore(DERIVED_FEATURES, FEATURE_STORE_DIR).build(df)
+    else:
+        for column, _, function in DERIVED_FEATURES:
+            df[column] = function(df)
+    df['YearBuiltBinned'] = np.clip(np.searchsorted(state['year_built_bins'][1:-1], df['YearBuilt'], side='left'),
+                                    0, YEAR_BUILT_BINS - 1)
+    df.loc[df['YearBuilt'].isna(), 'YearBuiltBinned'] = np.nan
+    return df
+
+
+def encode_features(raw_df, state, fit=False):
+    """
+    The steps up to the encoded matrix, before the imputation (see LazyFeaturesFunctions for the lazy version).
+    """
+    config = state['config']
+    # Corrections by Id and by rule, before the Id is dropped (see CorrectionFunctions)
+    if fit:
+        state['corrections'] = fit_corrections([raw_df])
+    raw_df, _ = apply_corrections(raw_df, state.get('corrections', {}))
+    df = raw_df.drop(columns=['Id', 'SalePrice'], errors='ignore').reset_index(drop=True)
+
+    if fit:
+        state['raw_dtypes'] = df.dtypes.astype(str).to_dict()
+        state['group_fills'] = {column: fit_group_fill(df, column, by, statistic)
+                                for column, (by, statistic) in GROUP_FILLS.items()}
+        _, state['year_built_bins'] = pd.cut(df['YearBuilt'], YEAR_BUILT_BINS, labels=False, retbins=True)
+
+    df = engineer_rows(df, state)
+    df = df.drop(columns=config['columns_to_drop'])
+    backup_df = df
+
+    # Simple imputing and one hot encoding
+    columns_to_ohe = config['columns_to_ohe']
+    if fit:
+        state['ohe_modes'] = {x: df[x].mode()[0] for x in columns_to_ohe}
+    df = df.copy()
+    for x in columns_to_ohe:
+        df[x] = df[x].fillna(state['ohe_modes'][x]).astype(str)
+    if fit:
+        state['rare_categories'] = fit_rare_categories(df, columns_to_ohe)
+    df = pool_rare_categories(df, state.get('rare_categories', {}))
+    if fit:
+        state['category_encodings'] = fit_category_encodings(df, config.get('columns_encoding', {}))
+    category_encodings = state.get('category_encodings', {})
+    df = encode_categories(df, category_encodings)
+    dummy_columns = [x for x in columns_to_ohe if x not in category_encodings]
+    if fit:
+        # dummy column -> (column, category)
+        state['dummies'] = {'{}_{}'.format(x, category): (x, category) for x in dummy_columns
+                            for category in df[x].unique()}
+    df = pd.get_dummies(df, columns=dummy_columns)
+
+    if fit:
+        drop = set(config['columns_to_drop_to_avoid_overfit']).union(fit_near_constant_columns(df))
+        state['encoded_columns'] = [x for x in df.columns if x not in drop]
+    df = df.reindex(columns=state['encoded_columns'], fill_value=0).astype(np.float64)
+
+    for column, _, function in AGGREGATED_FEATURES:
+        df[column] = function(backup_df).values
+    return df
+
+
+def finish_features(df, state, fit=False):
+    """
+    Imputation and skewness of the encoded matrix.
+    """
+    config = state['config']
+
+    # KNN imputation against the training rows
+    if fit:
+        state['imputer'] = KNNImputer(n_neighbors=KNN_NEIGHBORS, weights='distance').fit(df.values)
+        state['columns'] = list(df.columns)
+    df = pd.DataFrame(state['imputer'].transform(df.values), index=df.index, columns=state['columns'])
+
+    # Skewness, the new values are clipped to the training minimum to stay in the domain of the transformation
+    if fit:
+        numeric_columns = [x for x in config['numeric_columns'] if x in df]
+        skew_features = df[numeric_columns].apply(lambda x: skew(x))
+        state['boxcox'] = {x: (boxcox_normmax(df[x] + 1), df[x].min())
+                           for x in skew_features[skew_features > SKEW_THRESHOLD].index}
+    for x, (lmbda, minimum) in state['boxcox'].items():
+        df[x] = boxcox1p(np.maximum(df[x], minimum), lmbda)
+    return df
+
+
+def _engineer(raw_df, state, fit):
+    df = finish_features(encode_features(raw_df, state, fit), state, fit)
+    df.index = raw_df.index
+    return df
+
+
+def fit_features(raw_train_df, features_config):
+    """
+    Fits the features transform on the raw training rows (outliers already removed).
+    :param raw_train_df: rows with the schema of train.csv
+    :param features_config: the lists built by FeaturesEngineering.get_features_config()
+    :return: the fitted state (a picklable dict) and the engineered training matrix
+    """
+    state = {'config': dict(features_config)}
+    x_train = _engineer(raw_train_df, state, fit=True)
+    return state, x_train
+
+
+def transform_features(raw_df, state):
+    return _engineer(raw_df, state, fit=False)
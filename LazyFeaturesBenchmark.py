@@ -0,0 +1,57 @@
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from FeaturesEngineering import get_engineered_train_test, get_features_config
+from FeaturesPipeline import encode_features, fit_features
+from LazyFeaturesFunctions import check_equivalence, lazy_encode_features, pl
+from RegressionFunctions import RANDOM_STATE
+from constants import *
+
+# -------------------------------------- LAZY FEATURES BENCHMARK --------------------------------------
+# Encoding of a synthetic dump of raw listings (rows of train.csv and test.csv sampled with replacement), from the csv
+# to the encoded matrix: pandas (read_csv + FeaturesPipeline.encode_features) against the polars query plan.
+BENCHMARK_ROWS = 1000000
+BENCHMARK_INPUT = Path(predictions_dir, 'synthetic_listings.csv')
+
+((train_ids, _, y_train), _) = get_engineered_train_test()
+raw_train_df = pd.read_csv(Path(dataset_dir, 'train.csv'))
+raw_train_df = raw_train_df.set_index('Id', drop=False).loc[train_ids].reset_index(drop=True)
+raw_test_df = pd.read_csv(Path(dataset_dir, 'test.csv'))
+state, _ = fit_features(raw_train_df, get_features_config())
+
+print("Max difference with pandas, train: {}, test: {}".format(check_equivalence(raw_train_df, state),
+                                                                check_equivalence(raw_test_df, state)))
+
+if not BENCHMARK_INPUT.exists():
+    os.makedirs(predictions_dir, exist_ok=True)
+    rows = pl.read_csv(Path(dataset_dir, 'test.csv'), infer_schema_length=None)
+    sample = np.random.RandomState(RANDOM_STATE).randint(0, rows.height, BENCHMARK_ROWS)
+    rows[sample].with_columns(pl.int_range(BENCHMARK_ROWS).alias('Id')).write_csv(BENCHMARK_INPUT, null_value='NA')
+
+
+def summary(df):
+    # Sums and missing values of each column, the two matrices do not fit in memory together
+    return np.nansum(df.values, axis=0), np.isnan(df.values).sum(axis=0)
+
+
+timings = {}
+start = time.time()
+pandas_df = encode_features(pd.read_csv(BENCHMARK_INPUT), state)
+timings['pandas'] = time.time() - start
+pandas_summary = summary(pandas_df)
+del pandas_df
+
+start = time.time()
+lazy_df = lazy_encode_features(BENCHMARK_INPUT, state)
+timings['polars'] = time.time() - start
+
+lazy_summary = summary(lazy_df)
+assert np.allclose(pandas_summary[0], lazy_summary[0]) and np.array_equal(pandas_summary[1], lazy_summary[1])
+print("{} rows, {} columns".format(*lazy_df.shape))
+for name, elapsed in timings.items():
+    print("{:<10} {:8.2f} s".format(name, elapsed))
+print("Speedup: {:.1f}x".format(timings['pandas'] / timings['polars']))
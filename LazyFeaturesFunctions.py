@@ -0,0 +1,294 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from CorrectionFunctions import COMPARISONS, PREDICATE_CORRECTIONS, id_correction_values
+from EncodingFunctions import FREQUENCY_SUFFIX, RARE_CATEGORY, TARGET_CODE_SUFFIX
+from FeaturesPipeline import AGGREGATED_FEATURES, DERIVED_FEATURES, YEAR_BUILT_BINS, encode_features, \
+    finish_features
+from ResourceFunctions import available_cores
+from constants import *
+
+# The thread pool of polars is sized once, at import, from the cores budget
+os.environ.setdefault('POLARS_MAX_THREADS', str(available_cores()))
+import polars as pl
+
+# %% ~~~~~ LAZY FEATURES TRANSFORM ~~~~~
+# The steps of FeaturesPipeline.encode_features (group fills, derived features, ohe with the fitted state) written as
+# a single polars query plan: the raw columns that no step reads (e.g. most of columns_to_drop) are never parsed,
+# the independent features are computed in parallel and nothing is materialized until the encoded matrix.
+# The imputation and the skewness are then the ones of FeaturesPipeline.finish_features.
+
+# Same missing values of pandas.read_csv
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A',
+             'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+# Rows used to infer the types of the columns not in the fitted state
+INFER_SCHEMA_ROWS = 10000
+
+_POLARS_DTYPES = {'int64': pl.Int64, 'float64': pl.Float64, 'object': pl.String, 'bool': pl.Boolean}
+
+
+def _plain(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _mapping(mapping):
+    return {_plain(key): _plain(value) for key, value in mapping.items()}
+
+
+# Comparisons with the pandas semantics of the missing values
+def _eq(a, b):
+    return (a == b).fill_null(False)
+
+
+def _ne(a, b):
+    return (a != b).fill_null(True)
+
+
+def _gt(a, b):
+    return (a > b).fill_null(False)
+
+
+def _flag(condition):
+    return condition.cast(pl.Int64)
+
+
+def _encoding(source, mapping):
+    return pl.col(source).cast(pl.String).replace_strict(_mapping(mapping), default=None, return_dtype=pl.Float64)
+
+
+def _simplify_overall(source):
+    mapping = {value: simple_value for values, simple_value in bins_overall.items() for value in values}
+    return pl.col(source).replace_strict(mapping, default=None, return_dtype=pl.Float64)
+
+
+def _merge_conditions():
+    c1, c2 = pl.col('Condition1'), pl.col('Condition2')
+    condition = pl.when(_ne(c1, 'Norm')).then(c1).when(_ne(c2, 'Norm')).then(c2).otherwise(pl.lit('Norm'))
+    both = _ne(c1, 'Norm') & _ne(c2, 'Norm') & _ne(c1, c2)
+    discarded = pl.when(_eq(c1, 'Feedr') | _eq(c2, 'Feedr')).then(pl.lit('Feedr')).otherwise(pl.lit('Artery'))
+    return pl.when(both).then(pl.when(_eq(c1, discarded)).then(c2).otherwise(c1)).otherwise(condition)
+
+
+def _fix_exterior_typos(source):
+    return pl.col(source).replace(exterior_typos_dict)
+
+
+# column -> expression, the polars version of each of FeaturesPipeline.DERIVED_FEATURES
+LAZY_DERIVED_FEATURES = {
+    'HasAlley': _flag(pl.col('Alley').is_not_null()),
+    'IsGoodNeighborhood': _flag(pl.col('Neighborhood').is_in(list(good_neighborhoods)).fill_null(False)),
+    'Condition': _merge_conditions(),
+    'HouseStyle_int': _encoding('HouseStyle', house_style_dict),
+    'OverallQualSimplified': _simplify_overall('OverallQual'),
+    'OverallCondSimplified': _simplify_overall('OverallCond'),
+    'IsRemodeled': _flag(_ne(pl.col('YearRemodAdd'), pl.col('YearBuilt'))),
+    'IsRemodelRecent': _flag(_eq(pl.col('YearRemodAdd'), pl.col('YrSold'))),
+    'YearsSinceRemodel': pl.col('YrSold') - pl.col('YearRemodAdd'),
+    'IsNewHouse': _flag(_eq(pl.col('YearBuilt'), pl.col('YrSold'))),
+    'Exterior1st': _fix_exterior_typos('Exterior1st'),
+    'Exterior2nd': _fix_exterior_typos('Exterior2nd'),
+    'MasVnrType_int': _encoding('MasVnrType', mas_vnr_type_dict),
+    'ExterQual': _encoding('ExterQual', qualities_dict),
+    'ExterCond': _encoding('ExterCond', qualities_dict),
+    'ExterQualCond': (pl.col('ExterQual') + pl.col('ExterCond')) / 2,
+    'Foundation_int': _encoding('Foundation', foundation_dict),
+    'BsmtQual': _encoding('BsmtQual', qualities_dict),
+    'BsmtCond': _encoding('BsmtCond', qualities_dict),
+    'BsmtQualCond': (pl.col('BsmtQual') + pl.col('BsmtCond')) / 2,
+    'BsmtExposure': _encoding('BsmtExposure', bsmt_exposure_dict),
+    'BsmtFinType1_int': _encoding('BsmtFinType1', fin_qualities_dict),
+    'IsBsmtFinType1Unf': _flag(_eq(pl.col('BsmtFinType1'), 'Unf')),
+    'BsmtFinType2_int': _encoding('BsmtFinType2', fin_qualities_dict),
+    'IsBsmtFinType2Unf': _flag(_eq(pl.col('BsmtFinType2'), 'Unf')),
+    'BsmtIsPresent': _flag(_gt(pl.col('TotalBsmtSF'), 0)),
+    'HeatingQC': _encoding('HeatingQC', qualities_dict),
+    'CentralAir': _flag(_eq(pl.col('CentralAir'), 'Y')),
+    '2ndFloorIsPresent': _flag(_gt(pl.col('2ndFlrSF'), 0)),
+    'KitchenQual': _encoding('KitchenQual', qualities_dict),
+    'Functional_int': _encoding('Functional', functional_dict),
+    'FireplaceIsPresent': _flag(_gt(pl.col('Fireplaces'), 0)),
+    'FireplaceQu': _encoding('FireplaceQu', qualities_dict),
+    'GarageIsPresent': _flag(_gt(pl.col('GarageYrBlt'), 0)),
+    'GarageFinish': _encoding('GarageFinish', garage_finish_dict),
+    'GarageQual': _encoding('GarageQual', qualities_dict),
+    'GarageCond': _encoding('GarageCond', qualities_dict),
+    'GarageQualCond': (pl.col('GarageCond') + pl.col('GarageQual')) / 2,
+    'HasWoodDeck': _flag(_eq(pl.col('WoodDeckSF'), 0)),
+    'HasOpenPorch': _flag(_eq(pl.col('OpenPorchSF'), 0)),
+    'HasEnclosedPorch': _flag(_eq(pl.col('EnclosedPorch'), 0)),
+    'Has3SsnPorch': _flag(_eq(pl.col('3SsnPorch'), 0)),
+    'HasScreenPorch': _flag(_eq(pl.col('ScreenPorch'), 0)),
+    'PoolQC': _encoding('PoolQC', pool_qualities_dict),
+    'PoolIsPresent': _flag(_gt(pl.col('PoolArea'), 0)),
+    'Fence': _encoding('Fence', fence_dict),
+    'MiscVal_int': pl.col('MiscVal'),
+    'HasShed': _flag(_eq(pl.col('MiscFeature'), 'Shed') & _gt(pl.col('MiscVal'), 0)),
+    'SaleType': _encoding('SaleType', sale_type_dict),
+}
+
+LAZY_AGGREGATED_FEATURES = {
+    'TotalArea': pl.sum_horizontal(area_columns),
+    'Total_Bathrooms': pl.col('FullBath') + (0.5 * pl.col('HalfBath')) + pl.col('BsmtFullBath') +
+                       (0.5 * pl.col('BsmtHalfBath')),
+}
+
+assert [column for column, _, _ in DERIVED_FEATURES] == list(LAZY_DERIVED_FEATURES)
+assert [column for column, _, _ in AGGREGATED_FEATURES] == list(LAZY_AGGREGATED_FEATURES)
+
+
+def derived_levels(features=DERIVED_FEATURES):
+    """
+    Groups the features in levels computed by a single with_columns each (in parallel): a feature comes after the
+    features producing its inputs, and a feature overwriting a column not before the features reading its old value.
+    :return: list of lists of columns
+    """
+    levels, produced, read = [], {}, {}
+    for column, inputs, _ in features:
+        level = max([produced[x] + 1 for x in inputs if x in produced] + [read.get(column, 0)])
+        for x in inputs:
+            read[x] = max(read.get(x, 0), level)
+        produced[column] = level
+        levels.extend([] for _ in range(level + 1 - len(levels)))
+        levels[level].append(column)
+    return levels
+
+
+# %% ~~~~~ QUERY PLAN ~~~~~
+def _raw_schema(state):
+    # With the Id, for the corrections
+    schema = {x: _POLARS_DTYPES[dtype] for x, dtype in state['raw_dtypes'].items() if dtype in _POLARS_DTYPES}
+    return dict(schema, Id=pl.Int64)
+
+
+def _series(values, dtype):
+    # Without the pyarrow conversion of pl.from_pandas, the missing values become nulls
+    if values.dtype == object:
+        return pl.Series(values.name, values.where(values.notna(), None).tolist(), dtype=dtype, strict=False)
+    return pl.Series(values.name, values.to_numpy(), nan_to_null=True).cast(dtype)
+
+
+def scan_raw(source, state):
+    """
+    :param source: a .csv or .parquet path, or a pandas DataFrame (same schema of test.csv)
+    :return: the LazyFrame of the raw rows, with the types of the training rows
+    """
+    schema = _raw_schema(state)
+    if isinstance(source, pd.DataFrame):
+        return pl.DataFrame([_series(source[x], schema[x]) for x in source.columns if x in schema]).lazy()
+    if str(source).endswith('.parquet'):
+        return pl.scan_parquet(source).with_columns([pl.col(x).cast(dtype) for x, dtype in schema.items()])
+    return pl.scan_csv(source, null_values=NA_VALUES, schema_overrides=schema, infer_schema_length=INFER_SCHEMA_ROWS)
+
+
+def lazy_corrections(lf, state):
+    """
+    :return: the LazyFrame with the corrections of CorrectionFunctions, joined on the Id and masked by the rules
+    """
+    columns = lf.collect_schema()
+    schema = _raw_schema(state)
+    corrections = []
+    if 'Id' in columns:
+        row_id = pl.col('Id')
+        for column, values in id_correction_values(state.get('corrections', {})).items():
+            if column in columns:
+                # A fitted median of an integer column (e.g. 479.5) is float, as in pandas
+                dtype = pl.Float64 if any(isinstance(x, float) for x in values.values()) and \
+                    schema[column] == pl.Int64 else schema[column]
+                corrections.append(
+                    pl.when(row_id.is_in(list(values))).then(
+                        row_id.replace_strict(_mapping(values), default=None, return_dtype=dtype))
+                    .otherwise(pl.col(column)).alias(column))
+    if corrections:
+        lf = lf.with_columns(corrections)
+    for column, comparison, other, offset, value in PREDICATE_CORRECTIONS:
+        if column in columns and other in columns and value in columns:
+            condition = COMPARISONS[comparison](pl.col(column), pl.col(other) + offset).fill_null(False)
+            lf = lf.with_columns(pl.when(condition).then(pl.col(value)).otherwise(pl.col(column)).alias(column))
+    return lf
+
+
+def lazy_encode(lf, state):
+    """
+    :return: the LazyFrame of the encoded matrix, same columns and values of FeaturesPipeline.encode_features
+    """
+    config = state['config']
+    lf = lazy_corrections(lf, state)
+
+    # Group fills and year bins
+    lf = lf.with_columns([pl.col(column).fill_null(pl.col(by).replace_strict(_mapping(values), default=_plain(default)))
+                          for column, (by, values, default) in state['group_fills'].items()])
+    for level in derived_levels():
+        lf = lf.with_columns([LAZY_DERIVED_FEATURES[column].alias(column) for column in level])
+    edges = state['year_built_bins'][1:-1]
+    assert len(edges) == YEAR_BUILT_BINS - 1
+    year_built = pl.col('YearBuilt')
+    lf = lf.with_columns(pl.when(year_built.is_null()).then(None).otherwise(
+        pl.sum_horizontal([_flag(_gt(year_built, float(edge))) for edge in edges])).alias('YearBuiltBinned'))
+
+    # Simple imputing, pooling and encoding of the categories
+    category_encodings = state.get('category_encodings', {})
+    rare_categories = state.get('rare_categories', {})
+    categories = []
+    for x in config['columns_to_ohe']:
+        category = pl.col(x).fill_null(_plain(state['ohe_modes'][x])).cast(pl.String)
+        if x in rare_categories:
+            category = pl.when(category.is_in(rare_categories[x])).then(category).otherwise(pl.lit(RARE_CATEGORY))
+        categories.append(category.alias(x))
+    lf = lf.with_columns(categories)
+
+    encoded = []
+    for x, (encoding, mapping) in category_encodings.items():
+        if encoding == 'frequency':
+            encoded.append(pl.col(x).replace_strict(_mapping(mapping), default=0.0, return_dtype=pl.Float64)
+                           .alias(x + FREQUENCY_SUFFIX))
+        else:
+            encoded.append(pl.col(x).replace_strict(_mapping(mapping), default=-1, return_dtype=pl.Int64)
+                           .alias(x + TARGET_CODE_SUFFIX))
+    if encoded:
+        lf = lf.with_columns(encoded)
+
+    # The dummies of the training categories only, the unseen ones are all zeros
+    columns = []
+    for column in state['encoded_columns']:
+        if column in state['dummies']:
+            x, category = state['dummies'][column]
+            columns.append(_eq(pl.col(x), category).cast(pl.Float64).alias(column))
+        else:
+            columns.append(pl.col(column).cast(pl.Float64))
+    columns.extend(expression.cast(pl.Float64).alias(column)
+                   for column, expression in LAZY_AGGREGATED_FEATURES.items())
+    return lf.select(columns)
+
+
+def lazy_encode_features(source, state):
+    """
+    :return: the pandas encoded matrix (see lazy_encode)
+    """
+    encoded = lazy_encode(scan_raw(source, state), state).collect()
+    return pd.DataFrame(encoded.to_numpy(), columns=encoded.columns)
+
+
+def lazy_transform_features(source, state):
+    """
+    Same of FeaturesPipeline.transform_features with the lazy encoding.
+    """
+    df = finish_features(lazy_encode_features(source, state), state)
+    if isinstance(source, pd.DataFrame):
+        df.index = source.index
+    return df
+
+
+def check_equivalence(raw_df, state):
+    """
+    Compares the lazy encoding with the pandas one on the same raw rows.
+    :return: the maximum absolute difference (0 when equivalent), raises if the columns or the missing values differ
+    """
+    expected = encode_features(raw_df, state)
+    actual = lazy_encode_features(raw_df, state)
+    assert list(expected.columns) == list(actual.columns), 'Different columns'
+    expected, actual = expected.values, actual.values
+    assert np.array_equal(np.isnan(expected), np.isnan(actual)), 'Different missing values in {}'.format(
+        sorted(set(np.where(np.isnan(expected) != np.isnan(actual))[1])))
+    return float(np.nanmax(np.abs(expected - actual), initial=0))
@@ -0,0 +1,272 @@
+import copy
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import RidgeCV, BayesianRidge
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import RobustScaler
+
+from SketchFunctions import QuantileSketch
+
+# Same number of folds of the kfolds used by RidgeCV in fit_models
+STATISTICS_FOLDS = 20
+# Rows of the engineered matrix accumulated together
+STATISTICS_CHUNK_SIZE = 100000
+BAYES_TOL = 1e-3
+BAYES_PRIOR = 1e-6
+
+
+# %% ~~~~~ SUFFICIENT STATISTICS ~~~~~
+class SufficientStatistics:
+    """
+    Count, means and centered co-moments (XᵀX, Xᵀy, yᵀy of the centered data) of a set of rows.
+    Two statistics are merged with the pairwise update of Chan et al., so chunks and processes can be accumulated
+    in any order without the cancellation of the raw sums of squares.
+    """
+
+    def __init__(self, n_features):
+        self.n = 0
+        self.x_mean = np.zeros(n_features)
+        self.y_mean = 0.0
+        self.xx = np.zeros((n_features, n_features))
+        self.xy = np.zeros(n_features)
+        self.yy = 0.0
+
+    @classmethod
+    def from_rows(cls, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64).ravel()
+        stats = cls(x.shape[1])
+        if x.shape[0] == 0:
+            return stats
+        stats.n = x.shape[0]
+        stats.x_mean = x.mean(axis=0)
+        stats.y_mean = y.mean()
+        xc = x - stats.x_mean
+        yc = y - stats.y_mean
+        stats.xx = xc.T @ xc
+        stats.xy = xc.T @ yc
+        stats.yy = yc @ yc
+        return stats
+
+    def update(self, x, y):
+        return self.merge(SufficientStatistics.from_rows(x, y))
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        dx = other.x_mean - self.x_mean
+        dy = other.y_mean - self.y_mean
+        factor = self.n * other.n / n
+        self.xx += other.xx + factor * np.outer(dx, dx)
+        self.xy += other.xy + factor * dx * dy
+        self.yy += other.yy + factor * dy * dy
+        self.x_mean = self.x_mean + dx * other.n / n
+        self.y_mean = self.y_mean + dy * other.n / n
+        self.n = n
+        return self
+
+    def copy(self):
+        copied = SufficientStatistics(self.x_mean.shape[0])
+        return copied.merge(self)
+
+    def scaled(self, center, scale):
+        """
+        :return: the statistics of (x - center) / scale
+        """
+        scaled = self.copy()
+        scaled.x_mean = (self.x_mean - center) / scale
+        scaled.xx = self.xx / np.outer(scale, scale)
+        scaled.xy = self.xy / scale
+        return scaled
+
+    def residuals(self, coef, intercept):
+        """
+        :return: the sum of the squared residuals of the linear model on the rows
+        """
+        bias = self.y_mean - intercept - self.x_mean @ coef
+        return self.n * bias ** 2 + self.yy - 2 * coef @ self.xy + coef @ self.xx @ coef
+
+
+class LinearStatistics:
+    """
+    Everything needed to fit the RobustScaler + RidgeCV and RobustScaler + BayesianRidge members of fit_models:
+    the sufficient statistics of each cross validation fold and a quantile sketch of each feature (for the median and
+    the interquartile range of the scaler). The memory grows with features², not with rows.
+    The fold of a row depends only on its position in the stream, use first_row to accumulate disjoint parts of the
+    stream in different processes and merge them at the end.
+    """
+
+    def __init__(self, n_features, n_folds=STATISTICS_FOLDS, columns=None):
+        self.n_folds = n_folds
+        self.columns = columns
+        self.folds = [SufficientStatistics(n_features) for _ in range(n_folds)]
+        self.sketches = [QuantileSketch() for _ in range(n_features)]
+        self.rows = 0
+
+    @property
+    def n(self):
+        return sum(fold.n for fold in self.folds)
+
+    def update(self, x, y, first_row=None):
+        first_row = self.rows if first_row is None else first_row
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64).ravel()
+        assert not np.isnan(x).any(), 'The engineered matrix must not contain missing values'
+
+        folds = assign_folds(np.arange(first_row, first_row + x.shape[0]), self.n_folds)
+        for f in np.unique(folds):
+            mask = folds == f
+            self.folds[f].update(x[mask], y[mask])
+        for j, sketch in enumerate(self.sketches):
+            sketch.update(x[:, j])
+        self.rows = max(self.rows, first_row + x.shape[0])
+        return self
+
+    def merge(self, other):
+        for fold, other_fold in zip(self.folds, other.folds):
+            fold.merge(other_fold)
+        for sketch, other_sketch in zip(self.sketches, other.sketches):
+            sketch.merge(other_sketch)
+        self.rows = max(self.rows, other.rows)
+        return self
+
+    def total(self):
+        total = SufficientStatistics(len(self.sketches))
+        for fold in self.folds:
+            total.merge(fold)
+        return total
+
+
+def assign_folds(positions, n_folds):
+    # Multiplicative hash of the position: shuffled folds that do not depend on how the stream is chunked
+    return ((positions.astype(np.uint64) * np.uint64(2654435761)) % np.uint64(2 ** 32) % np.uint64(n_folds)).astype(
+        np.int64)
+
+
+def accumulate_statistics(chunks, n_folds=STATISTICS_FOLDS):
+    """
+    :param chunks: iterable of (x, y) chunks of the engineered matrix, y already in log scale
+    """
+    statistics = None
+    for x, y in chunks:
+        if statistics is None:
+            columns = list(x.columns) if isinstance(x, pd.DataFrame) else None
+            statistics = LinearStatistics(x.shape[1], n_folds, columns)
+        statistics.update(x, y)
+    assert statistics is not None, 'No rows to accumulate'
+    return statistics
+
+
+def read_matrix_chunks(path, target='SalePrice', chunk_size=STATISTICS_CHUNK_SIZE):
+    """
+    Reads an engineered matrix saved as csv (features plus the target price) chunk by chunk.
+    """
+    for chunk in pd.read_csv(path, chunksize=chunk_size):
+        yield chunk.drop(columns=[target]), np.log1p(chunk[target].values)
+
+
+# %% ~~~~~ SOLVERS ~~~~~
+def robust_scaler_from_statistics(statistics):
+    q25, median, q75 = np.array([[sketch.quantile(q) for q in (0.25, 0.5, 0.75)] for sketch in statistics.sketches]).T
+    scale = q75 - q25
+    scale[scale == 0] = 1.0
+
+    scaler = RobustScaler()
+    scaler.center_ = median
+    scaler.scale_ = scale
+    scaler.n_features_in_ = median.shape[0]
+    if statistics.columns is not None:
+        scaler.feature_names_in_ = np.array(statistics.columns, dtype=object)
+    return scaler
+
+
+def ridge_path(stats, alphas):
+    """
+    Solves the ridge regression (intercept not penalized) for every alpha with a single eigendecomposition of XᵀX.
+    :return: (n_alphas, n_features) coefficients and (n_alphas,) intercepts
+    """
+    eigen_vals, eigen_vecs = np.linalg.eigh(stats.xx)
+    projected = eigen_vecs.T @ stats.xy
+    coefs = np.array([eigen_vecs @ (projected / (eigen_vals + alpha)) for alpha in alphas])
+    return coefs, stats.y_mean - coefs @ stats.x_mean
+
+
+def fit_ridge_cv(statistics, alphas, center, scale):
+    """
+    Same selection of RidgeCV with cv=kfolds: the alpha with the best R² averaged over the validation folds,
+    then the ridge refitted on all the rows.
+    """
+    folds = [fold.scaled(center, scale) for fold in statistics.folds]
+    scores = []
+    for i, validation in enumerate(folds):
+        if validation.n < 2:
+            continue
+        training = SufficientStatistics(center.shape[0])
+        for j, fold in enumerate(folds):
+            if j != i:
+                training.merge(fold)
+        coefs, intercepts = ridge_path(training, alphas)
+        scores.append([1 - validation.residuals(coef, intercept) / validation.yy
+                       for coef, intercept in zip(coefs, intercepts)])
+    scores = np.mean(scores, axis=0)
+
+    best = int(np.argmax(scores))
+    coefs, intercepts = ridge_path(statistics.total().scaled(center, scale), [alphas[best]])
+
+    ridge = RidgeCV(alphas=alphas, fit_intercept=True)
+    ridge.alpha_ = alphas[best]
+    ridge.best_score_ = scores[best]
+    ridge.coef_ = coefs[0]
+    ridge.intercept_ = intercepts[0]
+    ridge.n_features_in_ = center.shape[0]
+    return ridge
+
+
+def fit_bayesian_ridge(stats, n_iter=10000):
+    """
+    Evidence maximization of BayesianRidge (MacKay updates, same defaults of sklearn) on the statistics.
+    """
+    eps = np.finfo(np.float64).eps
+    eigen_vals, eigen_vecs = np.linalg.eigh(stats.xx)
+    eigen_vals = np.maximum(eigen_vals, 0)
+    projected = eigen_vecs.T @ stats.xy
+
+    def _update_coef(alpha, lmbda):
+        coef = eigen_vecs @ (projected / (eigen_vals + lmbda / alpha))
+        return coef, stats.residuals(coef, stats.y_mean - stats.x_mean @ coef)
+
+    alpha, lmbda = 1. / (stats.yy / stats.n + eps), 1.
+    coef_old = None
+    for iteration in range(n_iter):
+        coef, rmse = _update_coef(alpha, lmbda)
+        gamma = np.sum((alpha * eigen_vals) / (lmbda + alpha * eigen_vals))
+        lmbda = (gamma + 2 * BAYES_PRIOR) / (np.sum(coef ** 2) + 2 * BAYES_PRIOR)
+        alpha = (stats.n - gamma + 2 * BAYES_PRIOR) / (rmse + 2 * BAYES_PRIOR)
+        if coef_old is not None and np.sum(np.abs(coef_old - coef)) < BAYES_TOL:
+            break
+        coef_old = coef
+
+    coef, _ = _update_coef(alpha, lmbda)
+    baye = BayesianRidge(fit_intercept=True, n_iter=n_iter)
+    baye.n_iter_ = iteration + 1
+    baye.alpha_ = alpha
+    baye.lambda_ = lmbda
+    baye.coef_ = coef
+    baye.intercept_ = stats.y_mean - stats.x_mean @ coef
+    baye.sigma_ = eigen_vecs @ (eigen_vecs.T / (alpha * eigen_vals + lmbda)[:, None])
+    baye.X_offset_ = stats.x_mean
+    baye.X_scale_ = np.ones_like(stats.x_mean)
+    baye.n_features_in_ = stats.x_mean.shape[0]
+    return baye
+
+
+def fit_linear_models(statistics, alphas, n_iter=10000):
+    """
+    Builds the 'ridge' and 'baye' members of fit_models from the accumulated statistics, as fitted pipelines.
+    """
+    scaler = robust_scaler_from_statistics(statistics)
+    ridge = fit_ridge_cv(statistics, alphas, scaler.center_, scaler.scale_)
+    baye = fit_bayesian_ridge(statistics.total().scaled(scaler.center_, scaler.scale_), n_iter)
+    return {'ridge': make_pipeline(scaler, ridge), 'baye': make_pipeline(copy.deepcopy(scaler), baye)}
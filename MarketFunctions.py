@@ -0,0 +1,160 @@
+import hashlib
+import json
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from MemoryFunctions import MEMORY_ENV, parse_budget
+from ResourceFunctions import CORES_ENV, available_cores
+from constants import *
+
+# %% ~~~~~ MARKETS ~~~~~
+# The same pipeline (Regression.py: features engineering, training and predictions) runs for every market of a
+# manifest, each one as a process with its own dataset_dir and predictions_dir (see constants.py), on a shared pool of
+# MARKET_WORKERS jobs at a time. Every job gets its share of the cores budget and its memory budget (the soft one of
+# MemoryFunctions, with a hard limit of the data segment above it), and a timeout.
+# A market whose inputs (its dataset files, the code of the pipeline and its job config) did not change since its last
+# successful run is skipped. The longest markets of the previous runs are started first, to finish the night earlier.
+# Manifest: JSON list of {"name": ..., "dataset": dir with train.csv and test.csv, optional "predictions" (dir, by
+# default MARKETS_DIR/name), "memory" (e.g. "6G"), "cores", "timeout" (seconds), "script"}.
+MARKETS_DIR = Path(predictions_dir, 'markets')
+MARKET_SCRIPT = 'Regression.py'
+# Jobs running at the same time (None for one per core)
+MARKET_WORKERS = None
+MARKET_TIMEOUT = 3 * 3600
+# Hard limit of the data segment of a job, relative to its memory budget (the spills are memory-mapped, they do not
+# count), None for no hard limit
+MARKET_HARD_MEMORY_FACTOR = 1.5
+# State of the last run, in the predictions dir of each market
+MARKET_STATE = 'market_state.json'
+MARKET_LOG = 'market.log'
+# Lines of the log kept in the summary of a failed market
+MARKET_ERROR_LINES = 5
+
+_CODE_DIR = Path(__file__).resolve().parent
+_MARKET_INPUTS = ('train.csv', 'test.csv')
+
+
+def load_manifest(path):
+    """
+    :return: list of the markets, with the default predictions dir
+    """
+    with open(path) as f:
+        markets = json.load(f)
+    names = [market['name'] for market in markets]
+    assert len(names) == len(set(names)), "Duplicate markets in {}".format(path)
+    for market in markets:
+        market.setdefault('predictions', str(Path(MARKETS_DIR, market['name'])))
+    return markets
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _file_hash_all(paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.name.encode())
+        digest.update(_file_hash(path).encode())
+    return digest.hexdigest()
+
+
+def code_fingerprint(directory=_CODE_DIR):
+    return _file_hash_all(sorted(Path(directory).glob('*.py')))
+
+
+def market_fingerprint(market, code):
+    """
+    :param code: code_fingerprint of the pipeline
+    """
+    inputs = _file_hash_all([Path(market['dataset'], x) for x in _MARKET_INPUTS])
+    config = json.dumps({x: market.get(x) for x in ('memory', 'cores', 'script')}, sort_keys=True)
+    return hashlib.sha256('{}{}{}'.format(inputs, code, config).encode()).hexdigest()
+
+
+def read_state(market):
+    path = Path(market['predictions'], MARKET_STATE)
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def run_market(market, fingerprint, cores):
+    """
+    Runs the pipeline of a market in a process (its output in MARKET_LOG of its predictions dir).
+    :return: row of the summary
+    """
+    predictions = Path(market['predictions'])
+    os.makedirs(predictions, exist_ok=True)
+    memory = parse_budget(market.get('memory'))
+    cores = market.get('cores', cores)
+    env = dict(os.environ, HOUSE_PRICES_DATASET=str(Path(market['dataset']).resolve()),
+               HOUSE_PRICES_PREDICTIONS=str(predictions.resolve()))
+    env[CORES_ENV] = str(cores)
+    if memory:
+        env[MEMORY_ENV] = str(memory)
+
+    start = time.time()
+    status, error = 'ok', None
+    with open(Path(predictions, MARKET_LOG), 'w') as log:
+        process = subprocess.Popen([sys.executable, market.get('script', MARKET_SCRIPT)], cwd=str(_CODE_DIR), env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        # Set from outside (a preexec_fn is not safe with the threads of the pool), before the interpreter starts
+        if memory and MARKET_HARD_MEMORY_FACTOR:
+            hard = int(memory * MARKET_HARD_MEMORY_FACTOR)
+            resource.prlimit(process.pid, resource.RLIMIT_DATA, (hard, hard))
+        try:
+            if process.wait(timeout=market.get('timeout', MARKET_TIMEOUT)) != 0:
+                status = 'failed'
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            status = 'timeout'
+    seconds = time.time() - start
+    if status != 'ok':
+        with open(Path(predictions, MARKET_LOG)) as log:
+            error = ''.join(log.readlines()[-MARKET_ERROR_LINES:]).strip()
+
+    with open(Path(predictions, MARKET_STATE), 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'status': status, 'seconds': seconds, 'finished_at': time.time()}, f)
+    return {'market': market['name'], 'status': status, 'seconds': seconds, 'cores': cores, 'memory': memory,
+            'error': error}
+
+
+def run_markets(markets, n_workers=MARKET_WORKERS, force=False):
+    """
+    :param force: run also the markets whose inputs did not change
+    :return: summary table with the status (ok, failed, timeout or skipped), the seconds and the error of every market
+    """
+    code = code_fingerprint()
+    states = {market['name']: read_state(market) for market in markets}
+    fingerprints = {market['name']: market_fingerprint(market, code) for market in markets}
+    skipped = [market for market in markets
+               if not force and states[market['name']].get('status') == 'ok'
+               and states[market['name']].get('fingerprint') == fingerprints[market['name']]]
+    pending = [market for market in markets if market not in skipped]
+    # Longest first, the new markets before all the others
+    pending.sort(key=lambda market: -states[market['name']].get('seconds', float('inf')))
+
+    n_workers = max(1, min(n_workers or available_cores(), len(pending) or 1))
+    cores = max(1, available_cores() // n_workers)
+    print("Markets: {} to run ({} jobs at a time, {} cores each), {} unchanged".format(len(pending), n_workers, cores,
+                                                                                      len(skipped)))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        rows = list(executor.map(lambda market: run_market(market, fingerprints[market['name']], cores), pending))
+    rows += [{'market': market['name'], 'status': 'skipped', 'seconds': 0.0, 'cores': None,
+              'memory': parse_budget(market.get('memory')), 'error': None} for market in skipped]
+    order = {market['name']: i for i, market in enumerate(markets)}
+    summary = pd.DataFrame(rows, columns=['market', 'status', 'seconds', 'cores', 'memory', 'error'])
+    return summary.sort_values('market', key=lambda x: x.map(order)).reset_index(drop=True)
@@ -0,0 +1,21 @@
+from pathlib import Path
+
+from MarketFunctions import MARKETS_DIR, load_manifest, run_markets
+from constants import *
+
+# -------------------------------------- MARKETS --------------------------------------
+# Nightly run of the pipeline for every market of the manifest (see MarketFunctions), the summary of the timings and
+# of the errors is written next to the predictions of the markets
+MARKETS_MANIFEST = Path('markets.json')
+MARKETS_SUMMARY = Path(MARKETS_DIR, 'summary.csv')
+# Run also the markets whose inputs did not change
+FORCE_ALL_MARKETS = False
+
+summary = run_markets(load_manifest(MARKETS_MANIFEST), force=FORCE_ALL_MARKETS)
+os.makedirs(MARKETS_DIR, exist_ok=True)
+summary.to_csv(MARKETS_SUMMARY, index=False)
+
+print(summary.drop(columns=['error']).to_string(float_format='{:.1f}'.format))
+for market, error in summary.dropna(subset=['error'])[['market', 'error']].values:
+    print("\n{} failed:\n{}".format(market, error))
+print("Total: {:.1f} s of jobs, summary in {}".format(summary['seconds'].sum(), MARKETS_SUMMARY))
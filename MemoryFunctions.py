@@ -0,0 +1,172 @@
+import itertools
+import os
+import resource
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from constants import *
+
+# %% ~~~~~ MEMORY BUDGET ~~~~~
+# The resident memory of the process is recorded at the end of every stage (of FeaturesEngineering.py and fit_predict),
+# against a budget given in HOUSE_PRICES_MEMORY (bytes, or with a K/M/G suffix, or 'auto' for the limit of the cgroup
+# of the container). Without a budget the stages are only recorded.
+# With a budget:
+# - the large dense copies (e.g. the matrices of the stacker) are written chunk by chunk into memory-mapped files
+#   instead of memory when the resident memory would get above MEMORY_SPILL_FRACTION of the budget;
+# - a stage that ends above the budget, or that fails to allocate, raises a MemoryBudgetError with the breakdown of
+#   the resident memory of every stage, instead of getting OOM-killed later without a trace.
+MEMORY_ENV = 'HOUSE_PRICES_MEMORY'
+MEMORY_SPILL_FRACTION = 0.8
+MEMORY_SPILL_DIR = Path(predictions_dir, 'spill')
+# Rows converted to float at once when spilling a DataFrame
+MEMORY_SPILL_CHUNK = 50000
+
+_CGROUP_LIMITS = ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+_MB = 1024 ** 2
+
+
+class MemoryBudgetError(MemoryError):
+    pass
+
+
+def cgroup_limit():
+    """
+    :return: the memory limit of the container in bytes, None without one
+    """
+    for path in _CGROUP_LIMITS:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # cgroup v1 reports "no limit" as a huge number
+        if value.isdigit() and int(value) < 2 ** 60:
+            return int(value)
+    return None
+
+
+def parse_budget(value):
+    """
+    :param value: e.g. '6G', '500M', '1073741824' or 'auto'
+    :return: bytes, None for no budget
+    """
+    value = (value or '').strip().upper()
+    if not value:
+        return None
+    if value == 'AUTO':
+        return cgroup_limit()
+    if value[-1] in _UNITS:
+        return int(float(value[:-1]) * _UNITS[value[-1]])
+    return int(value)
+
+
+def resident_bytes():
+    """
+    :return: the anonymous resident memory of the process (the pages of the memory-mapped files can be dropped by the
+             kernel, they do not count), the peak where /proc is not available
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return peak_bytes()
+
+
+def peak_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryBudget:
+
+    def __init__(self, limit=None, spill_fraction=MEMORY_SPILL_FRACTION, spill_dir=MEMORY_SPILL_DIR):
+        """
+        :param limit: bytes, None to only record the stages
+        """
+        self.limit = limit
+        self.spill_fraction = spill_fraction
+        self.spill_dir = Path(spill_dir)
+        # (stage, resident bytes at its end, difference with its start, peak of the process so far, bytes spilled)
+        self.stages = []
+        self._start = resident_bytes()
+        self._spilled = 0
+        self._counter = itertools.count()
+
+    def report(self):
+        lines = ["{:<36} {:>10} {:>10} {:>10} {:>10}".format('stage', 'resident', 'delta', 'peak', 'spilled')]
+        for name, resident, delta, peak, spilled in self.stages:
+            lines.append("{:<36} {:>8.0f}MB {:>+8.0f}MB {:>8.0f}MB {:>8.0f}MB".format(
+                name, resident / _MB, delta / _MB, peak / _MB, spilled / _MB))
+        if self.limit:
+            lines.append("Budget: {:.0f}MB".format(self.limit / _MB))
+        return '\n'.join(lines)
+
+    def mark(self, name):
+        """
+        Records the end of a stage (the one started with the previous mark), fails if it ended above the budget.
+        """
+        resident = resident_bytes()
+        self.stages.append((name, resident, resident - self._start, peak_bytes(), self._spilled))
+        self._start, self._spilled = resident, 0
+        if self.limit and resident > self.limit:
+            raise MemoryBudgetError("Memory budget exceeded at the end of '{}'\n{}".format(name, self.report()))
+
+    @contextmanager
+    def stage(self, name):
+        self._start, self._spilled = resident_bytes(), 0
+        try:
+            yield
+        except MemoryBudgetError:
+            raise
+        except MemoryError as e:
+            self.stages.append((name + ' (failed)', resident_bytes(), resident_bytes() - self._start, peak_bytes(),
+                                self._spilled))
+            raise MemoryBudgetError("Out of memory in '{}'\n{}".format(name, self.report())) from e
+        self.mark(name)
+
+    def fits(self, n_bytes):
+        return not self.limit or resident_bytes() + n_bytes <= self.spill_fraction * self.limit
+
+    def asarray(self, name, x, dtype=np.float64, order='C'):
+        """
+        np.asarray of a matrix (e.g. the engineered DataFrame), written into a read-only memory-mapped file when the
+        copy does not fit in the budget.
+        :param order: 'C' or 'F' (column-major)
+        """
+        n_bytes = int(np.prod(x.shape)) * np.dtype(dtype).itemsize
+        if self.fits(n_bytes) or (isinstance(x, np.ndarray) and x.dtype == dtype):
+            return np.asarray(x, dtype=dtype, order=order)
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = Path(self.spill_dir, '{}-{}-{}.npy'.format(name, os.getpid(), next(self._counter)))
+        spilled = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=x.shape,
+                                               fortran_order=order == 'F')
+        for i in range(0, x.shape[0], MEMORY_SPILL_CHUNK):
+            chunk = x.iloc[i:i + MEMORY_SPILL_CHUNK] if isinstance(x, pd.DataFrame) else x[i:i + MEMORY_SPILL_CHUNK]
+            spilled[i:i + MEMORY_SPILL_CHUNK] = np.asarray(chunk, dtype=dtype)
+        spilled.flush()
+        del spilled
+        spilled = np.load(path, mmap_mode='r')
+        # The mapping keeps the data until it is released, nothing is left on disk
+        os.remove(path)
+        self._spilled += n_bytes
+        return spilled
+
+
+_budget = None
+
+
+def memory_budget():
+    """
+    :return: the MemoryBudget of the process, with the budget of HOUSE_PRICES_MEMORY
+    """
+    global _budget
+    if _budget is None:
+        _budget = MemoryBudget(parse_budget(os.environ.get(MEMORY_ENV)))
+    return _budget
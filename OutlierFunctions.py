@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+
+from constants import *
+
+# %% ~~~~~ OUTLIERS ~~~~~
+# The training sales whose price is far from the one of similar houses are dropped before any fit. A robust linear
+# model of the log price on a few raw columns (Huber weights) gives the residual of every sale, and the fences of the
+# residuals are fitted for every segment (OverallQual, the segments with few sales use the fences of all of them):
+# below Q1 - k * IQR or above Q3 + k * IQR is an outlier. Everything is fitted on the training rows with a few
+# vectorized passes, then the filter is a lookup of the fences of the segment of every row, so the chunks of a stream
+# (e.g. the new sales of RefreshFunctions) are filtered one by one, with the reason of every dropped row.
+# column -> transformation of the columns of the price model, the missing values get the training median
+OUTLIER_FEATURES = {'GrLivArea': 'log', 'LotArea': 'log', 'TotalBsmtSF': 'log1p', 'OverallQual': None,
+                    'OverallCond': None, 'YearBuilt': None, 'GarageCars': None}
+OUTLIER_SEGMENT = 'OverallQual'
+OUTLIER_TARGET = 'SalePrice'
+# k of the fences, 3 for the extreme outliers only
+OUTLIER_IQR_FACTOR = 3
+# Segments with fewer training sales use the fences of all the sales
+OUTLIER_MIN_SEGMENT_ROWS = 30
+# Reweighting iterations of the robust fit and Huber threshold (in robust standard deviations)
+OUTLIER_HUBER_ITERATIONS = 5
+OUTLIER_HUBER_DELTA = 1.345
+
+_TRANSFORMS = {None: lambda x: x, 'log': np.log, 'log1p': np.log1p}
+
+
+class OutlierFilter:
+    """
+    Fitted outlier stage of the training sales, e.g.
+    outliers = OutlierFilter().fit(train_df)
+    train_df, dropped = outliers.filter(train_df)
+    """
+
+    def __init__(self, features=None, segment=OUTLIER_SEGMENT, iqr_factor=OUTLIER_IQR_FACTOR,
+                 min_segment_rows=OUTLIER_MIN_SEGMENT_ROWS):
+        self.features = dict(OUTLIER_FEATURES if features is None else features)
+        self.segment = segment
+        self.iqr_factor = iqr_factor
+        self.min_segment_rows = min_segment_rows
+
+    def _design(self, df):
+        columns = [_TRANSFORMS[transform](pd.to_numeric(df[x], errors='coerce').fillna(self.medians_[x]).values)
+                   for x, transform in self.features.items()]
+        return np.column_stack([np.ones(df.shape[0])] + columns)
+
+    def residuals(self, df):
+        """
+        :return: log price minus the log price of the model, NaN without the price
+        """
+        prices = pd.to_numeric(df[OUTLIER_TARGET], errors='coerce').values if OUTLIER_TARGET in df else \
+            np.full(df.shape[0], np.nan)
+        return np.log(prices) - self._design(df) @ self.coefficients_
+
+    def fit(self, df):
+        """
+        :param df: raw training sales, schema of train.csv
+        """
+        self.medians_ = {x: pd.to_numeric(df[x], errors='coerce').median() for x in self.features}
+        x, y = self._design(df), np.log(df[OUTLIER_TARGET].values)
+        weights = np.ones(y.shape[0])
+        for _ in range(OUTLIER_HUBER_ITERATIONS):
+            root = np.sqrt(weights)
+            self.coefficients_ = np.linalg.lstsq(x * root[:, None], y * root, rcond=None)[0]
+            residuals = y - x @ self.coefficients_
+            scale = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+            weights = np.minimum(1, OUTLIER_HUBER_DELTA * scale / np.maximum(np.abs(residuals), 1e-12))
+
+        residuals = pd.Series(residuals)
+        segments = df[self.segment].reset_index(drop=True)
+        quartiles = residuals.groupby(segments).quantile([0.25, 0.75]).unstack()
+        quartiles = quartiles[residuals.groupby(segments).size() >= self.min_segment_rows]
+        self.fences_ = self._fences(quartiles[0.25], quartiles[0.75])
+        self.default_fences_ = self._fences(*residuals.quantile([0.25, 0.75]))
+        return self
+
+    def _fences(self, q1, q3):
+        iqr = q3 - q1
+        return {'low': q1 - self.iqr_factor * iqr, 'high': q3 + self.iqr_factor * iqr}
+
+    def _detect(self, df):
+        residuals = pd.Series(self.residuals(df), index=df.index)
+        segments = df[self.segment]
+        low = segments.map(self.fences_['low']).fillna(self.default_fences_['low'])
+        high = segments.map(self.fences_['high']).fillna(self.default_fences_['high'])
+        outliers = ((residuals < low) | (residuals > high)).values
+        report = pd.DataFrame({'Id': df['Id'] if 'Id' in df else df.index.to_series(), 'segment': segments,
+                               'residual': residuals, 'low': low, 'high': high})[outliers]
+        report['reason'] = ['price {:.0f}% {} the model, out of the fences of {} {} ({:+.2f}, {:+.2f})'.format(
+            100 * abs(np.expm1(residual)), 'under' if residual < 0 else 'over', self.segment, segment, low, high)
+            for segment, residual, low, high in zip(report['segment'], report['residual'], report['low'],
+                                                    report['high'])]
+        return outliers, report
+
+    def detect(self, df):
+        """
+        :return: the report of the outliers of df (Id, segment, residual of the log price, fences and reason), with the
+                 index of df
+        """
+        return self._detect(df)[1]
+
+    def filter(self, df):
+        """
+        :return: the rows of df that are not outliers and the report of the dropped ones (see detect)
+        """
+        outliers, report = self._detect(df)
+        return df[~outliers], report
@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from constants import *
+
+# %% ~~~~~ PREDICTION CACHE ~~~~~
+# The same listings are scored again and again (relistings, repeated queries, nightly rescoring of the inventory).
+# The blended prediction of a row (features transform and members, the expensive part) is cached under the canonical
+# hash of its raw values (without the Id, with the columns in a fixed order and the types of the training schema) and
+# the version of the artifact (hash of the features state and of the models).
+# The post-processing is applied after the cache, so the thresholds refreshed by update_thresholds do not invalidate it.
+# The cache is an LRU in memory, optionally backed by a SQLite file shared by the runs (LRU as well, on the time of the
+# last read from disk).
+PREDICTION_CACHE_FILE = Path(predictions_dir, 'prediction_cache.sqlite')
+# Rows kept in memory (about 150 bytes each)
+PREDICTION_CACHE_SIZE = 1000000
+# Rows kept on disk
+PREDICTION_CACHE_DISK_SIZE = 20000000
+# Seconds a writer waits for the lock of the file
+PREDICTION_CACHE_TIMEOUT = 60
+
+# Parameters of a single query, below the limit of the older SQLite versions
+_BATCH = 900
+
+
+def artifact_version(artifact):
+    """
+    :return: hash of what the predictions of a scoring artifact depend on (not the post-processing thresholds)
+    """
+    return joblib.hash([artifact['features'], artifact['models']])
+
+
+def row_hashes(raw_df, raw_dtypes):
+    """
+    :param raw_dtypes: dict column -> dtype of the raw training rows (see FeaturesPipeline.encode_features)
+    :return: uint64 hash of every row, the same for the same values whatever the Id, the column order and the dtypes
+             inferred for the chunk (e.g. a column without values read as float)
+    """
+    canonical = {}
+    for x in sorted(raw_dtypes):
+        values = raw_df[x] if x in raw_df else pd.Series(np.nan, index=raw_df.index)
+        if raw_dtypes[x] == 'object':
+            canonical[x] = values.astype(object).where(values.notna(), None)
+        else:
+            canonical[x] = pd.to_numeric(values, errors='coerce').astype(np.float64)
+    return pd.util.hash_pandas_object(pd.DataFrame(canonical), index=False).values
+
+
+class PredictionCache:
+
+    def __init__(self, max_entries=PREDICTION_CACHE_SIZE, path=None, max_disk_entries=PREDICTION_CACHE_DISK_SIZE,
+                 timeout=PREDICTION_CACHE_TIMEOUT):
+        """
+        :param path: SQLite file backing the cache (e.g. PREDICTION_CACHE_FILE), None for memory only
+        """
+        self.max_entries = max_entries
+        self.path = Path(path) if path is not None else None
+        self.max_disk_entries = max_disk_entries
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # The workers of score_stream share the cache
+        self._lock = threading.Lock()
+        if self.path is not None:
+            os.makedirs(self.path.parent, exist_ok=True)
+            with closing(self._connect()) as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS predictions (version TEXT, row INTEGER, prediction REAL, "
+                             "used_at REAL, PRIMARY KEY (version, row))")
+                conn.execute("CREATE INDEX IF NOT EXISTS predictions_used_at ON predictions (used_at)")
+                # Upper bound of the rows on disk, counted again only when it gets above the limit
+                self._disk_entries = conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    def _connect(self):
+        return sqlite3.connect(str(self.path), timeout=self.timeout)
+
+    def _read_disk(self, version, hashes):
+        # SQLite integers are signed
+        rows = np.asarray(hashes, dtype=np.uint64).view(np.int64).tolist()
+        found = {}
+        with closing(self._connect()) as conn, conn:
+            for i in range(0, len(rows), _BATCH):
+                batch = rows[i:i + _BATCH]
+                query = "SELECT row, prediction FROM predictions WHERE version = ? AND row IN ({})".format(
+                    ','.join('?' * len(batch)))
+                found.update(conn.execute(query, [version] + batch).fetchall())
+            now = time.time()
+            conn.executemany("UPDATE predictions SET used_at = ? WHERE version = ? AND row = ?",
+                             [(now, version, row) for row in found])
+        return {row % 2 ** 64: prediction for row, prediction in found.items()}
+
+    def get(self, version, hashes):
+        """
+        :param hashes: see row_hashes
+        :return: the cached predictions of the rows, NaN for the ones not cached
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64).tolist()
+        predictions = np.full(len(hashes), np.nan)
+        missing = []
+        with self._lock:
+            for i, row in enumerate(hashes):
+                prediction = self.entries.get((version, row))
+                if prediction is None:
+                    missing.append(i)
+                else:
+                    self.entries.move_to_end((version, row))
+                    predictions[i] = prediction
+            self.hits += len(hashes) - len(missing)
+        if missing and self.path is not None:
+            found = self._read_disk(version, [hashes[i] for i in missing])
+            with self._lock:
+                for i in missing:
+                    if hashes[i] in found:
+                        predictions[i] = found[hashes[i]]
+                        self._put_memory(version, hashes[i], predictions[i])
+                        self.disk_hits += 1
+        with self._lock:
+            self.misses += int(np.isnan(predictions).sum())
+        return predictions
+
+    def _put_memory(self, version, row, prediction):
+        self.entries[(version, row)] = float(prediction)
+        self.entries.move_to_end((version, row))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put(self, version, hashes, predictions):
+        hashes = np.asarray(hashes, dtype=np.uint64).tolist()
+        with self._lock:
+            for row, prediction in zip(hashes, predictions):
+                self._put_memory(version, row, prediction)
+        if self.path is None:
+            return
+        now = time.time()
+        rows = np.asarray(hashes, dtype=np.uint64).view(np.int64).tolist()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+                             [(version, row, float(prediction), now) for row, prediction in zip(rows, predictions)])
+            with self._lock:
+                self._disk_entries += len(rows)
+                recount = self._disk_entries > self.max_disk_entries
+            if recount:
+                count = conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+                if count > self.max_disk_entries:
+                    conn.execute("DELETE FROM predictions WHERE rowid IN "
+                                 "(SELECT rowid FROM predictions ORDER BY used_at LIMIT ?)",
+                                 (count - self.max_disk_entries,))
+                with self._lock:
+                    self._disk_entries = min(count, self.max_disk_entries)
+
+    def stats(self):
+        """
+        :return: dict with the hits (from memory and from disk), the misses and the hit rate of the lookups so far
+        """
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'entries': len(self.entries)}
@@ -0,0 +1,152 @@
+import html
+import os
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from constants import *
+
+# %% ~~~~~ DATASET PROFILE ~~~~~
+# The statistics of every column of a train and a test file, computed together after a single read of each file:
+# missing values, distinct values, skewness and quantiles of the numeric columns, counts of the levels in train and
+# test of the categorical columns (and of the numeric ones with few values), with the levels found only in one of them.
+# The profile is cached under the size and modification time of the files, and rendered as a static HTML report.
+PROFILE_DIR = Path(predictions_dir, 'profile')
+PROFILE_REPORT = Path(PROFILE_DIR, 'report.html')
+# Numeric columns with at most this many distinct values are profiled as levels as well
+PROFILE_MAX_LEVELS = 30
+# Levels shown in the report for every column, the most frequent ones
+PROFILE_REPORT_LEVELS = 15
+PROFILE_QUANTILES = [0.0, 0.01, 0.25, 0.5, 0.75, 0.99, 1.0]
+# Bump to invalidate the cached profiles when the statistics change
+PROFILE_VERSION = 2
+
+_IGNORED_COLUMNS = ['Id']
+
+
+def _files_key(paths):
+    stats = [(str(Path(path).resolve()), os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths]
+    return joblib.hash([PROFILE_VERSION, PROFILE_MAX_LEVELS, PROFILE_QUANTILES, stats])
+
+
+def count_levels(train_df, test_df, column):
+    """
+    :return: the count of every level of the column (missing values included) in train and test, most frequent first
+    """
+    counts = pd.DataFrame({
+        'train': train_df[column].value_counts(dropna=False) if column in train_df else pd.Series(dtype=np.int64),
+        'test': test_df[column].value_counts(dropna=False) if column in test_df else pd.Series(dtype=np.int64)})
+    counts = counts.fillna(0).astype(np.int64).rename_axis('level').reset_index()
+    return counts.sort_values(['train', 'test'], ascending=False, ignore_index=True)
+
+
+def profile_frames(train_df, test_df, max_levels=PROFILE_MAX_LEVELS):
+    """
+    :return: dict with 'columns' (one row of statistics per column) and 'levels' (counts of every level of every
+             categorical column, in train and test)
+    """
+    train_df = train_df.drop(columns=_IGNORED_COLUMNS, errors='ignore')
+    test_df = test_df.drop(columns=_IGNORED_COLUMNS, errors='ignore')
+    columns = list(train_df.columns) + [x for x in test_df.columns if x not in train_df]
+    numeric = [x for x in columns
+               if all(pd.api.types.is_numeric_dtype(df[x]) for df in (train_df, test_df) if x in df)]
+    # Only the numeric columns are concatenated, the levels of the others are counted in each file
+    numeric_df = pd.concat([train_df.reindex(columns=numeric), test_df.reindex(columns=numeric)], ignore_index=True)
+
+    table = pd.DataFrame(index=pd.Index(columns, name='column'))
+    table['dtype'] = [str(train_df[x].dtype if x in train_df else test_df[x].dtype) for x in columns]
+    table['nan_train'] = train_df.isna().sum().reindex(columns).astype('Int64')
+    table['nan_test'] = test_df.isna().sum().reindex(columns).astype('Int64')
+    table['nan_share'] = (table['nan_train'].fillna(0) + table['nan_test'].fillna(0)) / (len(train_df) + len(test_df))
+    table['distinct'] = numeric_df.nunique().reindex(columns).astype('Int64')
+    if numeric:
+        table['skew'] = numeric_df.skew()
+        table['zero_share'] = (numeric_df == 0).mean()
+        quantiles = numeric_df.quantile(PROFILE_QUANTILES).T
+        quantiles.columns = ['q{:g}'.format(q * 100) for q in PROFILE_QUANTILES]
+        table = table.join(quantiles)
+    del numeric_df
+
+    levels = []
+    for x in columns:
+        if x in numeric and table.at[x, 'distinct'] > max_levels:
+            continue
+        counts = count_levels(train_df, test_df, x)
+        table.at[x, 'distinct'] = counts['level'].notna().sum()
+        counts.insert(0, 'column', x)
+        levels.append(counts)
+    levels = pd.concat(levels, ignore_index=True) if levels else pd.DataFrame(
+        columns=['column', 'level', 'train', 'test'])
+    levels = levels.sort_values(['column', 'train', 'test'], ascending=[True, False, False], ignore_index=True)
+    # The missing values are not levels only in train or test, they are counted by nan_train and nan_test
+    present = levels['level'].notna()
+    levels['level'] = levels['level'].astype(str)
+
+    only_train = levels[present & (levels['train'] > 0) & (levels['test'] == 0)].groupby('column')['level'].apply(list)
+    only_test = levels[present & (levels['train'] == 0) & (levels['test'] > 0)].groupby('column')['level'].apply(list)
+    table['levels_only_train'] = only_train.reindex(columns)
+    table['levels_only_test'] = only_test.reindex(columns)
+    return {'columns': table, 'levels': levels, 'rows': (train_df.shape[0], test_df.shape[0])}
+
+
+def profile_dataset(train_path, test_path, cache_dir=PROFILE_DIR):
+    """
+    The profile of the files (see profile_frames), from the cache if they did not change.
+    """
+    path = Path(cache_dir, '{}.joblib'.format(_files_key([train_path, test_path])))
+    if path.exists():
+        return joblib.load(path)
+    profile = profile_frames(pd.read_csv(train_path, low_memory=False), pd.read_csv(test_path, low_memory=False))
+    os.makedirs(cache_dir, exist_ok=True)
+    joblib.dump(profile, path)
+    return profile
+
+
+def describe_column(profile, column):
+    """
+    :return: the statistics and the levels of a column, e.g. for the console
+    """
+    levels = profile['levels'][profile['levels']['column'] == column].drop(columns='column')
+    return "{}\n\n{}".format(profile['columns'].loc[column].dropna().to_string(),
+                             levels.to_string(index=False) if len(levels)
+                             else 'No levels in the profile (more than PROFILE_MAX_LEVELS values)')
+
+
+def _bars(levels):
+    # Share of the rows of train and test of every level, as horizontal bars
+    rows = []
+    totals = levels[['train', 'test']].sum().replace(0, 1)
+    for level, train, test in levels[['level', 'train', 'test']].values:
+        bars = ''.join('<div class="bar {}" style="width:{:.1f}%"></div>'.format(name, 100 * count / totals[name])
+                       for name, count in (('train', train), ('test', test)))
+        rows.append('<tr><td>{}</td><td>{}</td><td>{}</td><td class="bars">{}</td></tr>'.format(
+            html.escape(level), train, test, bars))
+    return '<table><tr><th>level</th><th>train</th><th>test</th><th></th></tr>{}</table>'.format(''.join(rows))
+
+
+def write_report(profile, path=PROFILE_REPORT, n_levels=PROFILE_REPORT_LEVELS):
+    """
+    Writes the profile as a single static HTML page: the table of the columns, then the levels of every column.
+    """
+    table = profile['columns']
+    sections = []
+    for x in table.index:
+        levels = profile['levels'][profile['levels']['column'] == x]
+        if len(levels):
+            hidden = len(levels) - n_levels
+            sections.append('<h3 id="{0}">{0}</h3>{1}{2}'.format(
+                html.escape(x), _bars(levels.head(n_levels)),
+                '<p>{} more levels</p>'.format(hidden) if hidden > 0 else ''))
+    style = ('body{font-family:sans-serif;font-size:13px} table{border-collapse:collapse;margin-bottom:8px}'
+             'td,th{border:1px solid #ddd;padding:2px 6px;text-align:right} .bars{width:240px;text-align:left}'
+             '.bar{height:6px;margin:1px 0} .bar.train{background:#4c72b0} .bar.test{background:#dd8452}')
+    page = ('<html><head><meta charset="utf-8"><style>{}</style></head><body>'
+            '<h1>Dataset profile</h1><p>{} train rows, {} test rows, {} columns</p>{}<h2>Levels</h2>{}'
+            '</body></html>').format(style, profile['rows'][0], profile['rows'][1], len(table),
+                                     table.to_html(float_format='{:.3f}'.format, na_rep=''), ''.join(sections))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(page)
+    return path
@@ -0,0 +1,211 @@
+import os
+import time
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.metrics import mean_squared_log_error
+
+from FeaturesPipeline import fit_group_statistics, update_group_statistics, group_fills_from_statistics, \
+    transform_features
+from LinearFunctions import accumulate_statistics, fit_linear_models
+from OutlierFunctions import OutlierFilter
+from RegressionFunctions import RIDGE_ALPHAS, BAYES_N_ITER, matrix_chunks, predict_members, blend, post_average
+from ScoringFunctions import build_scoring_artifact
+from SketchFunctions import QuantileSketch
+
+# %% ~~~~~ INCREMENTAL REFRESH ~~~~~
+# The training store is a directory with all the labeled raw sales (sales.csv, schema of train.csv) and the state of
+# the last fit. Every refresh appends the new sales, updates in place the group fills of the features transform and
+# the sufficient statistics of the Ridge and BayesianRidge members, and refits them from the statistics (seconds).
+# The other members (lasso, elastic net, gradient boosting, stack) and the rest of the features transform are
+# refitted from scratch only when the sales are too many, too old or drifted with respect to the last full fit.
+# The outliers of the new sales are dropped before they are added, with the OutlierFilter of the last full fit, and
+# kept aside: every full fit refits the filter on all the labeled sales (the outliers included, a filter fitted on
+# filtered sales would have narrower fences at every refit) and splits them again.
+STORE_SALES = 'sales.csv'
+STORE_OUTLIERS = 'outliers.csv'
+STORE_STATE = 'refresh_state.joblib'
+
+# New sales, as a fraction of the sales of the last full fit, that trigger a full refit
+REFRESH_MAX_NEW_FRACTION = 0.2
+# Days after the last full fit that trigger a full refit
+REFRESH_MAX_DAYS = 30
+# Population stability index of the new prices (against the prices of the last full fit) that triggers a full refit
+REFRESH_MAX_PSI = 0.2
+# New sales needed before the population stability index is considered
+REFRESH_MIN_DRIFT_ROWS = 200
+DRIFT_BINS = 10
+
+
+def _store_paths(store_dir):
+    return Path(store_dir, STORE_SALES), Path(store_dir, STORE_STATE)
+
+
+def _outliers_path(store_dir):
+    return Path(store_dir, STORE_OUTLIERS)
+
+
+def _split_outliers(store_dir, labeled):
+    """
+    Fits the OutlierFilter on all the labeled sales and writes the kept ones and the outliers in the store.
+    :return: the fitted filter and the kept sales
+    """
+    outliers = OutlierFilter().fit(labeled)
+    sales, dropped = outliers.filter(labeled)
+    sales.to_csv(_store_paths(store_dir)[0], index=False)
+    labeled.loc[dropped.index].to_csv(_outliers_path(store_dir), index=False)
+    return outliers, sales.reset_index(drop=True)
+
+
+def load_store_state(store_dir):
+    return joblib.load(_store_paths(store_dir)[1])
+
+
+def _save_store_state(store_dir, state):
+    joblib.dump(state, _store_paths(store_dir)[1])
+
+
+def _drift_edges(target_sketch):
+    return np.array([target_sketch.quantile(q) for q in np.arange(1, DRIFT_BINS) / DRIFT_BINS])
+
+
+def population_stability_index(counts):
+    """
+    :param counts: new prices in each of the DRIFT_BINS equally populated bins of the prices of the last full fit
+    """
+    expected = 1. / DRIFT_BINS
+    actual = np.maximum(counts / max(counts.sum(), 1), 1e-4)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def full_refit(store_dir, features_config):
+    """
+    Fits the features transform and all the members on every sale of the store, as build_scoring_artifact, with the
+    Ridge and BayesianRidge members fitted from the sufficient statistics that the next refreshes will update.
+    """
+    sales_path, _ = _store_paths(store_dir)
+    outliers_path = _outliers_path(store_dir)
+    labeled = pd.concat([pd.read_csv(sales_path)] + ([pd.read_csv(outliers_path)] if outliers_path.exists() else []),
+                        ignore_index=True)
+    outliers, sales = _split_outliers(store_dir, labeled)
+    y = np.log1p(sales['SalePrice'].values)
+
+    artifact = build_scoring_artifact(sales, sales['SalePrice'].values, features_config)
+    x = transform_features(sales, artifact['features'])
+    linear_statistics = accumulate_statistics(matrix_chunks(x, y))
+    artifact['models'].update(fit_linear_models(linear_statistics, RIDGE_ALPHAS, BAYES_N_ITER))
+
+    group_statistics = fit_group_statistics(sales)
+    artifact['features']['group_fills'] = group_fills_from_statistics(group_statistics)
+
+    state = {
+        'artifact': artifact,
+        'outliers': outliers,
+        'features_config': features_config,
+        'group_statistics': group_statistics,
+        'linear_statistics': linear_statistics,
+        'target_sketch': QuantileSketch().update(y),
+        'drift_counts': np.zeros(DRIFT_BINS),
+        'fitted_rows': sales.shape[0],
+        'fitted_at': time.time(),
+        'rows': sales.shape[0],
+        'history': [],
+    }
+    _save_store_state(store_dir, state)
+    return state
+
+
+def create_store(store_dir, raw_train_df, features_config):
+    """
+    :param raw_train_df: all the labeled raw sales, the outliers included (they are split by full_refit)
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    raw_train_df.to_csv(_store_paths(store_dir)[0], index=False)
+    return full_refit(store_dir, features_config)
+
+
+def refresh_reasons(state, now=None):
+    now = time.time() if now is None else now
+    new_rows = state['rows'] - state['fitted_rows']
+    reasons = []
+    if new_rows > REFRESH_MAX_NEW_FRACTION * state['fitted_rows']:
+        reasons.append('{} new sales'.format(new_rows))
+    if new_rows and now - state['fitted_at'] > REFRESH_MAX_DAYS * 24 * 3600:
+        reasons.append('{:.0f} days since the last full fit'.format((now - state['fitted_at']) / 24 / 3600))
+    if new_rows >= REFRESH_MIN_DRIFT_ROWS:
+        psi = population_stability_index(state['drift_counts'])
+        if psi > REFRESH_MAX_PSI:
+            reasons.append('prices drift (PSI {:.3f})'.format(psi))
+    return reasons
+
+
+def refresh(store_dir, new_sales_df, now=None):
+    """
+    Appends the new labeled sales (without their outliers) to the store and updates the models, with a full refit if
+    needed.
+    :return: the record of the refresh (also kept in the history of the store), with the error of the models on all
+             the new sales before they were added and the outliers dropped from them
+    """
+    start = time.time()
+    sales_path, _ = _store_paths(store_dir)
+    state = load_store_state(store_dir)
+    artifact = state['artifact']
+
+    # The new sales are still unseen: their error is an honest estimate of the current accuracy, the outliers included
+    error = np.sqrt(mean_squared_log_error(new_sales_df['SalePrice'], predict_artifact(artifact, new_sales_df)))
+
+    columns = pd.read_csv(sales_path, nrows=0).columns
+    kept_df, dropped = new_sales_df, None
+    if state.get('outliers') is not None:
+        kept_df, dropped = state['outliers'].filter(new_sales_df)
+    if dropped is not None and not dropped.empty:
+        outliers_path = _outliers_path(store_dir)
+        new_sales_df.loc[dropped.index].to_csv(outliers_path, mode='a', header=not outliers_path.exists(),
+                                               index=False, columns=columns)
+    new_sales_df = kept_df
+    new_sales_df.to_csv(sales_path, mode='a', header=False, index=False, columns=columns)
+    state['rows'] += new_sales_df.shape[0]
+
+    y_new = np.log1p(new_sales_df['SalePrice'].values)
+    state['drift_counts'] += np.bincount(np.searchsorted(_drift_edges(state['target_sketch']), y_new),
+                                         minlength=DRIFT_BINS)
+
+    reasons = refresh_reasons(state, now)
+    if reasons:
+        history = state['history']
+        state = full_refit(store_dir, state['features_config'])
+        state['history'] = history
+    else:
+        update_group_statistics(state['group_statistics'], new_sales_df)
+        artifact['features']['group_fills'] = group_fills_from_statistics(state['group_statistics'])
+        state['linear_statistics'].update(transform_features(new_sales_df, artifact['features']), y_new)
+        artifact['models'].update(fit_linear_models(state['linear_statistics'], RIDGE_ALPHAS, BAYES_N_ITER))
+
+    record = {'new_rows': new_sales_df.shape[0], 'rows': state['rows'], 'error_before': error,
+              'full_refit': reasons, 'seconds': time.time() - start,
+              'outliers': [] if dropped is None else dropped[['Id', 'reason']].to_dict('records')}
+    state['history'].append(record)
+    _save_store_state(store_dir, state)
+    return record
+
+
+def predict_artifact(artifact, raw_df):
+    x = transform_features(raw_df, artifact['features'])
+    return post_average(blend(predict_members(artifact['models'], x)), thresholds=artifact['thresholds'])
+
+
+def compare_with_full_retrain(store_dir, holdout_df):
+    """
+    Errors on labeled holdout sales of the incrementally refreshed models and of a full retrain on the same sales
+    (the full retrain is not saved in the store).
+    """
+    state = load_store_state(store_dir)
+    sales = pd.read_csv(_store_paths(store_dir)[0])
+    retrained = build_scoring_artifact(sales, sales['SalePrice'].values, state['features_config'])
+
+    errors = {}
+    for name, artifact in [('incremental', state['artifact']), ('full', retrained)]:
+        errors[name] = np.sqrt(mean_squared_log_error(holdout_df['SalePrice'], predict_artifact(artifact, holdout_df)))
+    return errors
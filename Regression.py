@@ -1,62 +1,157 @@
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
 
-from sklearn.metrics import mean_squared_log_error
-from sklearn.model_selection import train_test_split
-
-from FeaturesEngineering import get_engineered_train_test
+from BlendFunctions import blend_errors, get_oof_predictions, optimize_blend_weights, save_blend_weights, load_blend_weights
+from BufferFunctions import CopyCounter
+from EvaluationFunctions import evaluate_configs
+from ExperimentFunctions import ExperimentStore
+from FeaturesEngineering import get_engineered_train_test, get_features_config
+from MemoryFunctions import memory_budget
+from PredictionCacheFunctions import PREDICTION_CACHE_FILE, PredictionCache
 from RegressionFunctions import *
+from RefreshFunctions import create_store, refresh
+from TuningFunctions import run_tuning
+from ScoringFunctions import build_scoring_artifact, save_artifact, score_stream, update_thresholds
 from constants import *
 
 # %% Prepare data
 ((train_ids, x_train, y_train), (test_ids, x_test)) = get_engineered_train_test()
 
 # -------------------------------------- DEV --------------------------------------
-NUMBER_OF_RANDOM_SPLITS = 50
-TEST_SIZE = 0.50
 PERFORM_VALIDATION = False
+# Paired comparison of the optimized blend weights with the hand-tuned ones, on the same folds
+PERFORM_COMPARISON = False
 PERFORM_PREDICTIONS = True
+PERFORM_TUNING = False
+PERFORM_BLEND_OPTIMIZATION = False
+PERFORM_BATCH_SCORING = False
+PERFORM_INCREMENTAL_REFRESH = False
+# Best configurations evaluated so far, read from the experiment store without fitting anything
+SHOW_EXPERIMENTS = False
+# Count the full-matrix copies made by the estimators during the predictions run (see BufferFunctions), debug only:
+# it wraps the validation of sklearn and walks the stack on every call
+COUNT_MATRIX_COPIES = False
 
+# Streaming scoring of a raw listings dump (same schema of test.csv), .csv or .parquet
+BATCH_SCORING_INPUT = Path(dataset_dir, 'test.csv')
+BATCH_SCORING_OUTPUT = Path(predictions_dir, 'predictions_batch.csv')
+SCORING_ARTIFACT = Path(predictions_dir, 'scoring_artifact.joblib')
+# Cache of the predictions of the rows already scored by this artifact, on disk across the runs (None for no cache)
+PREDICTION_CACHE = PREDICTION_CACHE_FILE
 
-def get_error_random_dev(title=""):
-    if title:
-        print(title)
-
-    # %% Split into train and dev
-    x_dev, x_val, y_dev, y_val = train_test_split(
-        x_train, y_train, test_size=TEST_SIZE)
-
-    predictions_dev = fit_predict(x_dev, y_dev, x_val)
+# Out-of-fold predictions of the members (computed once) and the blend weights optimized on them
+OOF_PREDICTIONS = Path(predictions_dir, 'oof_predictions.npz')
+BLEND_WEIGHTS_FILE = Path(predictions_dir, 'blend_weights.json')
+# Predict with the optimized weights of BLEND_WEIGHTS_FILE instead of the hand-tuned BLEND_WEIGHTS
+APPLY_BLEND_WEIGHTS = False
 
-    # %% Compute error on DEV
-    y_val = np.expm1(y_val)
-    err = np.sqrt(mean_squared_log_error(y_val, predictions_dev))
+# Daily labeled sales (same schema of train.csv) added to the training store
+NEW_SALES = Path(dataset_dir, 'new_sales.csv')
+TRAINING_STORE = Path(predictions_dir, 'training_store')
 
-    print("ERROR on validation set: {}".format(err))
-    return err
+# Every validation and prediction run is recorded in it, the folds already evaluated are read instead of fitted
+experiments = ExperimentStore()
 
 
 if PERFORM_VALIDATION:
     print("Performing validation")
-    dev_errors = [get_error_random_dev("{}/{}".format(i + 1, NUMBER_OF_RANDOM_SPLITS)) for i in
-                  range(NUMBER_OF_RANDOM_SPLITS)]
-    print("\n\nDEV ERROR ~ Stats over {} random splits with {} test\n"
+    validation = evaluate_configs(x_train, y_train, {'fit_predict': fit_predict}, store=experiments,
+                                  features=get_features_config())
+    print("\n\nDEV ERROR ~ Stats over {} folds of the seeded evaluation plan\n"
           "> mean: {}\n"
-          "> variance: {}\n"
-          "> stdev: {}\n\n".format(NUMBER_OF_RANDOM_SPLITS,
-                                   TEST_SIZE,
-                                   np.mean(dev_errors),
-                                   np.var(dev_errors),
-                                   np.std(dev_errors)))
+          "> stdev: {}\n\n".format(validation['folds'][0], validation['error'][0], validation['std'][0]))
     print("Done validating")
 
 
+# -------------------------------------- TUNING --------------------------------------
+# The config is written in TUNED_CONFIG_FILE and used by every following fit_predict
+if PERFORM_TUNING:
+    print("Performing hyperparameters tuning")
+    tuned_config = run_tuning(TUNED_CONFIG_FILE, x_train, y_train)
+    print("GBR: {}\nStack: {}\nErrors: {}".format(tuned_config['gbr'], tuned_config['stack'], tuned_config['errors']))
+    print("Done tuning")
+
+
+# -------------------------------------- BLEND --------------------------------------
+if PERFORM_BLEND_OPTIMIZATION:
+    print("Performing blend optimization")
+    oof_predictions = get_oof_predictions(OOF_PREDICTIONS, x_train, y_train)
+    optimized_weights, oof_error = optimize_blend_weights(oof_predictions)
+    save_blend_weights(optimized_weights, BLEND_WEIGHTS_FILE)
+    print("Weights: {}\nOOF error: {} (hand-tuned: {})".format(
+        optimized_weights, oof_error, blend_errors(oof_predictions, list(BLEND_WEIGHTS.values()))[0]))
+    print("Done optimizing")
+
+optimized_weights = load_blend_weights(BLEND_WEIGHTS_FILE) if BLEND_WEIGHTS_FILE.exists() else None
+if APPLY_BLEND_WEIGHTS and optimized_weights is None:
+    raise FileNotFoundError("APPLY_BLEND_WEIGHTS needs the optimized weights in {}".format(BLEND_WEIGHTS_FILE))
+blend_weights = optimized_weights if APPLY_BLEND_WEIGHTS else None
+
+if PERFORM_COMPARISON and optimized_weights is not None:
+    print("Performing comparison")
+    comparison = evaluate_configs(x_train, y_train, {'hand-tuned': fit_predict,
+                                                     'optimized': partial(fit_predict, weights=optimized_weights)},
+                                  store=experiments, features=get_features_config())
+    print(comparison.to_string(float_format='{:.5f}'.format))
+    print("{} fits".format(comparison.attrs['fits']))
+    print("Done comparing")
+
+
+if SHOW_EXPERIMENTS:
+    print(experiments.best_configs().drop(columns=['model', 'features']).to_string(float_format='{:.5f}'.format))
+
+
 # -------------------------------------- TEST --------------------------------------
 if PERFORM_PREDICTIONS:
     print("Performing predictions")
-    predictions_test = fit_predict(x_train, y_train, x_test)
+    print("Blend weights: {} ({})".format(BLEND_WEIGHTS if blend_weights is None else blend_weights,
+                                          BLEND_WEIGHTS_FILE if APPLY_BLEND_WEIGHTS else 'hand-tuned BLEND_WEIGHTS'))
+    timings = {}
+    copies = CopyCounter(x_train.size) if COUNT_MATRIX_COPIES else nullcontext()
+    with copies:
+        predictions_test = fit_predict(x_train, y_train, x_test, blend_weights, timings)
+    if COUNT_MATRIX_COPIES:
+        print("Full-matrix copies: {}\n{}".format(copies.count, copies.summary().to_string(index=False)))
+    experiments.add_run(experiments.register('fit_predict', partial(fit_predict, weights=blend_weights), x_train,
+                                             y_train, get_features_config()), 'predictions', 1, timings)
 
     predictions_df = pd.DataFrame()
     predictions_df.insert(0, 'Id', test_ids)
     predictions_df['SalePrice'] = predictions_test
     predictions_df.to_csv(Path(predictions_dir, 'predictions_test.csv'), index=False)
+    if memory_budget().limit:
+        print(memory_budget().report())
+    print("DONE")
+
+
+# -------------------------------------- BATCH SCORING --------------------------------------
+if PERFORM_BATCH_SCORING:
+    raw_train_df = pd.read_csv(Path(dataset_dir, 'train.csv'))
+    raw_train_df = raw_train_df.set_index('Id', drop=False).loc[train_ids].reset_index(drop=True)
+
+if PERFORM_BATCH_SCORING:
+    print("Performing batch scoring")
+    artifact = build_scoring_artifact(raw_train_df, y_train, get_features_config())
+    save_artifact(artifact, SCORING_ARTIFACT)
+
+    cache = PredictionCache(path=PREDICTION_CACHE) if PREDICTION_CACHE is not None else None
+    scored_rows, scored_sketch = score_stream(artifact, BATCH_SCORING_INPUT, BATCH_SCORING_OUTPUT, cache=cache)
+    print("Scored {} rows into {}".format(scored_rows, BATCH_SCORING_OUTPUT))
+    if cache is not None:
+        print("Prediction cache: {}".format(cache.stats()))
+
+    # The next runs clip with the quantiles of everything scored so far
+    save_artifact(update_thresholds(artifact, scored_sketch), SCORING_ARTIFACT)
+    print("DONE")
+
+
+# -------------------------------------- INCREMENTAL REFRESH --------------------------------------
+if PERFORM_INCREMENTAL_REFRESH:
+    print("Performing incremental refresh")
+    if not TRAINING_STORE.exists():
+        # All the labeled sales, the store splits the outliers with its own filter
+        create_store(TRAINING_STORE, pd.read_csv(Path(dataset_dir, 'train.csv')), get_features_config())
+    if NEW_SALES.exists():
+        print(refresh(TRAINING_STORE, pd.read_csv(NEW_SALES)))
     print("DONE")
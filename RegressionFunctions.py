@@ -1,3 +1,8 @@
+import json
+import os
+import time
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
 from mlxtend.regressor import StackingCVRegressor
@@ -7,7 +12,54 @@ from sklearn.model_selection import KFold
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import RobustScaler
 
+from BufferFunctions import feature_buffer
+from CheckpointFunctions import CheckpointStore, fit_estimators, fit_stack
+from EncodingFunctions import add_target_encoder, target_code_columns
+from LinearFunctions import accumulate_statistics, fit_linear_models, STATISTICS_CHUNK_SIZE
+from MemoryFunctions import memory_budget
+from ResourceFunctions import split_cores, limit_threads
+from SketchFunctions import QuantileSketch
+from TreesFunctions import flatten_gradient_boosting_models
+from constants import *
+
 RANDOM_STATE = 42
+# Predict with the array-based copy of the fitted GradientBoostingRegressors (same outputs, lower latency)
+FLATTEN_TREES = True
+# Fit the Ridge and BayesianRidge members from sufficient statistics accumulated chunk by chunk (see LinearFunctions)
+OUT_OF_CORE_LINEAR = False
+BAYES_N_ITER = 10000
+# Persist every fitted member and stacking fold as soon as it completes, a rerun (or another machine sharing the
+# directory) resumes from them and the unchanged models are loaded instead of fitted (see CheckpointFunctions)
+CHECKPOINT_FITS = True
+
+# Folds of the CV-tuned members
+CV_FOLDS = 20
+
+RIDGE_ALPHAS = list(np.linspace(4, 15, 50)) + [14.49, 14.61, 14.69, 14.81, 14.89, 15.01, 15.09, 15.21, 15.29, 15.41,
+                                               15.490]
+
+LASSO_ALPHAS = list(np.linspace(0.0001, 3, 100)) + [0.000051, 0.00009, 0.00021, 0.00029, 0.00041, 0.00051, 0.00059,
+                                                    0.00071, 0.00078]
+
+E_L1RATIO = list(np.linspace(0.1, 1, 20)) + [0.8, 0.85, 0.9, 0.95, 0.99, 1]
+E_ALPHAS = list(np.linspace(0.00095, 1, 20)) + [0.0001, 0.0002, 0.0003, 0.0004, 0.0005, 0.0006, 0.0007]
+
+# Hand-tuned hyperparameters of the GradientBoostingRegressors and alphas of the stack, the ones found by the successive
+# halving search (see TuningFunctions) are written in TUNED_CONFIG_FILE and override them
+GBR_PARAMS = {'n_estimators': 3000, 'learning_rate': 0.02, 'max_depth': 4, 'min_samples_leaf': 15,
+              'min_samples_split': 50}
+STACK_ALPHAS = {'ridge': 7.0, 'lasso': 0.00143, 'meta': 0.0007}
+TUNED_CONFIG_FILE = Path(predictions_dir, 'tuned_config.json')
+
+# Weights of the final blend, summed in this order
+BLEND_WEIGHTS = {
+    'ridge': 0.15,
+    'lasso': 0.15,
+    'elastic': 0.15,
+    'grad': 0.15,
+    'baye': 0.05,
+    'stack': 0.35,
+}
 
 
 # %% Global variables
@@ -16,104 +68,166 @@ def geo_mean_overflow(iterable):
     return np.exp(a.sum() / len(a))
 
 
-def fit_predict(x_train, y_train, x_test):
-    # y_train = quantile_reductions(y_train, max_norm=0.9, min_norm=1.05)
-    y_train = np.log1p(y_train)
+def load_tuned_config(path=TUNED_CONFIG_FILE):
+    """
+    :return: dict with the 'gbr' params and the 'stack' alphas, the hand-tuned ones updated with the tuned ones in path
+    """
+    config = {'gbr': dict(GBR_PARAMS), 'stack': dict(STACK_ALPHAS)}
+    if os.path.exists(path):
+        with open(path) as f:
+            tuned = json.load(f)
+        for name in config:
+            config[name].update(tuned.get(name, {}))
+    return config
 
-    kfolds = KFold(n_splits=20, shuffle=True, random_state=RANDOM_STATE)
 
-    ridge_alphas = list(np.linspace(4, 15, 50)) + [14.49, 14.61, 14.69, 14.81, 14.89, 15.01, 15.09, 15.21, 15.29, 15.41,
-                                                   15.490]
+def fit_predict(x_train, y_train, x_test, weights=None, timings=None):
+    """
+    :param weights: blend weights of the members, BLEND_WEIGHTS by default (see BlendFunctions)
+    :param timings: dict filled with the seconds of each stage, e.g. for the ExperimentStore
+    """
+    timings = {} if timings is None else timings
+    start = time.time()
+    models = fit_models(x_train, y_train)
+    timings['fit'] = time.time() - start
+    start = time.time()
+    members_predictions = predict_members(models, x_test)
+    timings['predict'] = time.time() - start
+    start = time.time()
+    predictions = post_average(blend(members_predictions, weights))
+    timings['post_average'] = time.time() - start
+    return predictions
 
-    lasso_alpha = list(np.linspace(0.0001, 3, 100)) + [0.000051, 0.00009, 0.00021, 0.00029, 0.00041, 0.00051, 0.00059,
-                                                       0.00071, 0.00078]
 
-    e_l1ratio = list(np.linspace(0.1, 1, 20)) + [0.8, 0.85, 0.9, 0.95, 0.99, 1]
-    e_alphas = list(np.linspace(0.00095, 1, 20)) + [0.0001, 0.0002, 0.0003, 0.0004, 0.0005, 0.0006, 0.0007]
+def fit_models(x_train, y_train):
+    # y_train = quantile_reductions(y_train, max_norm=0.9, min_norm=1.05)
+    y_train = np.log1p(y_train)
+
+    kfolds = KFold(n_splits=CV_FOLDS, shuffle=True, random_state=RANDOM_STATE)
+    # One job per fold at most, the remaining cores go to the BLAS threads of each job
+    n_jobs, n_threads = split_cores(CV_FOLDS)
+    config = load_tuned_config()
+    # The target encoded categories (see EncodingFunctions) are encoded by the first step of every member
+    target_columns = target_code_columns(x_train)
+    # The sufficient statistics cannot be fitted on the target encoding
+    out_of_core = OUT_OF_CORE_LINEAR and not target_columns
 
-    predictors = [
+    predictors = add_target_encoder([
         make_pipeline(
             RobustScaler(),
-            RidgeCV(alphas=ridge_alphas, cv=kfolds, fit_intercept=True)),
+            RidgeCV(alphas=RIDGE_ALPHAS, cv=kfolds, fit_intercept=True)),
         make_pipeline(
             RobustScaler(),
-            LassoCV(max_iter=1e8, alphas=lasso_alpha, verbose=True, random_state=RANDOM_STATE,
-                    cv=kfolds, n_jobs=12, fit_intercept=True)),
+            LassoCV(max_iter=1e8, alphas=LASSO_ALPHAS, verbose=True, random_state=RANDOM_STATE,
+                    cv=kfolds, n_jobs=n_jobs, fit_intercept=True)),
         make_pipeline(
             RobustScaler(),
-            ElasticNetCV(max_iter=1e7, alphas=e_alphas, verbose=True, random_state=RANDOM_STATE, cv=kfolds,
-                         l1_ratio=e_l1ratio, n_jobs=12)),
+            ElasticNetCV(max_iter=1e7, alphas=E_ALPHAS, verbose=True, random_state=RANDOM_STATE, cv=kfolds,
+                         l1_ratio=E_L1RATIO, n_jobs=n_jobs)),
         make_pipeline(
             RobustScaler(),
-            GradientBoostingRegressor(n_estimators=3000, verbose=True, learning_rate=0.02,
-                                      max_depth=4, max_features='sqrt',
-                                      min_samples_leaf=15, min_samples_split=50,
-                                      loss='huber', random_state=5)),
+            GradientBoostingRegressor(verbose=True, max_features='sqrt', loss='huber', random_state=5,
+                                      **config['gbr'])),
         make_pipeline(
             RobustScaler(),
-            BayesianRidge(fit_intercept=True, verbose=True, n_iter=10000))
-    ]
+            BayesianRidge(fit_intercept=True, verbose=True, n_iter=BAYES_N_ITER))
+    ], target_columns, RANDOM_STATE)
+
+    store = CheckpointStore() if CHECKPOINT_FITS else None
+    members = [1, 2, 3] if out_of_core else list(range(len(predictors)))
+    budget = memory_budget()
+    # The same read-only buffer (memory-mapped when it does not fit in the memory budget) for every member and the stack
+    x_train = feature_buffer(x_train, 'x_train', budget)
+    y_train = np.asarray(y_train)
+    with limit_threads(n_threads), budget.stage('fit: members'):
+        if CHECKPOINT_FITS:
+            fitted = fit_estimators([predictors[i] for i in members], x_train, y_train, store)
+        else:
+            fitted = [predictors[i].fit(x_train, y_train) for i in members]
+        for i, predictor in zip(members, fitted):
+            predictors[i] = predictor
+
+        if out_of_core:
+            linear = fit_linear_members(matrix_chunks(x_train, y_train))
+            predictors[0], predictors[4] = linear['ridge'], linear['baye']
+
+    stacked = get_stack_gen_model(config, target_columns)
+    with budget.stage('fit: stack'):
+        if CHECKPOINT_FITS:
+            fit_stack(stacked, x_train, y_train, store)
+            print('Fitted models: {} loaded, {} fitted'.format(store.hits, store.misses))
+        else:
+            stacked.fit(x_train, y_train)
+    del x_train
+
+    if FLATTEN_TREES:
+        flatten_gradient_boosting_models([predictors[3], stacked])
+
+    return dict(zip(['ridge', 'lasso', 'elastic', 'grad', 'baye'], predictors), stack=stacked)
 
-    for predictor in predictors:
-        predictor.fit(x_train, y_train)
 
-    x_train_sta = np.asarray(x_train)
-    y_train_sta = np.asarray(y_train)
-    x_test_sta = np.asarray(x_test)
-    stacked = get_stack_gen_model()
-    stacked.fit(x_train_sta, y_train_sta)
+def matrix_chunks(x, y, chunk_size=STATISTICS_CHUNK_SIZE):
+    for i in range(0, x.shape[0], chunk_size):
+        yield x[i:i + chunk_size], y[i:i + chunk_size]
 
-    pred_ridge = predictors[0].predict(x_test)
-    pred_lasso = predictors[1].predict(x_test)
-    pred_ela = predictors[2].predict(x_test)
-    pred_grad = predictors[3].predict(x_test)
-    pred_baye = predictors[4].predict(x_test)
-    pred_sta = stacked.predict(x_test_sta)
+
+def fit_linear_members(chunks):
+    """
+    Out-of-core version of the 'ridge' and 'baye' members of fit_models.
+    :param chunks: iterable of (x, log1p(y)) chunks of the engineered matrix, e.g. LinearFunctions.read_matrix_chunks
+    """
+    return fit_linear_models(accumulate_statistics(chunks), RIDGE_ALPHAS, BAYES_N_ITER)
+
+
+def predict_members(models, x_test):
+    budget = memory_budget()
+    x_test = feature_buffer(x_test, 'x_test', budget)
 
     def _pre_average(preds):
         preds = np.expm1(preds)
         return preds
 
-    pred_ridge = _pre_average(pred_ridge)
-    pred_lasso = _pre_average(pred_lasso)
-    pred_ela = _pre_average(pred_ela)
-    pred_grad = _pre_average(pred_grad)
-    pred_baye = _pre_average(pred_baye)
-    pred_sta = _pre_average(pred_sta)
+    with budget.stage('predict'):
+        return {name: _pre_average(model.predict(x_test))
+                for name, model in models.items()}
 
-    predictions = ((0.15 * pred_ridge) + (0.15 * pred_lasso) + (0.15 * pred_ela)
-                   + (0.15 * pred_grad) + (0.05 * pred_baye)
-                   + (0.35 * pred_sta))
 
-    def _post_average(preds):
-        preds = quantile_reductions(preds)
-        return approximate(preds)
+def blend(members_predictions, weights=None):
+    weights = BLEND_WEIGHTS if weights is None else weights
+    predictions = 0
+    for name, weight in weights.items():
+        predictions = predictions + (weight * members_predictions[name])
+    return predictions
 
-    predictions = _post_average(predictions)
 
-    return predictions
+def post_average(predictions, thresholds=None):
+    predictions = quantile_reductions(predictions, thresholds=thresholds)
+    return approximate(predictions)
 
 
 # %% Build stack gen model
-def get_stack_gen_model():
+def get_stack_gen_model(config=None, target_columns=()):
+    """
+    :param config: see load_tuned_config, read from TUNED_CONFIG_FILE by default
+    :param target_columns: positions of the target code columns, encoded by the first step of every regressor
+    """
+    config = load_tuned_config() if config is None else config
     kfolds = KFold(n_splits=42, shuffle=True, random_state=RANDOM_STATE)
 
     # TODO  QUELLO CHE HA FATTO SCENDERE SOTTO LA SOGLIA DI 113 È QUESTO ALPHA! O.O
-    meta = Lasso(alpha=0.0007, random_state=RANDOM_STATE, max_iter=50000)
-    meta_regr = make_pipeline(
+    meta = Lasso(alpha=config['stack']['meta'], random_state=RANDOM_STATE, max_iter=50000)
+    # The features come first in the inputs of the meta regressor
+    meta_regr, = add_target_encoder([make_pipeline(
         RobustScaler(),
-        meta)
+        meta)], target_columns, RANDOM_STATE)
 
-    ridge = Ridge(alpha=7.0, fit_intercept=True)
-    lasso = Lasso(alpha=0.00143, random_state=RANDOM_STATE, max_iter=50000)
+    ridge = Ridge(alpha=config['stack']['ridge'], fit_intercept=True)
+    lasso = Lasso(alpha=config['stack']['lasso'], random_state=RANDOM_STATE, max_iter=50000)
     elasti = ElasticNet(alpha=4.0, l1_ratio=0.007, random_state=3)
-    grad = GradientBoostingRegressor(n_estimators=3000, learning_rate=0.02,
-                                     max_depth=4, max_features='sqrt',
-                                     min_samples_leaf=15, min_samples_split=50,
-                                     loss='huber', random_state=5)
+    grad = GradientBoostingRegressor(max_features='sqrt', loss='huber', random_state=5, **config['gbr'])
     baye = BayesianRidge(fit_intercept=True, verbose=True, n_iter=10000)
 
-    predictors = [
+    predictors = add_target_encoder([
         make_pipeline(
             RobustScaler(),
             ridge),
@@ -129,36 +243,45 @@ def get_stack_gen_model():
         make_pipeline(
             RobustScaler(),
             baye),
-    ]
+    ], target_columns, RANDOM_STATE)
 
     # stack
+    # The folds are fitted in parallel processes, each with its share of the cores
     stack_gen = StackingCVRegressor(regressors=predictors,
                                     meta_regressor=meta_regr,
                                     use_features_in_secondary=True,
-                                    cv=kfolds)
+                                    cv=kfolds,
+                                    n_jobs=split_cores(kfolds.get_n_splits())[0])
     return stack_gen
 
 
 def approximate(preds):
-    def _transform(x):
-        round_value = 1000
-        int_price = int(x)
-        remainder = int_price % round_value
-        if remainder >= round_value / 2:
-            int_price += (round_value - remainder)
-        else:
-            int_price -= remainder
+    round_value = 1000
+    int_price = np.trunc(np.asarray(preds, dtype=np.float64)).astype(np.int64)
+    remainder = int_price % round_value
+    return np.where(remainder >= round_value / 2, int_price + (round_value - remainder), int_price - remainder)
 
-        return int_price
 
-    return np.asarray([_transform(x) for x in preds])
+def quantile_thresholds(predictions, max_tresh=0.0042, min_tresh=0.99):
+    """
+    :param predictions: the predicted prices or a QuantileSketch built on them
+    """
+    if isinstance(predictions, QuantileSketch):
+        return predictions.quantile(max_tresh), predictions.quantile(min_tresh)
+    predictions = pd.Series(predictions)
+    return predictions.quantile(max_tresh), predictions.quantile(min_tresh)
 
 
-def quantile_reductions(predictions, max_tresh=0.0042, max_norm=0.77, min_tresh=0.99, min_norm=1.1):
-    predictions_df = pd.DataFrame()
-    predictions_df['norm'] = predictions
-    q1 = predictions_df['norm'].quantile(max_tresh)
-    q2 = predictions_df['norm'].quantile(min_tresh)
-    predictions_df['norm'] = predictions_df['norm'].apply(lambda x: x if x > q1 else x * max_norm)
-    predictions_df['norm'] = predictions_df['norm'].apply(lambda x: x if x < q2 else x * min_norm)
-    return predictions_df['norm'].values
+def quantile_reductions(predictions, max_tresh=0.0042, max_norm=0.77, min_tresh=0.99, min_norm=1.1, thresholds=None):
+    """
+    Scales down the lowest predictions and scales up the highest ones.
+    :param thresholds: fixed (low, high) prices, otherwise the max_tresh and min_tresh quantiles of the predictions
+                       (or of the QuantileSketch passed in their place)
+    """
+    if isinstance(thresholds, QuantileSketch):
+        thresholds = quantile_thresholds(thresholds, max_tresh, min_tresh)
+    predictions = np.asarray(predictions, dtype=np.float64)
+    q1, q2 = quantile_thresholds(predictions, max_tresh, min_tresh) if thresholds is None else thresholds
+    predictions = np.where(predictions > q1, predictions, predictions * max_norm)
+    predictions = np.where(predictions < q2, predictions, predictions * min_norm)
+    return predictions
@@ -0,0 +1,54 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.linear_model import LassoCV, ElasticNetCV
+from sklearn.model_selection import KFold
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import RobustScaler
+
+from FeaturesEngineering import get_engineered_train_test
+from RegressionFunctions import RANDOM_STATE, CV_FOLDS, LASSO_ALPHAS, E_ALPHAS, E_L1RATIO
+from ResourceFunctions import available_cores, init_worker, split_cores
+
+# -------------------------------------- CORES BUDGET BENCHMARK --------------------------------------
+# Independent fits of the CV-tuned members run together, as the random splits of the validation:
+# - naive: one process per core, each with the old n_jobs=12 and the default BLAS threads (one per core);
+# - budget: processes, joblib jobs and BLAS threads split from the cores budget (ResourceFunctions).
+BENCHMARK_TASKS = 8
+NAIVE_N_JOBS = 12
+
+((_, x_train, y_train), _) = get_engineered_train_test()
+x_train, y_train = np.asarray(x_train), np.log1p(np.asarray(y_train))
+
+
+def fit_cv_members(n_jobs=None):
+    n_jobs = n_jobs or split_cores(CV_FOLDS)[0]
+    kfolds = KFold(n_splits=CV_FOLDS, shuffle=True, random_state=RANDOM_STATE)
+    start = time.time()
+    make_pipeline(RobustScaler(), LassoCV(max_iter=int(1e8), alphas=LASSO_ALPHAS, random_state=RANDOM_STATE, cv=kfolds,
+                                          n_jobs=n_jobs)).fit(x_train, y_train)
+    make_pipeline(RobustScaler(), ElasticNetCV(max_iter=int(1e7), alphas=E_ALPHAS, l1_ratio=E_L1RATIO,
+                                               random_state=RANDOM_STATE, cv=kfolds, n_jobs=n_jobs)).fit(x_train,
+                                                                                                        y_train)
+    return time.time() - start
+
+
+def run(n_workers, n_jobs=None, worker_cores=None):
+    start = time.time()
+    initializer, initargs = (init_worker, (worker_cores,)) if worker_cores else (None, ())
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=initializer, initargs=initargs) as executor:
+        fit_times = list(executor.map(fit_cv_members, [n_jobs] * BENCHMARK_TASKS))
+    elapsed = time.time() - start
+    return BENCHMARK_TASKS / elapsed * 60, np.mean(fit_times)
+
+
+cores = available_cores()
+budget_workers, budget_cores = split_cores(BENCHMARK_TASKS, cores)
+print("Cores budget: {}, {} tasks".format(cores, BENCHMARK_TASKS))
+for name, (throughput, fit_time) in [
+    ('naive ({} processes x n_jobs={})'.format(cores, NAIVE_N_JOBS), run(cores, NAIVE_N_JOBS)),
+    ('budget ({} processes x {} cores)'.format(budget_workers, budget_cores),
+     run(budget_workers, worker_cores=budget_cores)),
+]:
+    print("{:<40} {:8.2f} fits/minute, {:8.2f} s per fit".format(name, throughput, fit_time))
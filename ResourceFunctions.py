@@ -0,0 +1,67 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from threadpoolctl import threadpool_limits
+
+# %% ~~~~~ CORES BUDGET ~~~~~
+# Every parallel stage (process pools, joblib n_jobs, scoring threads, BLAS/OpenMP) takes its share from a single
+# budget of cores, so that nested parallelism never multiplies: workers * inner threads <= cores.
+# The budget is the cores available to the process, or HOUSE_PRICES_CORES on shared hosts. The workers of a pool
+# receive their share as their own budget.
+CORES_ENV = 'HOUSE_PRICES_CORES'
+
+_budget = threading.local()
+
+
+def available_cores():
+    cores = getattr(_budget, 'cores', None)
+    if cores:
+        return cores
+    if os.environ.get(CORES_ENV):
+        return max(1, int(os.environ[CORES_ENV]))
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def split_cores(n_tasks, cores=None):
+    """
+    Splits the budget between parallel workers (at most one per task) and the threads of each worker.
+    :return: (number of workers, cores of each worker)
+    """
+    cores = cores or available_cores()
+    workers = max(1, min(n_tasks, cores))
+    return workers, max(1, cores // workers)
+
+
+@contextmanager
+def core_budget(cores):
+    """
+    Restricts the budget seen by available_cores in the current thread (e.g. a worker of a thread pool).
+    """
+    previous = getattr(_budget, 'cores', None)
+    _budget.cores = cores
+    try:
+        yield
+    finally:
+        _budget.cores = previous
+
+
+@contextmanager
+def limit_threads(threads):
+    """
+    Limits the BLAS and OpenMP threads of the whole process.
+    """
+    with threadpool_limits(limits=threads):
+        yield
+
+
+def init_worker(cores):
+    """
+    Initializer of the process pools: the worker gets its share of cores as budget, for its own BLAS threads and for
+    the parallel stages it runs (e.g. the n_jobs of fit_models).
+    """
+    os.environ[CORES_ENV] = str(cores)
+    threadpool_limits(limits=cores)
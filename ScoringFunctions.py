@@ -0,0 +1,194 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from CorrectionFunctions import apply_corrections
+from FeaturesPipeline import fit_features, transform_features
+from PredictionCacheFunctions import artifact_version, row_hashes
+from RegressionFunctions import fit_models, predict_members, blend, post_average, quantile_thresholds
+from ResourceFunctions import available_cores, core_budget, limit_threads, split_cores
+from SketchFunctions import QuantileSketch, merge_sketches
+
+# Rows read, transformed and predicted together
+CHUNK_SIZE = 50000
+# Chunks in flight for each worker (read but not yet written), bounds the memory used by the pipeline
+CHUNKS_PER_WORKER = 2
+
+
+# %% ~~~~~ SCORING ARTIFACT ~~~~~
+def build_scoring_artifact(raw_train_df, y_train, features_config):
+    """
+    Fits the features transform and the ensemble on the raw training rows.
+    The quantile thresholds used in the post-processing are fixed on a sketch of the predictions of the training rows,
+    so that the scores of a row do not depend on the other rows of its chunk.
+    """
+    features, x_train = fit_features(raw_train_df, features_config)
+    models = fit_models(x_train, np.asarray(y_train))
+    sketch = QuantileSketch().update(blend(predict_members(models, x_train)))
+    return {'features': features, 'models': models, 'sketch': sketch, 'thresholds': quantile_thresholds(sketch)}
+
+
+def update_thresholds(artifact, sketch):
+    """
+    Adds the sketch of newly scored predictions to the one of the artifact and refreshes the fixed thresholds.
+    """
+    artifact['sketch'] = merge_sketches([artifact['sketch'], sketch])
+    artifact['thresholds'] = quantile_thresholds(artifact['sketch'])
+    return artifact
+
+
+def save_artifact(artifact, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    joblib.dump(artifact, path)
+
+
+def load_artifact(path):
+    return joblib.load(path)
+
+
+def predict_chunk(artifact, raw_df, cache=None, version=None):
+    """
+    :param cache: PredictionCache, only the rows not cached are transformed and predicted
+    :param version: artifact_version of the artifact (computed once per stream)
+    :return: the blended predictions, before the post-processing
+    """
+    if cache is None:
+        return blend(predict_members(artifact['models'], transform_features(raw_df, artifact['features'])))
+    version = artifact_version(artifact) if version is None else version
+    # The corrections by Id are not seen by the hash (without the Id) of the raw rows, the one of the corrected rows is
+    # used (transform_features corrects them again, with no change)
+    raw_df, _ = apply_corrections(raw_df, artifact['features'].get('corrections', {}))
+    hashes = row_hashes(raw_df, artifact['features']['raw_dtypes'])
+    predictions = cache.get(version, hashes)
+    missing = np.isnan(predictions)
+    if missing.any():
+        x = transform_features(raw_df[missing], artifact['features'])
+        predictions[missing] = blend(predict_members(artifact['models'], x))
+        cache.put(version, hashes[missing], predictions[missing])
+    return predictions
+
+
+def score_chunk(artifact, raw_df, sketch=None, cache=None, version=None):
+    """
+    :param sketch: if given, it is updated with the predictions before the post-processing
+    :param cache: see predict_chunk
+    """
+    predictions = predict_chunk(artifact, raw_df, cache, version)
+    if sketch is not None:
+        sketch.update(predictions)
+    scores = pd.DataFrame()
+    scores.insert(0, 'Id', raw_df['Id'].values)
+    scores['SalePrice'] = post_average(predictions, thresholds=artifact['thresholds'])
+    return scores
+
+
+def _score_chunk_sketched(artifact, raw_df, cores=None, cache=None, version=None):
+    sketch = QuantileSketch()
+    with core_budget(cores):
+        return score_chunk(artifact, raw_df, sketch, cache, version), sketch
+
+
+# %% ~~~~~ STREAMING ~~~~~
+def read_chunks(input_path, chunk_size=CHUNK_SIZE):
+    if str(input_path).endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(input_path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(input_path, chunksize=chunk_size):
+            yield chunk
+
+
+class _CsvWriter:
+    def __init__(self, output_path):
+        self.handle = open(output_path, 'w', newline='')
+        self.header = True
+
+    def write(self, df):
+        df.to_csv(self.handle, header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        self.handle.close()
+
+
+class _ParquetWriter:
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.writer = None
+
+    def write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.output_path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def _write_results(pending, writer, sketch, errors):
+    # Consumes the futures in submission order, so the output (and the merged sketch) keeps the order of the input
+    while True:
+        future = pending.get()
+        if future is None:
+            break
+        if errors:
+            future.cancel()
+            continue
+        try:
+            scores, chunk_sketch = future.result()
+            writer.write(scores)
+            sketch.merge(chunk_sketch)
+        except Exception as e:
+            errors.append(e)
+
+
+def score_stream(artifact, input_path, output_path, chunk_size=CHUNK_SIZE, n_workers=None, cache=None):
+    """
+    Scores a CSV (or Parquet) file chunk by chunk: the main thread reads, a pool of workers transforms and predicts,
+    a writer thread appends the results to the output (CSV, or Parquet if the path ends with .parquet).
+    The three stages overlap and communicate through a bounded queue, so the memory does not depend on the input size.
+    :param cache: PredictionCache, the unchanged rows get their cached prediction (see cache.stats() for the hit rate)
+    :return: the number of scored rows and the sketch of their predictions (see update_thresholds)
+    """
+    # Each worker thread gets its share of the cores (e.g. for the flattened trees), the BLAS threads are shared
+    n_workers, worker_cores = split_cores(n_workers or available_cores())
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    writer = _ParquetWriter(output_path) if str(output_path).endswith('.parquet') else _CsvWriter(output_path)
+
+    pending = queue.Queue(maxsize=CHUNKS_PER_WORKER * n_workers)
+    sketch = QuantileSketch()
+    errors = []
+    rows = 0
+    version = artifact_version(artifact) if cache is not None else None
+    write_thread = threading.Thread(target=_write_results, args=(pending, writer, sketch, errors), daemon=True)
+    write_thread.start()
+    try:
+        with limit_threads(worker_cores), ThreadPoolExecutor(max_workers=n_workers) as executor:
+            try:
+                for chunk in read_chunks(input_path, chunk_size):
+                    if errors:
+                        break
+                    rows += chunk.shape[0]
+                    pending.put(executor.submit(_score_chunk_sketched, artifact, chunk, worker_cores, cache,
+                                                version))
+            finally:
+                pending.put(None)
+                write_thread.join()
+    finally:
+        writer.close()
+
+    if errors:
+        raise errors[0]
+    return rows, sketch
@@ -0,0 +1,90 @@
+import numpy as np
+
+# Centroids budget of the digest (~ compression * pi / 2 centroids): the tails, where the quantile reductions cut,
+# are the most accurate part of the sketch
+SKETCH_COMPRESSION = 1000
+# Values kept as they are before compressing, below this size the quantiles are exact
+SKETCH_BUFFER_SIZE = 20000
+
+
+class QuantileSketch:
+    """
+    Mergeable streaming quantile sketch (merging t-digest with the arcsine scale function).
+    The values are buffered and periodically compressed into weighted centroids, small near the tails and large in the
+    middle, so the memory is constant and two sketches (from different batches or processes) can be merged.
+    As long as no compression happened the quantiles are the exact ones (same linear interpolation of pandas).
+    """
+
+    def __init__(self, compression=SKETCH_COMPRESSION, buffer_size=SKETCH_BUFFER_SIZE):
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.means = np.empty(0, dtype=np.float64)
+        self.weights = np.empty(0, dtype=np.float64)
+        self.buffer = []
+        self.buffered = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self):
+        return self.weights.sum() + self.buffered
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if values.shape[0] == 0:
+            return self
+
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.buffer.append(values)
+        self.buffered += values.shape[0]
+        if self.buffered > self.buffer_size:
+            self._flush()
+        return self
+
+    def merge(self, other):
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.buffer.extend(other.buffer)
+        self.buffered += other.buffered
+        if other.weights.shape[0] or self.buffered > self.buffer_size:
+            self._flush(other.means, other.weights)
+        return self
+
+    def _flush(self, means=None, weights=None):
+        buffer = np.concatenate(self.buffer) if self.buffer else np.empty(0)
+        means = np.concatenate([self.means, buffer] + ([] if means is None else [means]))
+        weights = np.concatenate([self.weights, np.ones(buffer.shape[0])] + ([] if weights is None else [weights]))
+        self.buffer = []
+        self.buffered = 0
+
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        centers = (np.cumsum(weights) - weights / 2) / total
+
+        # Consecutive points within the same unit of the scale function are merged in a single centroid
+        scale = np.floor(self.compression / (2 * np.pi) * np.arcsin(2 * centers - 1))
+        starts = np.flatnonzero(np.r_[True, scale[1:] != scale[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        if self.weights.shape[0] == 0:
+            return np.quantile(np.concatenate(self.buffer), q)
+
+        if self.buffered:
+            self._flush()
+        total = self.weights.sum()
+        centers = np.cumsum(self.weights) - self.weights / 2
+        return np.interp(q * total, np.r_[0, centers, total], np.r_[self.min, self.means, self.max])
+
+
+def merge_sketches(sketches):
+    merged = QuantileSketch()
+    for sketch in sketches:
+        merged.merge(sketch)
+    return merged
@@ -0,0 +1,185 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.pipeline import Pipeline
+
+from ResourceFunctions import available_cores
+
+# Rows traversed together by a single thread, the (rows x trees) node indices of a block should stay in cache
+ROWS_PER_BLOCK = 64
+# Every tree is padded to a complete binary tree, so the layout grows as 2^depth
+MAX_FLAT_DEPTH = 12
+FLAT_TREES_ARRAYS = ['feature', 'threshold', 'value', 'scalars']
+# Batches of more rows are predicted by sklearn (predict_stages) when the original estimator is kept: the flat layout
+# is faster for a few rows (no per-call overhead), the tree by tree traversal of sklearn for the large batches
+FLAT_MAX_ROWS = 4
+
+
+class FlatTreeEnsemble(RegressorMixin, BaseEstimator):
+    """
+    Structure-of-arrays copy of a fitted GradientBoostingRegressor.
+    Each tree is stored as a complete binary tree of the same depth: the children of the node i are 2i+1 and 2i+2,
+    so the traversal is a fixed number of vectorized steps over all the (row, tree) pairs, with no child arrays.
+    The leaves reached before the last level are replicated in all their descendants (and their threshold is infinite).
+    The predictions are bit-identical to the ones of the original estimator: the input is cast to float32 and the
+    leaves are accumulated in the same order of sklearn. The batches of more than max_rows rows are predicted by the
+    original estimator, if given.
+    """
+
+    def __init__(self, feature, threshold, value, scalars, n_jobs=None, estimator=None, max_rows=FLAT_MAX_ROWS):
+        # (n_trees, 2^depth - 1) split features and thresholds, (n_trees, 2^depth) leaf values
+        self.feature = feature
+        self.threshold = threshold
+        self.value = value
+        # [init raw prediction, learning rate, depth, number of features]
+        self.scalars = scalars
+        self.n_jobs = n_jobs
+        # The fitted GradientBoostingRegressor
+        self.estimator = estimator
+        self.max_rows = max_rows
+
+    @property
+    def init(self):
+        return self.scalars[0]
+
+    @property
+    def learning_rate(self):
+        return self.scalars[1]
+
+    @property
+    def depth(self):
+        return int(self.scalars[2])
+
+    @property
+    def n_features(self):
+        return int(self.scalars[3])
+
+    def fit(self, x, y):
+        raise NotImplementedError('A FlatTreeEnsemble cannot be trained, use flatten_gradient_boosting on a fitted '
+                                  'GradientBoostingRegressor')
+
+    def __sklearn_is_fitted__(self):
+        return True
+
+    def _predict_block(self, x):
+        n_rows = x.shape[0]
+        n_trees, n_internal = self.feature.shape
+        flat_x = x.ravel()
+        flat_feature = self.feature.ravel()
+        flat_threshold = self.threshold.ravel()
+
+        rows_offset = (np.arange(n_rows, dtype=np.int32) * self.n_features)[:, None]
+        internal_offset = np.arange(n_trees, dtype=np.int32) * n_internal
+        leaves_offset = np.arange(n_trees, dtype=np.int32) * (n_internal + 1)
+
+        nodes = np.zeros((n_rows, n_trees), dtype=np.int32)
+        for _ in range(self.depth):
+            k = internal_offset + nodes
+            go_right = ~(flat_x[rows_offset + flat_feature[k]] <= flat_threshold[k])
+            nodes *= 2
+            nodes += 1
+            nodes += go_right
+
+        # Same accumulation of sklearn: out += learning_rate * leaf_value, one tree after the other
+        leaves = np.empty((n_rows, n_trees + 1), dtype=np.float64)
+        leaves[:, 0] = self.init
+        np.multiply(self.learning_rate, self.value.ravel()[leaves_offset + nodes - n_internal], out=leaves[:, 1:])
+        return np.cumsum(leaves, axis=1)[:, -1]
+
+    def predict(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        assert x.ndim == 2 and x.shape[1] == self.n_features, \
+            'Expected {} features, got shape {}'.format(self.n_features, x.shape)
+        if self.estimator is not None and x.shape[0] > self.max_rows:
+            return self.estimator.predict(x)
+
+        blocks = [x[i:i + ROWS_PER_BLOCK] for i in range(0, x.shape[0], ROWS_PER_BLOCK)]
+        n_jobs = self.n_jobs or available_cores()
+        if n_jobs == 1 or len(blocks) <= 1:
+            predictions = [self._predict_block(block) for block in blocks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(n_jobs, len(blocks))) as executor:
+                predictions = list(executor.map(self._predict_block, blocks))
+        return np.concatenate(predictions) if predictions else np.empty(0, dtype=np.float64)
+
+
+def flatten_gradient_boosting(gbr, n_jobs=None):
+    assert isinstance(gbr, GradientBoostingRegressor), 'Expected a GradientBoostingRegressor, got {}'.format(gbr)
+    trees = [estimator.tree_ for estimator in gbr.estimators_[:, 0]]
+    n_features = trees[0].n_features
+    depth = max(tree.max_depth for tree in trees)
+    assert depth <= MAX_FLAT_DEPTH, 'Trees too deep to be flattened: {} > {}'.format(depth, MAX_FLAT_DEPTH)
+
+    n_internal = 2 ** depth - 1
+    feature = np.zeros((len(trees), n_internal), dtype=np.int32)
+    threshold = np.full((len(trees), n_internal), np.inf, dtype=np.float64)
+    value = np.zeros((len(trees), n_internal + 1), dtype=np.float64)
+
+    for i, tree in enumerate(trees):
+        # (sklearn node, position in the complete tree, level)
+        stack = [(0, 0, 0)]
+        while stack:
+            node, position, level = stack.pop()
+            left, right = tree.children_left[node], tree.children_right[node]
+            if left == right:
+                span = 2 ** (depth - level)
+                first_leaf = (position + 1) * span - 1 - n_internal
+                value[i, first_leaf:first_leaf + span] = tree.value[node, 0, 0]
+            else:
+                feature[i, position] = tree.feature[node]
+                threshold[i, position] = tree.threshold[node]
+                stack.append((left, 2 * position + 1, level + 1))
+                stack.append((right, 2 * position + 2, level + 1))
+
+    if isinstance(gbr.init_, str) and gbr.init_ == 'zero':
+        init = 0.0
+    else:
+        init = gbr.init_.predict(np.zeros((1, n_features), dtype=np.float32)).astype(np.float64)[0]
+
+    scalars = np.array([init, gbr.learning_rate, depth, n_features], dtype=np.float64)
+    return FlatTreeEnsemble(feature=feature, threshold=threshold, value=value, scalars=scalars, n_jobs=n_jobs,
+                            estimator=gbr)
+
+
+def flatten_gradient_boosting_models(model, n_jobs=None):
+    """
+    Replaces in place every fitted GradientBoostingRegressor found in the model with its flattened version.
+    :param model: a fitted Pipeline, StackingCVRegressor or list of them
+    :return: the number of flattened estimators
+    """
+    if isinstance(model, (list, tuple)):
+        return sum(flatten_gradient_boosting_models(x, n_jobs) for x in model)
+
+    if isinstance(model, Pipeline):
+        flattened = 0
+        for i, (name, step) in enumerate(model.steps):
+            if isinstance(step, GradientBoostingRegressor):
+                model.steps[i] = (name, flatten_gradient_boosting(step, n_jobs))
+                flattened += 1
+            else:
+                flattened += flatten_gradient_boosting_models(step, n_jobs)
+        return flattened
+
+    # The fold models of the StackingCVRegressor are only used to build the meta features during the fit,
+    # the predictions are computed by the base regressors refitted on all the data
+    if hasattr(model, 'regr_'):
+        return (flatten_gradient_boosting_models(model.regr_, n_jobs)
+                + flatten_gradient_boosting_models(model.meta_regr_, n_jobs))
+
+    return 0
+
+
+def save_flat_trees(flat, directory):
+    os.makedirs(directory, exist_ok=True)
+    for name in FLAT_TREES_ARRAYS:
+        np.save(Path(directory, '{}.npy'.format(name)), getattr(flat, name))
+
+
+def load_flat_trees(directory, mmap_mode='r', n_jobs=None):
+    arrays = {name: np.load(Path(directory, '{}.npy'.format(name)), mmap_mode=mmap_mode)
+              for name in FLAT_TREES_ARRAYS}
+    return FlatTreeEnsemble(n_jobs=n_jobs, **arrays)
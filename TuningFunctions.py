@@ -0,0 +1,171 @@
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.stats import loguniform, randint
+from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.model_selection import KFold, ParameterSampler
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import RobustScaler
+
+from RegressionFunctions import RANDOM_STATE, GBR_PARAMS, STACK_ALPHAS, TUNED_CONFIG_FILE, get_stack_gen_model
+from ResourceFunctions import available_cores, init_worker, split_cores
+
+# %% ~~~~~ SUCCESSIVE HALVING ~~~~~
+# Hyperband over random candidates: each bracket evaluates its candidates with a fraction of the resources, keeps the
+# best 1/TUNING_ETA and evaluates them again with TUNING_ETA times the resources, up to the full ones.
+# The resources of a fraction f are f * TUNING_MAX_TREES trees and sqrt(f) of the training rows of each fold.
+# Every evaluation uses the same fold plan; the trees of the GradientBoostingRegressor are scored at every stage,
+# so a single fit also chooses n_estimators.
+TUNING_FOLDS = 5
+TUNING_ETA = 3
+# Number of brackets, the one with the most candidates starts from 1 / TUNING_ETA ** (TUNING_BRACKETS - 1)
+TUNING_BRACKETS = 3
+TUNING_MAX_TREES = 6000
+
+GBR_SPACE = {
+    'learning_rate': loguniform(0.005, 0.1),
+    'max_depth': randint(2, 7),
+    'min_samples_leaf': randint(5, 40),
+    'min_samples_split': randint(10, 100),
+}
+STACK_SPACE = {
+    'ridge': loguniform(0.5, 50),
+    'lasso': loguniform(1e-4, 1e-2),
+    'meta': loguniform(1e-4, 1e-2),
+}
+
+
+def fold_plan(x, n_splits=TUNING_FOLDS):
+    return list(KFold(n_splits=n_splits, shuffle=True, random_state=RANDOM_STATE).split(x))
+
+
+def _subsample(train_index, rows_fraction, seed):
+    n_rows = max(2, int(round(len(train_index) * rows_fraction)))
+    return np.random.RandomState(seed).permutation(train_index)[:n_rows]
+
+
+def _plain(params):
+    return {name: value.item() if isinstance(value, np.generic) else value for name, value in params.items()}
+
+
+# %% ~~~~~ EVALUATIONS ~~~~~
+def gbr_fold_errors(params, x, y, train_index, val_index, n_trees, rows_fraction, seed):
+    """
+    :return: RMSE on the validation rows after each tree
+    """
+    train_index = _subsample(train_index, rows_fraction, seed)
+    model = make_pipeline(RobustScaler(),
+                          GradientBoostingRegressor(max_features='sqrt', loss='huber', random_state=5,
+                                                    **dict(params, n_estimators=n_trees)))
+    model.fit(x[train_index], y[train_index])
+    x_val = model[:-1].transform(x[val_index])
+    return np.array([np.sqrt(np.mean((predictions - y[val_index]) ** 2))
+                     for predictions in model[-1].staged_predict(x_val)])
+
+
+def stack_fold_error(alphas, gbr_params, x, y, train_index, val_index, n_trees, rows_fraction, seed):
+    train_index = _subsample(train_index, rows_fraction, seed)
+    stack = get_stack_gen_model({'gbr': dict(gbr_params, n_estimators=n_trees), 'stack': alphas})
+    stack.fit(x[train_index], y[train_index])
+    return np.sqrt(np.mean((stack.predict(x[val_index]) - y[val_index]) ** 2))
+
+
+def evaluate_gbr(executor, candidates, x, y, folds, fraction):
+    """
+    :return: for each candidate, (error, candidate with the best n_estimators)
+    """
+    n_trees = max(1, int(round(TUNING_MAX_TREES * fraction)))
+    futures = [[executor.submit(gbr_fold_errors, params, x, y, train_index, val_index, n_trees,
+                                math.sqrt(fraction), RANDOM_STATE + i)
+                for i, (train_index, val_index) in enumerate(folds)]
+               for params in candidates]
+    results = []
+    for params, fold_futures in zip(candidates, futures):
+        errors = np.mean([future.result() for future in fold_futures], axis=0)
+        results.append((errors.min(), dict(params, n_estimators=int(errors.argmin()) + 1)))
+    return results
+
+
+def evaluate_stack(executor, candidates, x, y, folds, fraction, gbr_params):
+    """
+    :return: for each candidate, (error, candidate)
+    """
+    n_trees = max(1, int(round(gbr_params['n_estimators'] * fraction)))
+    futures = [[executor.submit(stack_fold_error, alphas, gbr_params, x, y, train_index, val_index, n_trees,
+                                math.sqrt(fraction), RANDOM_STATE + i)
+                for i, (train_index, val_index) in enumerate(folds)]
+               for alphas in candidates]
+    return [(np.mean([future.result() for future in fold_futures]), alphas)
+            for alphas, fold_futures in zip(candidates, futures)]
+
+
+# %% ~~~~~ SEARCH ~~~~~
+def successive_halving(evaluate, candidates, fractions, eta=TUNING_ETA):
+    """
+    :param evaluate: function of (candidates, fraction of the resources) -> list of (error, candidate)
+    :return: (error, candidate) of the winner at the last fraction, and the cost in full evaluations
+    """
+    cost = 0
+    for fraction in fractions:
+        results = sorted(evaluate(candidates, fraction), key=lambda result: result[0])
+        # Trees times rows
+        cost += len(candidates) * fraction * math.sqrt(fraction)
+        candidates = [candidate for _, candidate in results[:max(1, len(results) // eta)]]
+    return results[0], cost
+
+
+def hyperband(evaluate, space, start, n_brackets=TUNING_BRACKETS, eta=TUNING_ETA):
+    """
+    :param start: the hand-tuned candidate, added to every bracket
+    :return: (error, candidate) of the best winner and the log of the search
+    """
+    best, log = None, {'brackets': [], 'cost': 0, 'candidates': 0}
+    for s in reversed(range(n_brackets)):
+        n_candidates = int(math.ceil(n_brackets / (s + 1) * eta ** s))
+        candidates = [start] + [_plain(params) for params in
+                                ParameterSampler(space, n_candidates - 1, random_state=RANDOM_STATE + s)]
+        fractions = [eta ** (i - s) for i in range(s + 1)]
+        result, cost = successive_halving(evaluate, candidates, fractions, eta)
+        log['brackets'].append({'candidates': n_candidates, 'fractions': fractions, 'error': float(result[0]),
+                                'winner': result[1], 'cost': cost})
+        log['cost'] += cost
+        log['candidates'] += n_candidates
+        if best is None or result[0] < best[0]:
+            best = result
+        print("Bracket of {} candidates from {:.3f} of the resources: {:.5f} {}".format(
+            n_candidates, fractions[0], result[0], result[1]))
+    return best, log
+
+
+def run_tuning(output_path=TUNED_CONFIG_FILE, x_train=None, y_train=None, n_workers=None):
+    """
+    Tunes the GradientBoostingRegressor, then the alphas of the stack with the tuned GradientBoostingRegressor.
+    :param y_train: the prices, the models are tuned on their log as in fit_models
+    :return: the tuned config (also written as json to output_path, where fit_predict reads it)
+    """
+    x, y = np.asarray(x_train, dtype=np.float64), np.log1p(np.asarray(y_train, dtype=np.float64))
+    folds = fold_plan(x)
+
+    n_workers, worker_cores = split_cores(n_workers or available_cores(), available_cores())
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(worker_cores,)) as executor:
+        (gbr_error, gbr_params), gbr_log = hyperband(
+            lambda candidates, fraction: evaluate_gbr(executor, candidates, x, y, folds, fraction),
+            GBR_SPACE, {name: value for name, value in GBR_PARAMS.items() if name != 'n_estimators'})
+        (stack_error, stack_alphas), stack_log = hyperband(
+            lambda candidates, fraction: evaluate_stack(executor, candidates, x, y, folds, fraction, gbr_params),
+            STACK_SPACE, dict(STACK_ALPHAS))
+
+    config = {'gbr': gbr_params, 'stack': stack_alphas,
+              'errors': {'gbr': float(gbr_error), 'stack': float(stack_error)},
+              'search': {'gbr': gbr_log, 'stack': stack_log}}
+    for name, log in config['search'].items():
+        print("{}: {:.1f} full evaluations for {} candidates".format(name, log['cost'], log['candidates']))
+    if output_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        with open(output_path, 'w') as f:
+            json.dump(config, f, indent=2)
+    return config
+
@@ -1,3 +1,28 @@
+import os
+
 # %% ~~~~~ GLOBAL CONSTANTS ~~~~~
-dataset_dir = 'dataset'
-predictions_dir = './predictions/'
+# Overridden by the environment to run the same pipeline on the dataset of another market (see MarketFunctions)
+dataset_dir = os.environ.get('HOUSE_PRICES_DATASET', 'dataset')
+predictions_dir = os.environ.get('HOUSE_PRICES_PREDICTIONS', './predictions/')
+
+# %% ~~~~~ COMMON MAPPINGS ~~~~~
+NONE_VALUE = 'None'
+
+qualities_dict = {NONE_VALUE: 0, 'Po': 1, 'Fa': 2, 'TA': 3, 'Gd': 4, 'Ex': 5}
+fin_qualities_dict = {NONE_VALUE: 0, "Unf": 1, "LwQ": 2, "Rec": 3, "BLQ": 4, "ALQ": 5, "GLQ": 6}
+house_style_dict = {'1.5Unf': 0, 'SFoyer': 1, '1.5Fin': 2, '2.5Unf': 3, 'SLvl': 4, '1Story': 5, '2Story': 6, '2.5Fin': 7}
+mas_vnr_type_dict = {NONE_VALUE: 0, 'Stone': 1, 'BrkFace': 2, 'BrkCmn': 3}
+foundation_dict = {'BrkTil': 5, 'CBlock': 4, 'PConc': 3, 'Slab': 2, 'Stone': 1, 'Wood': 0}
+bsmt_exposure_dict = {NONE_VALUE: 0, 'No': 0, 'Mn': 2, 'Av': 3, 'Gd': 4}
+functional_dict = {NONE_VALUE: 0, 'Sal': 1, 'Sev': 2, 'Maj2': 3, 'Maj1': 4, 'Mod': 5, 'Min2': 6, 'Min1': 7, 'Typ': 8}
+garage_finish_dict = {NONE_VALUE: 0, "Unf": 1, "RFn": 2, "Fin": 3}
+pool_qualities_dict = {NONE_VALUE: 0, 'Fa': 1, 'TA': 2, 'Gd': 3, 'Ex': 4}
+fence_dict = {NONE_VALUE: 0, 'MnWw': 1, 'GdWo': 2, 'MnPrv': 3, 'GdPrv': 4}
+sale_type_dict = {'WD': 9, 'CWD': 8, 'VWD': 7, 'New': 6, 'COD': 5, 'Con': 4, 'ConLw': 3, 'ConLI': 2, 'ConLD': 1, 'Oth': 0}
+
+exterior_typos_dict = {'CmentBd': 'CemntBd', 'Wd Shng': 'Wd Sdng', 'Brk Cmn': 'BrkComm'}
+good_neighborhoods = ('NridgHt', 'Crawfor', 'StoneBr', 'Somerst', 'NoRidge')
+bins_overall = {range(1, 4): 1, range(4, 7): 2, range(7, 11): 3}
+area_columns = ['LotFrontage', 'LotArea', 'MasVnrArea', 'BsmtFinSF1', 'BsmtFinSF2', 'BsmtUnfSF',
+                'TotalBsmtSF', '1stFlrSF', '2ndFlrSF', 'GrLivArea', 'GarageArea', 'WoodDeckSF',
+                'OpenPorchSF', 'EnclosedPorch', '3SsnPorch', 'ScreenPorch', 'LowQualFinSF', 'PoolArea']
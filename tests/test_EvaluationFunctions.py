@@ -0,0 +1,44 @@
+import io
+from contextlib import redirect_stdout
+
+import numpy as np
+import pandas as pd
+
+from EvaluationFunctions import EVAL_CONFIDENCE, evaluate_configs, evaluation_plan
+
+N_ROWS = 200
+N_SEEDS = 200
+
+
+def _noisy_fit_predict(seed, noise=0.1):
+    # Same accuracy for every seed: the price times a lognormal error, drawn independently for every fold
+    def fit_predict(x_train, y_train, x_test, timings=None):
+        rng = np.random.default_rng([seed, *x_test.index[:4]])
+        return x_test['price'].values * np.exp(rng.normal(0, noise, x_test.shape[0]))
+
+    return fit_predict
+
+
+def _evaluate(configs, seed):
+    prices = np.random.default_rng(seed).lognormal(12, 0.4, N_ROWS)
+    x = pd.DataFrame({'price': prices})
+    plan = evaluation_plan(x, random_state=seed)
+    with redirect_stdout(io.StringIO()):
+        return evaluate_configs(x, prices, configs, plan=plan), len(plan)
+
+
+def test_identical_configs_never_stop_early():
+    for seed in range(N_SEEDS):
+        fit_predict = _noisy_fit_predict(seed)
+        table, n_folds = _evaluate({'a': fit_predict, 'b': fit_predict}, seed)
+        assert (table['folds'] == n_folds).all()
+
+
+def test_equally_accurate_configs_are_rarely_decided():
+    # Different errors with the same distribution: the whole sequence of looks is wrong at most 1 - EVAL_CONFIDENCE
+    early, decided = 0, 0
+    for seed in range(N_SEEDS):
+        table, n_folds = _evaluate({'a': _noisy_fit_predict(2 * seed), 'b': _noisy_fit_predict(2 * seed + 1)}, seed)
+        early += table['folds'].iloc[0] < n_folds
+        decided += not table['ci_low'].iloc[1] <= 0 <= table['ci_high'].iloc[1]
+    assert early <= decided <= (1 - EVAL_CONFIDENCE) * N_SEEDS